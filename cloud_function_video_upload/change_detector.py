@@ -0,0 +1,180 @@
+import math
+import os
+import subprocess
+
+import numpy as np
+
+from segmenter import FFMPEG_BINARY, INTERVAL_SEC, PTS_TIME_PATTERN, probe_duration
+
+# Set STATIC_DETECTION=0 to embed every interval as before
+STATIC_DETECTION = os.environ.get("STATIC_DETECTION", "1") == "1"
+# Only keyframes are decoded (the cheap default), or with STATIC_KEYFRAMES_ONLY=0 every frame is
+# decoded and sampled at STATIC_SAMPLE_FPS. Either way they are downscaled to a tiny grayscale thumbnail.
+STATIC_KEYFRAMES_ONLY = os.environ.get("STATIC_KEYFRAMES_ONLY", "1") == "1"
+STATIC_SAMPLE_FPS = float(os.environ.get("STATIC_SAMPLE_FPS", 1))
+THUMBNAIL_WIDTH = 32
+THUMBNAIL_HEIGHT = 18
+# Mean absolute pixel difference (0-1) under which two thumbnails count as the same picture
+STATIC_THRESHOLD = float(os.environ.get("STATIC_THRESHOLD", 0.02))
+
+
+def sample_frames(video_path,
+                  fps=STATIC_SAMPLE_FPS,
+                  keyframes_only=STATIC_KEYFRAMES_ONLY):
+    """Decodes video_path into thumbnails.
+
+    ffmpeg does the decode and downscale, so only a few hundred bytes per
+    sampled frame ever reach Python. With keyframes_only the other frames
+    aren't decoded at all (-skip_frame nokey, like segmenter.list_keyframes),
+    a small fraction of the cost of decoding every frame for fps= to pick from.
+
+    Returns:
+        (frames, times): a (frames, THUMBNAIL_HEIGHT, THUMBNAIL_WIDTH) uint8
+        array and the timestamp in seconds of each frame.
+    """
+    scale = f"scale={THUMBNAIL_WIDTH}:{THUMBNAIL_HEIGHT}"
+    if keyframes_only:
+        # showinfo prints each keyframe's timestamp, -vsync 0 keeps them as they are
+        command = [
+            FFMPEG_BINARY, "-hide_banner", "-nostats", "-skip_frame", "nokey",
+            "-i", video_path, "-map", "0:v:0", "-vsync", "0", "-vf",
+            f"showinfo,{scale}"
+        ]
+    else:
+        command = [
+            FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-i",
+            video_path, "-map", "0:v:0", "-vf", f"fps={fps},{scale}"
+        ]
+    command += ["-pix_fmt", "gray", "-f", "rawvideo", "-"]
+    completed = subprocess.run(command,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               check=True)
+    frame_bytes = THUMBNAIL_WIDTH * THUMBNAIL_HEIGHT
+    usable = len(completed.stdout) // frame_bytes * frame_bytes
+    frames = np.frombuffer(completed.stdout[:usable], dtype=np.uint8).reshape(
+        -1, THUMBNAIL_HEIGHT, THUMBNAIL_WIDTH)
+    if keyframes_only:
+        times = [
+            float(t) for t in PTS_TIME_PATTERN.findall(
+                completed.stderr.decode("utf-8", errors="ignore"))
+        ][:len(frames)]
+        frames = frames[:len(times)]
+    else:
+        times = [frame / fps for frame in range(len(frames))]
+    return frames, np.array(times, dtype=np.float64)
+
+
+def find_duplicate_runs(frames,
+                        times,
+                        duration,
+                        interval_sec=INTERVAL_SEC,
+                        threshold=STATIC_THRESHOLD):
+    """Groups the intervalSec windows of a part into runs of near-identical pictures.
+
+    A window joins the current run when every frame sampled in it is within
+    threshold of the run's first window (the representative). Only the
+    representative needs an embedding; the rest of the run shows the same
+    thing.
+
+    A window without a sample of its own (keyframes can be further apart than
+    intervalSec) is judged by the next sample after it: if the picture is
+    still the same there, it didn't change in between. Encoders put a keyframe
+    on scene cuts, so a change would normally have brought a sample with it.
+    Otherwise what the window shows is unknown: it is embedded on its own and
+    nothing joins it.
+
+    Args:
+        frames: thumbnails from sample_frames.
+        times: timestamp in seconds of each frame, in order.
+
+    Returns:
+        list of [first_window, last_window] covering every window in order.
+    """
+    window_count = int(math.ceil(duration / interval_sec))
+    frames = frames.astype(np.float32) / 255
+    runs = []
+    reference = None
+    for window in range(window_count):
+        first_frame, end_frame = np.searchsorted(
+            times, [window * interval_sec, (window + 1) * interval_sec])
+        window_frames = frames[first_frame:end_frame]
+        unknown = False
+        if not len(window_frames):
+            if end_frame < len(frames):
+                window_frames = frames[end_frame:end_frame + 1]
+                unknown = True
+            else:
+                # Shorter than one sample (the tail of the part): nothing new to see
+                window_frames = frames[-1:] if len(frames) else None
+        if (reference is not None and window_frames is not None and
+                np.abs(window_frames - reference).mean(axis=(1, 2)).max() <=
+                threshold):
+            runs[-1][1] = window
+        else:
+            runs.append([window, window])
+            reference = (window_frames.mean(axis=0)
+                         if window_frames is not None and not unknown else None)
+    return runs
+
+
+class StaticPlan:
+    """Which windows of a part to embed, and which span each embedding stands for.
+
+    The predict call embeds a contiguous range of the part, so it only skips
+    the windows of the trailing run (see end_offset_sec). The windows of
+    earlier runs are still embedded by predict and only left out of the
+    index: that saves upserts and index size, not predict cost.
+
+    Args:
+        runs: output of find_duplicate_runs.
+        duration: duration of the part in seconds.
+        interval_sec: videoSegmentConfig.intervalSec of the predict call.
+    """
+
+    def __init__(self, runs, duration, interval_sec=INTERVAL_SEC):
+        self.runs = runs
+        self.duration = duration
+        self.interval_sec = interval_sec
+        self.window_count = sum(last - first + 1 for first, last in runs)
+
+    def keeps(self, window):
+        return any(first == window for first, _ in self.runs)
+
+    def span(self, window):
+        """(start_sec, end_sec) of the part covered by the embedding of a kept window."""
+        for first, last in self.runs:
+            if first == window:
+                return (first * self.interval_sec,
+                        min((last + 1) * self.interval_sec, self.duration))
+        raise KeyError(window)
+
+    def end_offset_sec(self):
+        """The predict call can stop after the last window that is kept."""
+        return min((self.runs[-1][0] + 1) * self.interval_sec, self.duration)
+
+    def skipped(self):
+        """Windows left out of the index."""
+        return self.window_count - len(self.runs)
+
+    def trimmed(self):
+        """Windows after end_offset_sec, the only ones predict is not asked for."""
+        return self.runs[-1][1] - self.runs[-1][0]
+
+
+def analyze_part(video_path, duration=None):
+    """Returns the StaticPlan of a local part, or None when detection is off or fails."""
+    if not STATIC_DETECTION:
+        return None
+    try:
+        duration = duration or probe_duration(video_path)
+        frames, times = sample_frames(video_path)
+    except subprocess.CalledProcessError as e:
+        print(f"Static detection failed for {video_path}: {e.stderr.decode('utf-8', errors='ignore')}")
+        return None
+    if not duration:
+        return None
+    plan = StaticPlan(find_duplicate_runs(frames, times, duration), duration)
+    print(f"{video_path}: {plan.skipped()} of {plan.window_count} windows are static or repeated, "
+          f"the last {plan.trimmed()} are not sent to predict")
+    return plan
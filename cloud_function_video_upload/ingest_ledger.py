@@ -0,0 +1,184 @@
+import base64
+import contextlib
+import json
+import os
+import threading
+import time
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+# Ledger entries are small marker objects, gs://{LEDGER_BUCKET_NAME}/{LEDGER_PREFIX}{key}.json
+LEDGER_BUCKET_NAME = os.environ.get("LEDGER_BUCKET_NAME",
+                                    "videosearch_embeddings")
+LEDGER_PREFIX = os.environ.get("LEDGER_PREFIX", "_ingest_ledger/")
+# A "running" entry not renewed for this long is assumed abandoned (crashed instance) and can be taken over.
+# A job holding the claim renews it every LEDGER_HEARTBEAT_SEC (see IngestLedger.heartbeat), however long it runs.
+LEDGER_LEASE_SEC = int(os.environ.get("LEDGER_LEASE_SEC", 3600))
+LEDGER_HEARTBEAT_SEC = float(
+    os.environ.get("LEDGER_HEARTBEAT_SEC", LEDGER_LEASE_SEC / 4))
+
+RUNNING = "running"
+DONE = "done"
+
+
+def ledger_key(data):
+    """Builds the ledger key of a storage object event: bucket, name, generation and checksum.
+
+    A re-upload of the same name gets a new generation, so it is ingested again.
+    """
+    checksum = data.get("crc32c") or data.get("md5Hash") or ""
+    checksum = base64.b64decode(checksum).hex() if checksum else "nochecksum"
+    return f"{data['bucket']}/{data['name']}/{data.get('generation', 0)}-{checksum}"
+
+
+class IngestLedger:
+    """Makes sure each source object version is ingested once.
+
+    Claims are created with if_generation_match=0, which GCS applies atomically,
+    so duplicate or concurrent deliveries collapse into one pipeline run even
+    across instances. Deliveries on the same instance are also deduplicated in
+    memory before touching GCS.
+
+    A claim is a lease: while its job runs, heartbeat() keeps renewing it, and
+    one that hasn't been renewed for lease_sec can be taken over.
+    """
+
+    def __init__(self,
+                 bucket,
+                 prefix=LEDGER_PREFIX,
+                 lease_sec=LEDGER_LEASE_SEC,
+                 heartbeat_sec=LEDGER_HEARTBEAT_SEC):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.lease_sec = lease_sec
+        self.heartbeat_sec = heartbeat_sec
+        self.claimed = 0
+        self.duplicates_suppressed = 0
+        self._in_flight = set()
+        # key -> generation of the entry this instance wrote when claiming (or renewing) it
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """Returns True if the caller should ingest this object, False for a duplicate."""
+        with self._lock:
+            if key in self._in_flight:
+                return self._suppress(key, "already in flight on this instance")
+            self._in_flight.add(key)
+
+        blob = self._blob(key)
+        entry = json.dumps({"state": RUNNING, "claimed_at": time.time()})
+        try:
+            blob.upload_from_string(entry, if_generation_match=0)
+        except PreconditionFailed:
+            if not self._take_over_abandoned(blob, entry):
+                with self._lock:
+                    self._in_flight.discard(key)
+                    return self._suppress(key, "already claimed")
+
+        with self._lock:
+            self.claimed += 1
+            self._generations[key] = blob.generation
+        return True
+
+    def renew(self, key):
+        """Moves the lease of a claim made by this instance forward.
+
+        Returns False if the entry isn't that claim any more (done, released or taken over).
+        """
+        with self._lock:
+            generation = self._generations.get(key)
+        if generation is None:
+            return False
+        blob = self._blob(key)
+        entry = json.dumps({"state": RUNNING, "claimed_at": time.time()})
+        try:
+            blob.upload_from_string(entry, if_generation_match=generation)
+        except PreconditionFailed:
+            print(f"Ledger claim of {key} was taken over")
+            return False
+        with self._lock:
+            if key in self._generations:
+                self._generations[key] = blob.generation
+        return True
+
+    @contextlib.contextmanager
+    def heartbeat(self, key):
+        """Renews the claim of key every heartbeat_sec while the block runs, so a long job keeps it."""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat_sec):
+                try:
+                    if not self.renew(key):
+                        return
+                except Exception as e:
+                    # Tried again at the next beat, the lease has room for a few misses
+                    print(f"Could not renew ledger claim of {key}: {e}")
+
+        thread = threading.Thread(target=beat,
+                                  name="ledger-heartbeat",
+                                  daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def mark_done(self, key):
+        self._blob(key).upload_from_string(
+            json.dumps({
+                "state": DONE,
+                "done_at": time.time()
+            }))
+        with self._lock:
+            self._in_flight.discard(key)
+            self._generations.pop(key, None)
+
+    def release(self, key):
+        """Drops the claim after a failure so a redelivery can retry."""
+        try:
+            self._blob(key).delete()
+        except NotFound:
+            pass
+        with self._lock:
+            self._in_flight.discard(key)
+            self._generations.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "claimed": self.claimed,
+                "duplicates_suppressed": self.duplicates_suppressed
+            }
+
+    def _blob(self, key):
+        return self.bucket.blob(f"{self.prefix}{key}.json")
+
+    def _take_over_abandoned(self, blob, entry):
+        try:
+            blob.reload()
+            existing = json.loads(blob.download_as_text())
+        except NotFound:
+            existing = None
+
+        if existing is not None and (existing["state"] == DONE or
+                                     time.time() - existing["claimed_at"]
+                                     < self.lease_sec):
+            return False
+
+        # Abandoned (or released in the meantime): claim it against the generation we just read
+        try:
+            blob.upload_from_string(
+                entry,
+                if_generation_match=blob.generation if existing else 0)
+        except PreconditionFailed:
+            return False
+        return True
+
+    def _suppress(self, key, reason):
+        # Caller holds the lock
+        self.duplicates_suppressed += 1
+        print(f"Suppressed duplicate ingest of {key} ({reason}), {self.duplicates_suppressed} suppressed so far")
+        return False
@@ -10,90 +10,230 @@ import tempfile
 import base64
 import functions_framework
 import subprocess
-import requests
 import json
 import google.auth.transport.requests
 import math
+import urllib.parse
+import batch_index_writer
+import change_detector
+import credentials_cache
+import embedding_store
+import http_client
+import ingest_ledger
+import memory_monitor
+import metrics
+import resilience
+import segmenter
+from ingest_ledger import IngestLedger
+from replicator import rewrite_blob
+from embedding_executor import EmbeddingExecutor
+from batch_index_writer import BatchIndexWriter
+from upsert_writer import BatchUpsertWriter
 
 storage_client = storage.Client(project="videosearch-cloudspace")
+ledger = IngestLedger(storage_client.bucket(ingest_ledger.LEDGER_BUCKET_NAME))
+# Datapoints that still failed to upsert after retries, next to the ledger entries
+dead_letters = resilience.DeadLetterStore(
+    storage_client.bucket(ingest_ledger.LEDGER_BUCKET_NAME))
 
 # change these
 PROJECT_NAME = "videosearch-cloudspace"
 REGION = "us-central1"
+# Vertex AI REST base URL. Point it at vertex_emulator.py (e.g. http://localhost:8085) to run without the real APIs
+VERTEX_API_BASE = os.environ.get("VERTEX_API_BASE",
+                                 f"https://{REGION}-aiplatform.googleapis.com")
 INDEX_ID = "7673540028760326144"
 
+# Videos up to this long fit in a single multimodalembedding request, so they skip splitting entirely
+SHORT_VIDEO_MAX_SEC = float(
+    os.environ.get("SHORT_VIDEO_MAX_SEC", segmenter.MAX_SEGMENT_SEC))
+
+# "copy" cuts parts on keyframes without re-encoding, "reencode" re-encodes every part with moviepy
+SEGMENT_MODE = os.environ.get("SEGMENT_MODE", "copy")
+
+# There is no /metrics route to scrape here, so every span goes to Cloud Logging as a structured log
+metrics.LOG_SPANS = True
+
 
 def getToken():
-    creds, project = google.auth.default()
-    auth_req = google.auth.transport.requests.Request()
-    creds.refresh(auth_req)
-    return creds.token
+    # Cached, only refreshed when close to expiry
+    return credentials_cache.get_token()
 
 
-def upsertDataPoint(datapoint_id, datapoint_content):
+def upsertDataPoints(datapoints):
+    """Upserts a list of {"datapointId", "featureVector"} dicts in one request. Used by BatchUpsertWriter.
 
-    type_datapointcontent = type(datapoint_content)
-    type_datapointid = type(datapoint_id)
+    429 and 5xx are retried (see resilience). Raises RetriesExhausted when they persist.
+    """
 
-    print(f"datapoint id: {datapoint_id}, type: {type_datapointid}")
     print(
-        f"datapoint content: {datapoint_content[0]}, type: {type_datapointcontent}"
+        f"Upserting {len(datapoints)} datapoints, first id: {datapoints[0]['datapointId']}"
     )
 
-    token = getToken()
-
-    response = requests.post(
-        f"https://{REGION}-aiplatform.googleapis.com/v1/projects/{PROJECT_NAME}/locations/{REGION}/indexes/{INDEX_ID}:upsertDatapoints",
-        headers={"Authorization": f"Bearer {token}"},
-        json={
-            "datapoints": [{
-                "datapointId": datapoint_id,
-                "featureVector": datapoint_content
-            }]
-        })
+    def send():
+        with metrics.span("upsert", datapoints=len(datapoints)) as tags:
+            response = http_client.post(
+                "upsert",
+                f"{VERTEX_API_BASE}/v1/projects/{PROJECT_NAME}/locations/{REGION}/indexes/{INDEX_ID}:upsertDatapoints",
+                headers={"Authorization": f"Bearer {getToken()}"},
+                json={"datapoints": datapoints})
+            tags["status_code"] = response.status_code
+        return response
+
+    response = resilience.upsert_endpoint.call(send)
+    if response.status_code == 200:
+        metrics.inc("ingest_upsert_datapoints_total", len(datapoints))
 
     print(response.json())
 
-    if response.status_code == 200:
-        return "success"
-    else:
-        return "error"
+    return response
 
 
-def split_video_by_duration(video,
-                            seconds_per_part=120,
-                            output_filepath_template="/tmp/part-%d.mp4"):
+def updateIndex(contents_delta_uri):
+    """Starts a batch update of the index from the datapoint files under contents_delta_uri. Returns the operation name."""
 
-    # Calculate the duration of the video in seconds
-    duration = int(video.duration)
+    def send():
+        with metrics.span("index_update") as tags:
+            response = http_client.patch(
+                "update",
+                f"{VERTEX_API_BASE}/v1/projects/{PROJECT_NAME}/locations/{REGION}/indexes/{INDEX_ID}",
+                headers={"Authorization": f"Bearer {getToken()}"},
+                json={
+                    "metadata": {
+                        "contentsDeltaUri": contents_delta_uri,
+                        "isCompleteOverwrite": False
+                    }
+                })
+            tags["status_code"] = response.status_code
+        return response
+
+    # Only one update runs on an index at a time: BatchIndexWriter waits for the one in progress and tries again
+    response = resilience.update_endpoint.call(send)
+    if batch_index_writer.is_update_conflict(response):
+        raise batch_index_writer.IndexUpdateInProgress(response.text)
+    if response.status_code != 200:
+        raise RuntimeError(
+            f"Index update from {contents_delta_uri} failed: {response.status_code} {response.text}"
+        )
 
-    # print(f"Video Length: {duration}")
+    return response.json()["name"]
 
-    # Calculate the number of parts the video will be split into
-    parts = math.ceil(duration / seconds_per_part)
 
-    # Split and export the video
-    output_filepaths = []
-    for part in range(parts):
-        # Calculate start and end times for the current part
-        start_time = part * 60
-        end_time = (part + 1) * 60
+def new_index_writer(stripped_input_video_name, duration, generation=None):
+    """Streaming upserts for most videos, a batch index update from GCS for long ones (see batch_index_writer).
 
-        # Ensure end time does not exceed video duration
-        end_time = min(end_time, duration)
+    The files are staged under the source generation, so a redelivered event reuses the staging directory.
+    """
+    if batch_index_writer.use_batch_update(duration):
+        directory, file_prefix = batch_index_writer.staging_location(
+            stripped_input_video_name, generation)
+        return BatchIndexWriter(storage_client.bucket(
+            batch_index_writer.BATCH_STAGING_BUCKET_NAME),
+                                directory,
+                                file_prefix=file_prefix,
+                                update_fn=updateIndex)
+    # Failures left after retries are dead-lettered to be replayed with DeadLetterStore.replay
+    return BatchUpsertWriter(
+        upsertDataPoints,
+        dead_letter=lambda datapoints, errors: dead_letters.put(
+            stripped_input_video_name, datapoints, errors))
 
-        # Clip the video for the current part
-        current_part = video.subclip(start_time, end_time)
 
-        # Export the current part
-        output_filepath = output_filepath_template % part
-        current_part.write_videofile(
-            output_filepath,
-            audio=True  # set this to True if you have audio files
+def split_video_by_duration(video,
+                            seconds_per_part=segmenter.MAX_SEGMENT_SEC,
+                            output_filepath_template="/tmp/part-%d.mp4",
+                            mode=SEGMENT_MODE):
+
+    if mode == "copy":
+        # Remux only. Parts that can't be cut on a keyframe are re-encoded individually.
+        return segmenter.split_video_stream_copy(
+            video.filename,
+            video.duration,
+            seconds_per_part=seconds_per_part,
+            output_filepath_template=output_filepath_template)
+
+    # Whole video covered, boundaries on the intervalSec grid, at most seconds_per_part each
+    cuts = [(start_time, end_time)
+            for start_time, end_time, _ in segmenter.plan_segments(
+                video.duration, max_segment_sec=seconds_per_part)]
+    output_filepaths = [
+        output_filepath_template % part for part in range(len(cuts))
+    ]
+
+    # Export the parts, several at a time (capped by ENCODE_WORKERS / ENCODE_MEMORY_BUDGET_MB).
+    # Under a job memory budget ffmpeg encodes instead of moviepy, it streams the audio with the video
+    # instead of decoding it into Python, and the pool gets no more than the job's budget.
+    if memory_monitor.bounded():
+        return segmenter.encode_parts_parallel(
+            video.filename,
+            cuts,
+            output_filepaths,
+            encoder=segmenter.encode_part,
+            memory_budget_mb=min(segmenter.ENCODE_MEMORY_BUDGET_MB,
+                                 memory_monitor.JOB_MEMORY_BUDGET_MB))
+    return segmenter.encode_parts_parallel(
+        video.filename,
+        cuts,
+        output_filepaths,
+        encoder=segmenter.encode_part_moviepy)
+
+
+def probe_source_duration(input_bucket_name, input_video_name):
+    """Reads the source duration from its header over HTTP, without downloading the video. None if unknown."""
+    url = f"https://storage.googleapis.com/{input_bucket_name}/{urllib.parse.quote(input_video_name)}"
+    try:
+        return segmenter.probe_duration(
+            url, headers={"Authorization": f"Bearer {getToken()}"})
+    except Exception as e:
+        print(f"Could not probe duration of {input_video_name}: {e}")
+        return None
+
+
+def predict_part(parts_bucket_name, name, static_plan=None):
+    """Calls the multimodal embedding API for one uploaded part and returns its video embeddings.
+
+    With a static_plan the call stops after the last window that will be kept, so only a static or repeated
+    run at the end of the part saves predict cost (ingest_predict_windows_trimmed_total). The windows of runs
+    before it are embedded all the same and only left out of the index (ingest_static_windows_skipped_total).
+    """
+    print(f"Generating embeddings for part: gs://{name}")
+
+    segment_config = {"intervalSec": segmenter.INTERVAL_SEC}
+    if static_plan is not None:
+        segment_config["startOffsetSec"] = 0
+        segment_config["endOffsetSec"] = static_plan.end_offset_sec()
+        metrics.inc("ingest_predict_windows_trimmed_total",
+                    static_plan.trimmed())
+
+    def send():
+        # Token fetched per attempt (from the cache) so long videos don't outlive it
+        with metrics.span("predict", part=name) as tags:
+            response = http_client.post(
+                "predict",
+                f"{VERTEX_API_BASE}/v1/projects/{PROJECT_NAME}/locations/{REGION}/publishers/google/models/multimodalembedding@001:predict",
+                headers={"Authorization": f"Bearer {getToken()}"},
+                json={
+                    "instances": [{
+                        "video": {
+                            "gcsUri": f"gs://{parts_bucket_name}/{name}",
+                            "videoSegmentConfig": segment_config
+                        }
+                    }]
+                })
+            tags["nbytes"] = len(response.content)
+            tags["status_code"] = response.status_code
+        return response
+
+    # Retried on 429/5xx with backoff. If it still fails the function fails and Eventarc redelivers the event.
+    response = resilience.predict_endpoint.call(send)
+    if response.status_code != 200:
+        raise RuntimeError(
+            f"Predict failed for gs://{parts_bucket_name}/{name}: {response.status_code} {response.text}"
         )
-        output_filepaths.append(output_filepath)
 
-    return output_filepaths
+    print(response.json())
+
+    return response.json()["predictions"][0]['videoEmbeddings']
 
 
 # Triggered by a change in a storage bucket
@@ -107,93 +247,178 @@ def main(cloud_event: CloudEvent):
         embedding file + complete if successful
         embedding file + unsuccessful if error
     """
-    destination_file = "/tmp/video.mp4"
-
     request = cloud_event.data
     print(request)
 
     input_bucket_name = request["bucket"]
-    parts_bucket_name = "videosearch_video_source_parts"
-    output_bucket_name = "videosearch_embeddings"
     input_video_name = request["name"]
     stripped_input_video_name = input_video_name.replace(".mp4", "")
 
-    with open(f'{destination_file}', 'wb') as file_obj:
-        storage_client.download_blob_to_file(
-            f'gs://{input_bucket_name}/{input_video_name}', file_obj)
-
-    vid = VideoFileClip(destination_file)
-
-    # could upload directly in this function to save space.
-    # Tradeoff is I might encounter function timeout because all files would be uploaded individually
-    # TODO: make more efficient for videos shorter than 120 seconds
-    split_video_paths = split_video_by_duration(vid)
-
-    results = transfer_manager.upload_many_from_filenames(
-        bucket=storage_client.bucket(parts_bucket_name),
-        filenames=split_video_paths,
-        source_directory="",
-        blob_name_prefix=stripped_input_video_name)
-
-    for name, result in zip(split_video_paths, results):
-        # The results list is either `None` or an exception for each filename in
-        # the input list, in order.
-
-        if isinstance(result, Exception):
-            print("Failed to upload {} due to exception: {}".format(
-                name, result))
-        else:
-            print("Uploaded {} to {}.".format(name, parts_bucket_name))
-
-    token = getToken()
-
-    # get embeddings
-    for part in split_video_paths:
-        name = f"{stripped_input_video_name}{part}"
-        print(f"Generating embeddings for part: gs://{name}")
-
-        response = requests.post(
-            f"https://{REGION}-aiplatform.googleapis.com/v1/projects/{PROJECT_NAME}/locations/{REGION}/publishers/google/models/multimodalembedding@001:predict",
-            headers={"Authorization": f"Bearer {token}"},
-            json={
-                "instances": [{
-                    "video": {
-                        "gcsUri": f"gs://{parts_bucket_name}/{name}",
-                        "videoSegmentConfig": {
-                            "intervalSec": 5
-                        }
-                    }
-                }]
-            })
-
-        print(response.json())
-
-        embeddings_list = response.json()["predictions"][0]['videoEmbeddings']
-
-        # TODO: embeddings should be stored by timestamps
-        count = 0
-        for embedding_object in embeddings_list:
-            count += 1
-            embedding = embedding_object['embedding']
-            id = f"{name}_{count}"
+    # Eventarc redelivers events, so each object version (bucket, name, generation, checksum) is only ingested once
+    key = ingest_ledger.ledger_key(request)
+    if not ledger.claim(key):
+        return
+
+    try:
+        # /tmp is memory in Cloud Functions, so the files on it are counted with the RSS.
+        # The claim is kept for as long as the video is processed.
+        with memory_monitor.MemoryMonitor(stripped_input_video_name,
+                                          "/tmp"), ledger.heartbeat(key):
+            process_video(input_bucket_name, input_video_name,
+                          stripped_input_video_name, request.get("generation"))
+    except Exception:
+        # Let a redelivery of the same object retry
+        ledger.release(key)
+        raise
+    finally:
+        # Cumulative for this instance, like the /metrics route of the Cloud Run service
+        metrics.log_summary()
+    # This run upserted (or staged) every datapoint, replaying what an earlier attempt dead-lettered would put stale vectors back
+    dead_letters.clear(stripped_input_video_name)
+    ledger.mark_done(key)
+    print(f"Ingest ledger: {ledger.stats()}")
+
+
+def process_video(input_bucket_name,
+                  input_video_name,
+                  stripped_input_video_name,
+                  generation=None):
+    destination_file = "/tmp/video.mp4"
+    parts_bucket_name = "videosearch_video_source_parts"
+    output_bucket_name = "videosearch_embeddings"
 
-            json_object = {"id": f"{id}", "embedding": embedding}
+    duration = probe_source_duration(input_bucket_name, input_video_name)
+    if duration is not None and duration <= SHORT_VIDEO_MAX_SEC:
+        # Fast path: fits in a single predict request, so the original object is copied
+        # server-side under the usual part name instead of being downloaded, split and re-uploaded.
+        print(
+            f"{input_video_name} is {duration}s long, using the short video fast path"
+        )
+        split_video_paths = ["/tmp/part-0.mp4"]
+        # Never downloaded, so there is nothing to look for static stretches in
+        static_plans = {}
+        with metrics.span("upload",
+                          bucket=parts_bucket_name,
+                          video=stripped_input_video_name,
+                          part=split_video_paths[0]) as tags:
+            tags["nbytes"] = rewrite_blob(
+                storage_client.bucket(input_bucket_name).blob(input_video_name),
+                storage_client.bucket(parts_bucket_name).blob(
+                    f"{stripped_input_video_name}{split_video_paths[0]}"))
+    else:
+        with metrics.span("download",
+                          video=stripped_input_video_name) as tags:
+            with open(f'{destination_file}', 'wb') as file_obj:
+                storage_client.download_blob_to_file(
+                    f'gs://{input_bucket_name}/{input_video_name}', file_obj)
+            tags["nbytes"] = os.path.getsize(destination_file)
+
+        # could upload directly in this function to save space.
+        # Tradeoff is I might encounter function timeout because all files would be uploaded individually
+        #
+        # The clip only supplies the path and duration, the parts are encoded by their own readers. Without
+        # audio it holds no audio buffer, and leaving the block stops its ffmpeg reader process.
+        with metrics.span("split", video=stripped_input_video_name
+                         ) as tags, VideoFileClip(destination_file,
+                                                  audio=False) as vid:
+            duration = vid.duration
+            split_video_paths = split_video_by_duration(vid)
+            tags["nbytes"] = sum(
+                os.path.getsize(path) for path in split_video_paths)
+        # Files on /tmp stay in the instance's memory until deleted, across invocations too
+        os.remove(destination_file)
+
+        # Static and repeated stretches are found on the local parts (see change_detector)
+        with metrics.span("analyze", video=stripped_input_video_name):
+            static_plans = {
+                f"{stripped_input_video_name}{path}":
+                change_detector.analyze_part(path)
+                for path in split_video_paths
+            }
+
+        with metrics.span("upload",
+                          bucket=parts_bucket_name,
+                          video=stripped_input_video_name,
+                          nbytes=tags["nbytes"]):
+            results = transfer_manager.upload_many_from_filenames(
+                bucket=storage_client.bucket(parts_bucket_name),
+                filenames=split_video_paths,
+                source_directory="",
+                blob_name_prefix=stripped_input_video_name)
+
+        for name, result in zip(split_video_paths, results):
+            # The results list is either `None` or an exception for each filename in
+            # the input list, in order.
+
+            if isinstance(result, Exception):
+                print("Failed to upload {} due to exception: {}".format(
+                    name, result))
+            else:
+                print("Uploaded {} to {}.".format(name, parts_bucket_name))
+            os.remove(name)
+
+    # Datapoints are upserted in batches (or staged for one batch index update, see new_index_writer),
+    # the writer does the final flush when the video is done. Both are closed if the video fails too.
+    with new_index_writer(stripped_input_video_name, duration, generation
+                         ) as upsert_writer, EmbeddingExecutor() as executor:
+        # get embeddings, PREDICT_CONCURRENCY parts at a time. Results come back in part order.
+        names = [
+            f"{stripped_input_video_name}{part}" for part in split_video_paths
+        ]
+        embeddings = executor.map(
+            lambda name: predict_part(parts_bucket_name, name,
+                                      static_plans.get(name)), names)
+
+        for name, embeddings_list in zip(names, embeddings):
+            static_plan = static_plans.get(name)
+
+            # Embeddings are stored with their timestamps, one artifact per part (see embedding_store)
+            records = []
+            count = 0
+            for embedding_object in embeddings_list:
+                count += 1
+                embedding = embedding_object['embedding']
+                start_sec = embedding_object.get('startOffsetSec')
+                end_sec = embedding_object.get('endOffsetSec')
+
+                if static_plan is not None:
+                    # Only the first window of a static run is kept, spanning the whole run.
+                    # Ids stay numbered by window, the front-end derives the timestamp from them.
+                    window = count - 1 if start_sec is None else round(
+                        start_sec / segmenter.INTERVAL_SEC)
+                    count = window + 1
+                    if not static_plan.keeps(window):
+                        continue
+                    start_sec, end_sec = static_plan.span(window)
+
+                id = f"{name}_{count}"
+
+                records.append({
+                    "id": f"{id}",
+                    "start_sec": start_sec,
+                    "end_sec": end_sec,
+                    "embedding": embedding
+                })
+
+                upsert_writer.add(id, embedding)
 
             # NOTE: doesn't not check for repeated uploads of same image. Would need to include some logic in order to avoid overwriting already uploaded images
             # Vector Search does check for duplicates before upserting so it wouldn't affect the index performance wise. Although you would likely get charged for the bytes transfered.
-
-            output_bucket = storage_client.bucket(output_bucket_name)
-
-            new_blob = output_bucket.blob(f"{id}.json")
-            new_blob.upload_from_string(data=json.dumps(json_object),
-                                        content_type='application/json')
-
-            upsert_result = upsertDataPoint(id, embedding)
-            print(f"Upsert Result: {upsert_result}")
-
-            if upsert_result == "success":
-                print(f"{id}.json complete")
-            else:
-                print(f"{id}.json unsuccessful")
+            artifact_name = embedding_store.write_part_embeddings(
+                storage_client.bucket(output_bucket_name), name, records)
+            print(
+                f"Stored {len(records)} embeddings in gs://{output_bucket_name}/{artifact_name}"
+            )
+            if static_plan is not None:
+                # Embedded by predict, but left out of the index
+                metrics.inc("ingest_static_windows_skipped_total",
+                            len(embeddings_list) - len(records))
+
+    print(f"Credential cache: {credentials_cache.stats()}")
+
+    if upsert_writer.failed:
+        # Fail the function instead of marking the video done, the redelivered event loads them again
+        raise RuntimeError(
+            f"{len(upsert_writer.failed)} datapoints failed to upsert")
 
     return
@@ -0,0 +1,65 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+REPLICATION_WORKERS = int(os.environ.get("REPLICATION_WORKERS", 4))
+
+
+def rewrite_blob(source_blob, destination_blob):
+    """Server-side copy, across buckets and projects. Nothing goes through the instance. Returns the object size."""
+    # Large objects (or cross-location copies) take several rewrite calls
+    token, _, total_bytes = destination_blob.rewrite(source_blob)
+    while token is not None:
+        token, _, total_bytes = destination_blob.rewrite(source_blob,
+                                                         token=token)
+    return total_bytes
+
+
+class PartReplicator:
+    """Copies uploaded parts to other buckets with server-side rewrites, in the background.
+
+    The instance uploads each part once; every other destination is filled from
+    that first copy by GCS itself, so no extra egress leaves the instance.
+
+    Args:
+        source_bucket: bucket the parts are uploaded to first.
+        destination_buckets: buckets to copy each part into. They can belong to
+            another project (use a storage client for that project).
+        workers: concurrent rewrites.
+    """
+
+    def __init__(self,
+                 source_bucket,
+                 destination_buckets,
+                 workers=REPLICATION_WORKERS):
+        self.source_bucket = source_bucket
+        self.destination_buckets = destination_buckets
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="replicate")
+        self._futures = []
+
+    def submit(self, blob_name):
+        for destination_bucket in self.destination_buckets:
+            future = self._executor.submit(self._rewrite, blob_name,
+                                           destination_bucket)
+            self._futures.append((blob_name, destination_bucket.name, future))
+
+    def close(self):
+        """Waits for every copy and returns [(blob_name, bucket_name, None or exception)]."""
+        results = []
+        for blob_name, bucket_name, future in self._futures:
+            error = future.exception()
+            if error is None:
+                print(f"Replicated {blob_name} to {bucket_name}.")
+            else:
+                print(f"Failed to replicate {blob_name} to {bucket_name} due to exception: {error}")
+            results.append((blob_name, bucket_name, error))
+        self._executor.shutdown(wait=True)
+        return results
+
+    def _rewrite(self, blob_name, destination_bucket):
+        with metrics.span("upload", bucket=destination_bucket.name,
+                          part=blob_name) as tags:
+            tags["nbytes"] = rewrite_blob(self.source_bucket.blob(blob_name),
+                                          destination_bucket.blob(blob_name))
@@ -0,0 +1,234 @@
+"""Re-ingests every video in a source bucket (or under a prefix), several at a time.
+
+Each video runs through main.ingest_job, the same code path as the Cloud Run
+handler, in a pool of worker processes. --workers is the global limit on videos
+in flight; the predict quota (PREDICT_QPM) and the scratch budget
+(SCRATCH_QUOTA_MB) are split evenly between the processes so that together
+they stay within the instance and project limits. A run refuses to start if
+its share of scratch is smaller than one job's quota (JOB_SCRATCH_QUOTA_MB):
+
+    python backfill.py gs://videosearch_source_videos --workers 8 --scratch-quota-mb 16384 --dry-run
+    python backfill.py gs://videosearch_source_videos/lectures/ --workers 8 --scratch-quota-mb 16384 --predict-qpm 600
+
+Progress is appended to a JSON lines file (one line per finished video).
+Running the same command again skips every object version already done and
+retries the ones that failed. Each video's output goes to its own file under
+--log-dir so the progress lines stay readable.
+
+With --index-update batch, no datapoint is upserted: every video is staged in
+one GCS directory per progress file (see batch_index_writer) and the index is
+updated once from it at the end of the run:
+
+    python backfill.py gs://videosearch_source_videos --index-update batch --wait-index-update
+"""
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from google.cloud import storage
+
+import batch_index_writer
+import embedding_executor
+import scratch
+
+# Set by _init_worker in each worker process
+_main = None
+
+
+def _init_worker():
+    """Runs once per worker process. The limits were already set in the environment by the parent."""
+    global _main
+    import main
+    _main = main
+
+
+def ingest(video, log_dir, only_new):
+    """Runs one video through main.ingest_job in a worker process. Returns its progress record."""
+    key = _main.ingest_ledger.ledger_key(video)
+    start = time.time()
+    status = "done"
+    error = None
+    log_path = os.path.join(log_dir, re.sub(r"[^\w.-]", "_", video["name"]) + ".log")
+    with open(log_path, "a") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        if only_new and not _main.ledger.claim(key):
+            status = "skipped"
+        else:
+            try:
+                # Without --only-new nothing was claimed: a failure must not touch the ledger entry
+                _main.ingest_job(key, video["bucket"], video["name"], video["name"].replace(".mp4", ""), claimed=only_new)
+            except Exception as e:
+                status = "failed"
+                error = f"{type(e).__name__}: {e}"
+                print(error)
+    return dict(video,
+                status=status,
+                error=error,
+                elapsed_sec=round(time.time() - start, 1),
+                staged=status == "done" and _main.batch_index_writer.BATCH_UPDATE_DEFERRED)
+
+
+def update_index(uri, wait):
+    """Runs in a worker process: one batch index update from everything staged under uri."""
+    operation = _main.updateIndex(uri)
+    while wait and not _main.getOperation(operation).get("done"):
+        time.sleep(30)
+    return operation
+
+
+def list_videos(storage_client, uri, suffix):
+    bucket_name, _, prefix = uri[len("gs://"):].partition("/")
+    for blob in storage_client.list_blobs(bucket_name, prefix=prefix):
+        if blob.name.endswith(suffix):
+            yield {
+                "bucket": bucket_name,
+                "name": blob.name,
+                "generation": blob.generation,
+                "size": blob.size,
+                "crc32c": blob.crc32c,
+                "md5Hash": blob.md5_hash
+            }
+
+
+def load_progress(path):
+    """Returns the (name, generation) of every video already done or skipped by an earlier run,
+    and whether some of them were staged for a batch index update that hasn't been started yet."""
+    finished = set()
+    update_pending = False
+    if not os.path.exists(path):
+        return finished, update_pending
+    with open(path) as progress:
+        for line in progress:
+            record = json.loads(line)
+            if "operation" in record:
+                update_pending = False
+            elif record["status"] in ("done", "skipped"):
+                finished.add((record["name"], record["generation"]))
+                update_pending = update_pending or record.get("staged", False)
+    return finished, update_pending
+
+
+def staging_directory(progress_path):
+    """One staging directory per progress file, so a resumed run adds to the same batch update."""
+    stem = os.path.splitext(os.path.basename(progress_path))[0]
+    return f"{batch_index_writer.BATCH_STAGING_PREFIX}{stem}/"
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m{seconds % 60:02d}s"
+
+
+def worker_environment(args):
+    """Each process gets an equal share of the instance-wide limits, and no JobQueue workers of its own."""
+    environment = {
+        "PREDICT_QPM": str(args.predict_qpm / args.workers),
+        "PREDICT_INSTANCE_CONCURRENCY": str(max(1, math.ceil(embedding_executor.PREDICT_INSTANCE_CONCURRENCY / args.workers))),
+        "SCRATCH_QUOTA_MB": str(args.scratch_quota_mb // args.workers),
+        "PIPELINE_MODE": args.mode,
+        "INGEST_WORKERS": "0",
+        "JOB_QUEUE_PATH": os.path.join(tempfile.mkdtemp(prefix="backfill-"), "jobs.sqlite3"),
+        "INDEX_UPDATE_MODE": args.index_update,
+    }
+    if args.index_update == "batch":
+        environment["BATCH_UPDATE_DEFERRED"] = "1"
+        environment["BATCH_STAGING_PREFIX"] = staging_directory(args.progress)
+    return environment
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("uri", help="gs://bucket or gs://bucket/prefix to ingest")
+    parser.add_argument("--workers", type=int, default=max(1, scratch.SCRATCH_QUOTA_MB // scratch.JOB_SCRATCH_QUOTA_MB),
+                        help="videos processed at once, one process each (default: as many as the scratch budget holds)")
+    parser.add_argument("--predict-qpm", type=float, default=embedding_executor.PREDICT_QPM,
+                        help="multimodalembedding quota shared by every worker (requests per minute)")
+    parser.add_argument("--scratch-quota-mb", type=int, default=scratch.SCRATCH_QUOTA_MB,
+                        help="scratch (/tmp) budget shared by every worker")
+    parser.add_argument("--mode", default="streaming", choices=["streaming", "phased"])
+    parser.add_argument("--suffix", default=".mp4", help="only ingest objects ending with this")
+    parser.add_argument("--progress", default="backfill-progress.jsonl", help="progress file, appended to")
+    parser.add_argument("--log-dir", default="backfill-logs")
+    parser.add_argument("--only-new", action="store_true",
+                        help="skip object versions the ingest ledger already has (default: re-ingest everything)")
+    parser.add_argument("--videos-per-process", type=int, default=20,
+                        help="recycle a worker process after this many videos, so leaks can't build up")
+    parser.add_argument("--index-update", default=batch_index_writer.INDEX_UPDATE_MODE, choices=["auto", "stream", "batch"],
+                        help="batch: stage every datapoint and update the index once at the end instead of upserting")
+    parser.add_argument("--wait-index-update", action="store_true", help="wait for the batch index update to finish")
+    parser.add_argument("--dry-run", action="store_true", help="list what would be ingested and exit")
+    parser.add_argument("--project", default="videosearch-cloudspace")
+    args = parser.parse_args()
+    if args.scratch_quota_mb // args.workers < scratch.JOB_SCRATCH_QUOTA_MB:
+        parser.error(f"--scratch-quota-mb {args.scratch_quota_mb} leaves {args.scratch_quota_mb // args.workers} MB per worker, "
+                     f"less than one job's JOB_SCRATCH_QUOTA_MB ({scratch.JOB_SCRATCH_QUOTA_MB} MB): "
+                     f"use at most {args.scratch_quota_mb // scratch.JOB_SCRATCH_QUOTA_MB} workers or a larger budget")
+
+    finished, update_pending = load_progress(args.progress)
+    videos = []
+    already_done = 0
+    for video in list_videos(storage.Client(project=args.project), args.uri, args.suffix):
+        if (video["name"], video["generation"]) in finished:
+            already_done += 1
+        else:
+            videos.append(video)
+    total_bytes = sum(video["size"] for video in videos)
+    print(f"{len(videos)} videos to ingest ({total_bytes / 1e9:.2f} GB), {already_done} already done according to {args.progress}")
+
+    if args.dry_run:
+        for video in videos:
+            print(f"  gs://{video['bucket']}/{video['name']} ({video['size'] / 1e6:.1f} MB)")
+        return
+    if not videos and not update_pending:
+        return
+
+    os.makedirs(args.log_dir, exist_ok=True)
+    counts = {"done": 0, "skipped": 0, "failed": 0}
+    done_bytes = 0
+    start = time.time()
+    # Inherited by the worker processes, which read it when they import main and its modules.
+    # spawn: main starts threads at import, which fork doesn't carry over safely.
+    os.environ.update(worker_environment(args))
+    with open(args.progress, "a") as progress, ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            max_tasks_per_child=args.videos_per_process) as pool:
+        futures = [pool.submit(ingest, video, args.log_dir, args.only_new) for video in videos]
+        for finished_count, future in enumerate(as_completed(futures), 1):
+            record = future.result()
+            progress.write(json.dumps(record) + "\n")
+            progress.flush()
+
+            counts[record["status"]] += 1
+            done_bytes += record["size"]
+            elapsed = time.time() - start
+            rate = done_bytes / elapsed
+            eta = (total_bytes - done_bytes) / rate if rate else 0
+            print(f"[{finished_count}/{len(videos)}] {record['status']:>7} {record['name']} in {record['elapsed_sec']}s"
+                  f" | {rate / 1e6:.1f} MB/s, {finished_count / elapsed * 3600:.0f} videos/h, ETA {format_duration(eta)}"
+                  + (f" | {record['error']}" if record["error"] else ""))
+            update_pending = update_pending or record["staged"]
+
+        if update_pending:
+            # Also covers videos staged by an earlier, interrupted run with the same progress file
+            uri = f"gs://{batch_index_writer.BATCH_STAGING_BUCKET_NAME}/{staging_directory(args.progress)}"
+            operation = pool.submit(update_index, uri, args.wait_index_update).result()
+            progress.write(json.dumps({"operation": operation, "uri": uri}) + "\n")
+            print(f"Index update from {uri}: {operation}" + (" done" if args.wait_index_update else " started"))
+
+    print(f"Backfill finished in {format_duration(time.time() - start)}: {counts}. Logs in {args.log_dir}")
+    if counts["failed"]:
+        print(f"Run the same command again to retry the {counts['failed']} failed videos")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
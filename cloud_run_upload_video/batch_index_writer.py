@@ -0,0 +1,200 @@
+import json
+import os
+import re
+import threading
+import time
+
+import metrics
+import segmenter
+
+# "auto" uses a batch index update for videos expected to produce at least BATCH_UPDATE_MIN_DATAPOINTS
+# datapoints and streaming upserts below that. "stream" and "batch" force one or the other.
+INDEX_UPDATE_MODE = os.environ.get("INDEX_UPDATE_MODE", "auto")
+BATCH_UPDATE_MIN_DATAPOINTS = int(
+    os.environ.get("BATCH_UPDATE_MIN_DATAPOINTS", 2000))
+# Vector Search reads the staged files from here, so its service agent needs read access
+BATCH_STAGING_BUCKET_NAME = os.environ.get("BATCH_STAGING_BUCKET_NAME",
+                                           "videosearch_embeddings")
+BATCH_STAGING_PREFIX = os.environ.get("BATCH_STAGING_PREFIX",
+                                      "_batch_updates/")
+# Datapoints per staged file
+BATCH_FILE_DATAPOINTS = int(os.environ.get("BATCH_FILE_DATAPOINTS", 5000))
+# Set by backfill.py: every video of the run is staged flat under BATCH_STAGING_PREFIX and the
+# index is updated once for the whole run, instead of once per video
+BATCH_UPDATE_DEFERRED = os.environ.get("BATCH_UPDATE_DEFERRED", "0") == "1"
+# Only one update runs on an index at a time. While another one is in progress close() retries
+# every BATCH_UPDATE_RETRY_SEC, for up to BATCH_UPDATE_WAIT_SEC (updates take minutes to hours).
+BATCH_UPDATE_RETRY_SEC = float(os.environ.get("BATCH_UPDATE_RETRY_SEC", 60))
+BATCH_UPDATE_WAIT_SEC = float(os.environ.get("BATCH_UPDATE_WAIT_SEC", 3600))
+
+
+class IndexUpdateInProgress(Exception):
+    """Raised by an update_fn when the index is still being updated by an earlier request."""
+
+
+def is_update_conflict(response):
+    """True if Vector Search rejected an index update because another operation is running on the index."""
+    if response.status_code not in (400, 409):
+        return False
+    try:
+        status = response.json().get("error", {}).get("status")
+    except ValueError:
+        return False
+    return status in ("FAILED_PRECONDITION", "ABORTED")
+
+
+def use_batch_update(duration,
+                     mode=INDEX_UPDATE_MODE,
+                     min_datapoints=BATCH_UPDATE_MIN_DATAPOINTS,
+                     interval_sec=segmenter.INTERVAL_SEC):
+    """True if a video of duration seconds should be loaded with a batch index update.
+
+    A batch update takes minutes to hours to show up in queries, but costs far
+    less than streaming upserts for a large number of datapoints. Videos of
+    unknown duration stay on streaming upserts.
+    """
+    if mode == "batch":
+        return True
+    if mode == "stream" or duration is None:
+        return False
+    return duration / interval_sec >= min_datapoints
+
+
+def staging_location(video_name, generation=None, deferred=BATCH_UPDATE_DEFERRED):
+    """(directory, file_prefix) for the files of one video.
+
+    Vector Search only reads the files directly under contentsDeltaUri, so a
+    deferred video gets its own file prefix in the shared run directory
+    instead of a directory of its own. Both are named after the source
+    object generation, so a retry of the same version overwrites the files
+    of the failed attempt instead of leaving them behind.
+    """
+    version = generation if generation is not None else f"{time.time():.6f}".replace(".", "")
+    if deferred:
+        safe_name = re.sub(r"[^\w.-]", "_", video_name)
+        return (BATCH_STAGING_PREFIX, f"{safe_name}-{version}")
+    return (f"{BATCH_STAGING_PREFIX}{video_name}/{version}/", "datapoints")
+
+
+def read_staged_datapoints(storage_client, uri):
+    """Yields the {"id", "embedding"} datapoints a batch update from uri would load (files directly under it)."""
+    bucket_name, _, directory = uri[len("gs://"):].partition("/")
+    for blob in storage_client.list_blobs(bucket_name, prefix=directory):
+        relative = blob.name[len(directory):]
+        if "/" in relative or not relative.endswith(".json"):
+            continue
+        for line in blob.download_as_text().splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+class BatchIndexWriter:
+    """Stages datapoints as Vector Search batch update files in GCS, then loads them with one index update.
+
+    Drop-in for BatchUpsertWriter (add, close, upserted, failed). Each file
+    holds up to file_datapoints lines of {"id", "embedding"}, the JSON input
+    format of batch updates. close() writes what is left and calls update_fn
+    with the gs:// directory once. If another update is still running on the
+    index (update_fn raises IndexUpdateInProgress) it waits and tries again.
+
+    Args:
+        bucket: staging bucket.
+        directory: prefix of the staged files, ending in "/". The index is
+            updated from everything under it.
+        file_prefix: name of the staged files, before "-N.json".
+        update_fn: takes the gs:// directory, starts the index update and
+            returns its operation name. None only stages the files, the caller
+            updates the index later.
+        file_datapoints: maximum datapoints per file.
+        update_wait_sec: how long to keep retrying while another update runs.
+        update_retry_sec: time between those retries.
+    """
+
+    def __init__(self,
+                 bucket,
+                 directory,
+                 file_prefix="datapoints",
+                 update_fn=None,
+                 file_datapoints=BATCH_FILE_DATAPOINTS,
+                 update_wait_sec=BATCH_UPDATE_WAIT_SEC,
+                 update_retry_sec=BATCH_UPDATE_RETRY_SEC):
+        self.bucket = bucket
+        self.directory = directory
+        self.file_prefix = file_prefix
+        self.update_fn = update_fn
+        self.file_datapoints = file_datapoints
+        self.update_wait_sec = update_wait_sec
+        self.update_retry_sec = update_retry_sec
+
+        self.upserted = 0
+        self.failed = {}  # datapoint id -> error
+        self.operation = None
+
+        self._buffer = []
+        self._staged_ids = []
+        self._files = 0
+        self._lock = threading.Lock()
+
+    @property
+    def uri(self):
+        return f"gs://{self.bucket.name}/{self.directory}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, datapoint_id, feature_vector):
+        with self._lock:
+            self._buffer.append({"id": datapoint_id, "embedding": feature_vector})
+            if len(self._buffer) >= self.file_datapoints:
+                self._write_file()
+
+    def close(self):
+        """Stages what is left, starts the index update and returns {"upserted": count, "failed": {id: error}}."""
+        with self._lock:
+            if self._buffer:
+                self._write_file()
+            staged_ids = self._staged_ids
+            self._staged_ids = []
+
+        if staged_ids and self.update_fn is not None:
+            try:
+                self.operation = self._update()
+            except Exception as e:
+                # The staged files stay where they are, a retry of the job stages them again in the same place
+                for datapoint_id in staged_ids:
+                    self.failed[datapoint_id] = str(e)
+                print(f"Index update from {self.uri} failed: {e}")
+                staged_ids = []
+            else:
+                print(f"Index update from {self.uri} started: {self.operation}")
+
+        self.upserted += len(staged_ids)
+        print(f"Staged {self.upserted} datapoints in {self._files} files under {self.uri}, {len(self.failed)} failed")
+        return {"upserted": self.upserted, "failed": dict(self.failed)}
+
+    def _update(self):
+        deadline = time.monotonic() + self.update_wait_sec
+        while True:
+            try:
+                return self.update_fn(self.uri)
+            except IndexUpdateInProgress as e:
+                if time.monotonic() + self.update_retry_sec > deadline:
+                    raise
+                print(f"Index update from {self.uri} waits for the one in progress: {e}")
+                metrics.inc("ingest_index_update_conflicts_total")
+                time.sleep(self.update_retry_sec)
+
+    def _write_file(self):
+        # Caller holds the lock
+        blob = self.bucket.blob(
+            f"{self.directory}{self.file_prefix}-{self._files}.json")
+        data = "\n".join(json.dumps(datapoint) for datapoint in self._buffer)
+        with metrics.span("stage", bucket=self.bucket.name, nbytes=len(data)):
+            blob.upload_from_string(data, content_type="application/json")
+        metrics.inc("ingest_staged_datapoints_total", len(self._buffer))
+        self._staged_ids.extend(datapoint["id"] for datapoint in self._buffer)
+        self._files += 1
+        self._buffer = []
@@ -0,0 +1,46 @@
+"""Measures source download throughput against worker count.
+
+Compares the single-stream download process_video used to do with
+sliced_download at several worker counts:
+
+    python benchmark_download.py gs://videosearch_source_videos/animals.mp4 --workers 1,2,4,8,16 --chunk-mb 32
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from google.cloud import storage
+
+import sliced_download
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("uri", help="gs://bucket/object to download")
+    parser.add_argument("--workers", default="1,2,4,8,16")
+    parser.add_argument("--chunk-mb", type=int, default=sliced_download.DOWNLOAD_CHUNK_MB)
+    parser.add_argument("--project", default="videosearch-cloudspace")
+    args = parser.parse_args()
+
+    bucket_name, blob_name = args.uri[len("gs://"):].split("/", 1)
+    blob = storage.Client(project=args.project).bucket(bucket_name).get_blob(blob_name)
+    print(f"{args.uri}: {blob.size / 1e6:.1f} MB, {args.chunk_mb} MB chunks")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        destination = os.path.join(tmp, "video.mp4")
+
+        start = time.time()
+        blob.download_to_filename(destination)
+        elapsed = time.time() - start
+        print(f"{'single stream':>14}: {blob.size / elapsed / 1e6:8.1f} MB/s ({elapsed:.1f}s)")
+
+        for workers in [int(w) for w in args.workers.split(",")]:
+            os.remove(destination)
+            throughput = sliced_download.download(
+                blob, destination, chunk_size=args.chunk_mb * 1024 * 1024, workers=workers)
+            print(f"{workers:>6} workers: {throughput / 1e6:8.1f} MB/s ({blob.size / throughput:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Runs process_video end to end offline and reports where the time goes.
+
+Synthetic MP4s are generated locally with ffmpeg, and GCS, the predict
+endpoint and upsertDatapoints are replaced by in-process fakes with
+configurable latency, bandwidth and error rate. Nothing leaves the machine:
+
+    python benchmark_ingest.py --durations 60,600 --resolution 1280x720
+    python benchmark_ingest.py --durations 1800 --mode phased --predict-latency-ms 3000 --error-rate 0.02
+    python benchmark_ingest.py --durations 1200 --predict-qpm 6      (quota pressure: 429s and Retry-After)
+    JOB_MEMORY_BUDGET_MB=512 python benchmark_ingest.py --durations 60,600,1800 --max-memory-growth-mb 64
+
+main reads its settings (SEGMENT_MODE, PIPELINE_QUEUE_SIZE, ...) from the
+environment as usual, e.g. SEGMENT_MODE=reencode python benchmark_ingest.py.
+
+Reports per-stage time (from the metrics module), peak RSS, peak scratch
+(/tmp) usage and video-seconds ingested per wall-clock second.
+
+--max-memory-growth-mb turns a run into a regression check: it exits 1 if the
+job's peak memory (see memory_monitor) for the longest video is more than that
+above the shortest one's. With a JOB_MEMORY_BUDGET_MB it should stay flat.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Set before main is imported: it opens the job queue and reads these at import time
+WORK_DIR = tempfile.mkdtemp(prefix="benchmark-ingest-")
+os.environ.setdefault("SCRATCH_ROOT", os.path.join(WORK_DIR, "scratch"))
+os.environ.setdefault("JOB_QUEUE_PATH", os.path.join(WORK_DIR, "jobs.sqlite3"))
+
+from google.cloud import storage
+
+from fake_backends import FakeLatency, FakeStorageClient, FakeTransferManager, FakeVertex
+
+# Every storage.Client main creates at import talks to the fake GCS
+FakeStorageClient.root = os.path.join(WORK_DIR, "gcs")
+storage.Client = FakeStorageClient
+
+import main
+import metrics
+import segmenter
+
+
+def make_video(path, duration, resolution, fps, slide_sec=0):
+    """Writes a synthetic H.264/AAC MP4 (test pattern and a tone) with a keyframe every 2 seconds.
+
+    The pattern moves every frame, or with slide_sec only changes every slide_sec
+    seconds, like a lecture or a fixed camera.
+    """
+    rate = f"1/{slide_sec}" if slide_sec else fps
+    subprocess.run([
+        segmenter.FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={resolution}:rate={rate}:duration={duration},fps={fps}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-g", str(fps * 2), "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-shortest", path
+    ], check=True)
+
+
+def current_rss_bytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.path.getsize(os.path.join(root, filename))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class PeakSampler:
+    """Samples RSS and scratch usage in the background and keeps the peaks."""
+
+    def __init__(self, scratch_dir, interval_sec=0.1):
+        self.scratch_dir = scratch_dir
+        self.interval_sec = interval_sec
+        self.peak_rss = 0
+        self.peak_scratch = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, current_rss_bytes())
+            self.peak_scratch = max(self.peak_scratch, directory_bytes(self.scratch_dir))
+            self._stop.wait(self.interval_sec)
+
+
+def run_once(source_bucket, video_name, duration, mode, vertex):
+    metrics.reset()
+    stripped = video_name.replace(".mp4", "")
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    error = None
+    start = time.time()
+    with PeakSampler(os.environ["SCRATCH_ROOT"]) as sampler:
+        try:
+            main.process_video(source_bucket, video_name, stripped, mode=mode)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+    elapsed = time.time() - start
+
+    stages = {}
+    for metric in metrics.snapshot():
+        if metric["name"] == "ingest_stage_seconds":
+            stage = metric["labels"]["stage"]
+            if "bucket" in metric["labels"] and metric["labels"]["bucket"] != main.PARTS_BUCKET_NAME:
+                stage = f"{stage}:{metric['labels']['bucket']}"
+            stages[stage] = {k: metric[k] for k in ("count", "sum", "p50", "p99")}
+
+    return {
+        "video_sec": duration,
+        "mode": mode,
+        "wall_sec": round(elapsed, 3),
+        "video_sec_per_sec": round(duration / elapsed, 2),
+        "peak_rss_mb": round(sampler.peak_rss / 2**20, 1),
+        # ffmpeg and the encode pool run in child processes
+        "peak_child_rss_mb": round(max(0, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss - children_before) / 1024, 1),
+        "peak_scratch_mb": round(sampler.peak_scratch / 2**20, 1),
+        # What the job's own MemoryMonitor saw: its processes and scratch files, above its baseline
+        "peak_job_memory_mb": round(histogram_sum("ingest_job_peak_memory_bytes") / 2**20, 1),
+        "upserted": vertex.upserted,
+        "error": error,
+        "stages": stages
+    }
+
+
+def histogram_sum(name):
+    # metrics were reset before the run, so this is the one job's value
+    return next((metric["sum"] for metric in metrics.snapshot() if metric["name"] == name), 0)
+
+
+def memory_growth_mb(results):
+    """Peak job memory of the longest video minus that of the shortest."""
+    ordered = sorted(results, key=lambda result: result["video_sec"])
+    return ordered[-1]["peak_job_memory_mb"] - ordered[0]["peak_job_memory_mb"]
+
+
+def print_result(result):
+    print(f"\n{result['video_sec']}s video, {result['mode']}: {result['wall_sec']}s wall, "
+          f"{result['video_sec_per_sec']} video-s/s, peak RSS {result['peak_rss_mb']} MB "
+          f"(children {result['peak_child_rss_mb']} MB), peak scratch {result['peak_scratch_mb']} MB, "
+          f"job peak {result['peak_job_memory_mb']} MB, {result['upserted']} upserted")
+    if result["error"]:
+        print(f"  failed: {result['error']}")
+    for stage, timing in sorted(result["stages"].items()):
+        print(f"  {stage:>24}: {timing['count']:4d} spans, {timing['sum']:8.2f}s total, "
+              f"p50 {timing['p50']:.2f}s, p99 {timing['p99']:.2f}s")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--durations", default="60,600", help="video lengths in seconds, comma separated")
+    parser.add_argument("--resolution", default="1280x720")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--slide-sec", type=float, default=0, help="change the picture only every this many seconds (static content)")
+    parser.add_argument("--mode", default="streaming", choices=["streaming", "phased"])
+    parser.add_argument("--gcs-latency-ms", type=float, default=20)
+    parser.add_argument("--gcs-mbps", type=float, default=800, help="simulated GCS bandwidth per request, 0 for unlimited")
+    parser.add_argument("--predict-latency-ms", type=float, default=2000)
+    parser.add_argument("--upsert-latency-ms", type=float, default=200)
+    parser.add_argument("--predict-qpm", type=int, default=0, help="predict quota per minute, answered 429 with Retry-After beyond it")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of GCS, predict and upsert calls that fail")
+    parser.add_argument("--max-memory-growth-mb", type=float, default=None,
+                        help="exit 1 if the longest video's peak job memory exceeds the shortest one's by more than this")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--keep", action="store_true", help=f"keep {WORK_DIR}")
+    args = parser.parse_args()
+
+    storage_client = main.storage_client
+    FakeStorageClient.gcs = FakeLatency(args.gcs_latency_ms, args.gcs_mbps, args.error_rate)
+    vertex = FakeVertex(
+        storage_client,
+        predict=FakeLatency(args.predict_latency_ms, error_rate=args.error_rate, seed=1, qpm=args.predict_qpm),
+        upsert=FakeLatency(args.upsert_latency_ms, error_rate=args.error_rate, seed=2))
+    main.http_client = vertex
+    main.getToken = lambda: "benchmark"
+    main.transfer_manager = FakeTransferManager
+    # The real probe reads the header over HTTP, the fake objects are local files
+    main.probe_source_duration = lambda bucket_name, name: segmenter.probe_duration(
+        storage_client.bucket(bucket_name).blob(name).path)
+    # Same for the parts cut straight from the source under a memory budget
+    main.source_url = lambda bucket_name, name: storage_client.bucket(bucket_name).blob(name).path
+    main.source_headers = lambda: None
+
+    results = []
+    try:
+        for duration in [int(d) for d in args.durations.split(",")]:
+            video_name = f"benchmark-{duration}s-{args.resolution}.mp4"
+            local_video = os.path.join(WORK_DIR, video_name)
+            print(f"Generating {video_name}...", file=sys.stderr)
+            make_video(local_video, duration, args.resolution, args.fps, args.slide_sec)
+            source_bucket = storage_client.bucket("benchmark-source")
+            shutil.copyfile(local_video, source_bucket.blob(video_name).path)
+            os.remove(local_video)
+
+            vertex.upserted = 0
+            result = run_once(source_bucket.name, video_name, duration, args.mode, vertex)
+            results.append(result)
+            if not args.json:
+                print_result(result)
+    finally:
+        if not args.keep:
+            shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+    if args.max_memory_growth_mb is not None and len(results) > 1:
+        growth = memory_growth_mb(results)
+        print(f"\nPeak job memory grew {growth:.1f} MB from the shortest to the longest video "
+              f"(at most {args.max_memory_growth_mb} MB allowed)", file=sys.stderr)
+        if growth > args.max_memory_growth_mb:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
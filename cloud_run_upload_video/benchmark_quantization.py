@@ -0,0 +1,84 @@
+"""Measures size, decode time and recall loss of each embeddings format.
+
+Uses the stored embeddings under a prefix (or random vectors with --synthetic)
+and compares the top-k neighbours of float16 and int8 against float32:
+
+    python benchmark_quantization.py gs://videosearch_embeddings/animals/tmp --k 10 --queries 200
+    python benchmark_quantization.py --synthetic 20000
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+import embedding_store
+
+FORMATS = ["jsonl", "float32", "float16", "int8"]
+
+
+def load_records(uri, project):
+    from google.cloud import storage
+
+    bucket_name, prefix = uri[len("gs://"):].split("/", 1)
+    records = []
+    for blob in storage.Client(project=project).list_blobs(bucket_name, prefix=prefix):
+        if blob.name.endswith((embedding_store.EMBEDDINGS_SUFFIX, embedding_store.BINARY_SUFFIX)):
+            records.extend(embedding_store.read_part_embeddings(blob))
+    return records
+
+
+def synthetic_records(count, dim=1408):
+    vectors = np.random.default_rng(0).standard_normal((count, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return [{
+        "id": f"synthetic_{i}",
+        "start_sec": i * 5 % 120,
+        "end_sec": i * 5 % 120 + 5,
+        "embedding": vector.tolist()
+    } for i, vector in enumerate(vectors)]
+
+
+def encode(records, fmt):
+    if fmt == "jsonl":
+        return "\n".join(json.dumps(record) for record in records).encode("utf-8")
+    return embedding_store.encode_binary(records, fmt)
+
+
+def decode(data, fmt):
+    if fmt == "jsonl":
+        lines = data.decode("utf-8").splitlines()
+        return np.asarray([json.loads(line)["embedding"] for line in lines], dtype=np.float32)
+    _, _, values, scales = embedding_store.decode_binary(data)
+    return embedding_store.dequantize(values, scales)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("uri", nargs="?", help="gs://bucket/prefix holding embedding artifacts")
+    source.add_argument("--synthetic", type=int, help="use this many random unit vectors instead")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--project", default="videosearch-cloudspace")
+    args = parser.parse_args()
+
+    records = synthetic_records(args.synthetic) if args.synthetic is not None else load_records(args.uri, args.project)
+    if not records:
+        parser.error("no embeddings found")
+    vectors = np.asarray([record["embedding"] for record in records], dtype=np.float32)
+    queries = vectors[np.random.default_rng(1).choice(len(vectors), min(args.queries, len(vectors)), replace=False)]
+    print(f"{len(records)} vectors of dim {vectors.shape[1]}, {len(queries)} queries, recall@{args.k} vs float32")
+
+    for fmt in FORMATS:
+        data = encode(records, fmt)
+        start = time.time()
+        decoded = decode(data, fmt)
+        elapsed = time.time() - start
+        recall = embedding_store.recall_at_k(vectors, decoded, queries, k=args.k)
+        print(f"{fmt:>8}: {len(data) / 1e6:8.2f} MB, {len(data) / len(records):8.0f} B/vector, "
+              f"decode {elapsed * 1000:7.1f} ms, recall {recall:.4f}")
+
+
+if __name__ == "__main__":
+    main()
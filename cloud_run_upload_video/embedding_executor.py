@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Predict calls in flight per video, and across every video on this instance
+PREDICT_CONCURRENCY = int(os.environ.get("PREDICT_CONCURRENCY", 4))
+PREDICT_INSTANCE_CONCURRENCY = int(
+    os.environ.get("PREDICT_INSTANCE_CONCURRENCY", 8))
+# Match this to the project's multimodalembedding quota (requests per minute)
+PREDICT_QPM = float(os.environ.get("PREDICT_QPM", 120))
+
+
+class TokenBucket:
+    """Token bucket rate limiter: rate_per_minute sustained, bursts up to capacity."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_sec = rate_per_minute / 60
+        self.capacity = capacity or max(1, self.rate_per_sec)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate_per_sec)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate_per_sec
+            time.sleep(wait)
+
+
+# Shared by every video processed on this instance. Taken per attempt by resilience.predict_endpoint,
+# so retries count against the quota too.
+predict_rate_limiter = TokenBucket(PREDICT_QPM)
+
+
+class EmbeddingExecutor:
+    """Keeps up to concurrency predict calls in flight for one video.
+
+    The instance-wide limits (PREDICT_INSTANCE_CONCURRENCY, shrunk on 429, and
+    the shared rate limiter) are applied to every attempt by
+    resilience.predict_endpoint, so concurrent videos on one instance stay
+    within the quota together. map() yields results in input order so
+    datapoint IDs stay deterministic.
+    """
+
+    def __init__(self, concurrency=PREDICT_CONCURRENCY):
+        self._executor = ThreadPoolExecutor(max_workers=concurrency,
+                                            thread_name_prefix="predict")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def map(self, fn, items):
+        futures = [self.submit(fn, item) for item in items]
+        for future in futures:
+            yield future.result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,297 @@
+"""In-process stand-ins for GCS and the Vertex AI endpoints, for running the ingest path offline.
+
+FakeStorageClient keeps objects as files under a local directory and
+FakeVertex answers predict, upsertDatapoints and batch index updates the way
+http_client would.
+Both take a FakeLatency for latency, bandwidth and error injection.
+"""
+import collections
+import json
+import math
+import os
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core.exceptions import NotFound, PreconditionFailed, ServiceUnavailable
+
+import batch_index_writer
+import segmenter
+
+
+class FakeLatency:
+    """Latency, bandwidth, per-minute quota and error injection shared by the fakes."""
+
+    def __init__(self, latency_ms=0, mbps=0, error_rate=0, seed=0, qpm=0):
+        self.latency_sec = latency_ms / 1000
+        self.bytes_per_sec = mbps * 1e6 / 8 if mbps else 0
+        self.error_rate = error_rate
+        self.qpm = qpm
+        self._calls = collections.deque()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self, nbytes=0):
+        delay = self.latency_sec
+        if self.bytes_per_sec:
+            delay += nbytes / self.bytes_per_sec
+        if delay:
+            time.sleep(delay)
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def retry_after(self):
+        """Seconds until the quota has room again, or None when this call is admitted."""
+        if not self.qpm:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            while self._calls and self._calls[0] <= now - 60:
+                self._calls.popleft()
+            if len(self._calls) >= self.qpm:
+                return self._calls[0] + 60 - now
+            self._calls.append(now)
+            return None
+
+
+class FakeBlob:
+    """Just enough of storage.Blob for the ingest path. Objects are files under the fake bucket's directory.
+
+    Writes and deletes honour if_generation_match like GCS does.
+    """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.size = None
+        self.generation = None
+        self.crc32c = None
+        self.md5_hash = None
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.dir, self.name.replace("/", "%2F"))
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def reload(self):
+        if not self.exists():
+            raise NotFound(f"gs://{self.bucket.name}/{self.name}")
+        self.size = os.path.getsize(self.path)
+        self.generation = self.bucket.generations.get(self.name, 1)
+
+    def _maybe_fail(self, nbytes=0):
+        self.bucket.client.gcs.wait(nbytes)
+        if self.bucket.client.gcs.should_fail():
+            raise ServiceUnavailable(f"injected error on gs://{self.bucket.name}/{self.name}")
+
+    def _written(self):
+        self.bucket.generations[self.name] = self.bucket.generations.get(self.name, 0) + 1
+        self.reload()
+
+    def _check_generation(self, if_generation_match):
+        # Caller holds the bucket lock. 0 means the object must not exist yet, like GCS.
+        if if_generation_match is None:
+            return
+        current = self.bucket.generations.get(self.name, 1) if self.exists() else 0
+        if current != if_generation_match:
+            raise PreconditionFailed(
+                f"gs://{self.bucket.name}/{self.name} is at generation {current}, not {if_generation_match}")
+
+    def upload_from_filename(self, filename, if_generation_match=None, **kwargs):
+        self._maybe_fail(os.path.getsize(filename))
+        with self.bucket.lock:
+            self._check_generation(if_generation_match)
+            shutil.copyfile(filename, self.path)
+            self._written()
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._maybe_fail(len(data))
+        with self.bucket.lock:
+            self._check_generation(if_generation_match)
+            with open(self.path, "wb") as file_obj:
+                file_obj.write(data)
+            self._written()
+
+    def download_as_bytes(self, start=None, end=None, checksum="md5", **kwargs):
+        self.reload()
+        start = start or 0
+        end = self.size - 1 if end is None else min(end, self.size - 1)
+        self._maybe_fail(end - start + 1)
+        with open(self.path, "rb") as file_obj:
+            file_obj.seek(start)
+            return file_obj.read(end - start + 1)
+
+    def download_as_text(self, **kwargs):
+        return self.download_as_bytes().decode("utf-8")
+
+    def download_to_filename(self, filename, **kwargs):
+        with open(filename, "wb") as file_obj:
+            file_obj.write(self.download_as_bytes())
+
+    def delete(self, if_generation_match=None, **kwargs):
+        self._maybe_fail()
+        with self.bucket.lock:
+            self._check_generation(if_generation_match)
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                raise NotFound(f"gs://{self.bucket.name}/{self.name}")
+
+    def rewrite(self, source, token=None, **kwargs):
+        # Server-side: latency only, no bandwidth
+        source.reload()
+        self.bucket.client.gcs.wait()
+        shutil.copyfile(source.path, self.path)
+        self._written()
+        return None, self.size, self.size
+
+
+class FakeBucket:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.dir = os.path.join(client.root, name)
+        self.generations = {}
+        # Makes a generation precondition check and the write it guards atomic
+        self.lock = threading.RLock()
+        os.makedirs(self.dir, exist_ok=True)
+
+    def blob(self, name, **kwargs):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name, **kwargs):
+        blob = self.blob(name)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob
+
+    def list_blobs(self, prefix="", **kwargs):
+        for filename in sorted(os.listdir(self.dir)):
+            name = filename.replace("%2F", "/")
+            if name.startswith(prefix):
+                yield self.get_blob(name)
+
+
+class FakeStorageClient:
+    """In-process stand-in for storage.Client. Every client shares one root, so cross-project rewrites work."""
+
+    root = None  # local directory holding the buckets, set before use
+    gcs = FakeLatency()
+    _buckets = {}
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def bucket(self, name):
+        if name not in self._buckets:
+            self._buckets[name] = FakeBucket(self, name)
+        return self._buckets[name]
+
+    def list_blobs(self, bucket_name, prefix="", **kwargs):
+        return self.bucket(bucket_name).list_blobs(prefix=prefix)
+
+    def download_blob_to_file(self, uri, file_obj):
+        bucket_name, name = uri[len("gs://"):].split("/", 1)
+        file_obj.write(self.bucket(bucket_name).blob(name).download_as_bytes())
+
+
+class FakeTransferManager:
+    """transfer_manager.upload_many_from_filenames on a thread pool, against the fake buckets."""
+
+    @staticmethod
+    def upload_many_from_filenames(bucket, filenames, source_directory="", blob_name_prefix="", threads=4, **kwargs):
+
+        def upload(filename):
+            try:
+                bucket.blob(blob_name_prefix + filename).upload_from_filename(os.path.join(source_directory, filename))
+            except Exception as e:
+                return e
+            return None
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return list(executor.map(upload, filenames))
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, body, headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode("utf-8")
+        self.text = self.content.decode("utf-8")
+        self.headers = headers or {}
+        self.ok = status_code < 400
+        self.reason = "OK" if self.ok else "Service Unavailable"
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeVertex:
+    """Stands in for http_client: answers predict from the part's real duration, accepts upserts and batch index updates."""
+
+    def __init__(self, storage_client, predict, upsert, dimension=1408, update=None):
+        self.storage_client = storage_client
+        self.latency = {"predict": predict, "upsert": upsert, "update": update or FakeLatency()}
+        self.dimension = dimension
+        self.upserted = 0
+        self.index_updates = 0
+        self._lock = threading.Lock()
+
+    def patch(self, endpoint, url, json=None, headers=None, data=None):
+        """Batch index update: loads the staged files right away and returns a finished operation."""
+        latency = self.latency[endpoint]
+        latency.wait()
+        if latency.should_fail():
+            return FakeResponse(503, {"error": {"code": 503, "message": "injected"}})
+        datapoints = list(batch_index_writer.read_staged_datapoints(
+            self.storage_client, json["metadata"]["contentsDeltaUri"]))
+        with self._lock:
+            self.upserted += len(datapoints)
+            self.index_updates += 1
+            operation = f"{url.split('/v1/', 1)[1]}/operations/{self.index_updates}"
+        return FakeResponse(200, {"name": operation, "metadata": {"datapoints": len(datapoints)}})
+
+    def get(self, endpoint, url, headers=None):
+        return FakeResponse(200, {"name": url.split("/v1/", 1)[1], "done": True})
+
+    def post(self, endpoint, url, json=None, headers=None, data=None):
+        latency = self.latency[endpoint]
+        retry_after = latency.retry_after()
+        if retry_after is not None:
+            return FakeResponse(429, {"error": {"code": 429, "message": "quota exceeded"}},
+                                {"Retry-After": str(math.ceil(retry_after))})
+        latency.wait()
+        if latency.should_fail():
+            return FakeResponse(503, {"error": {"code": 503, "message": "injected"}})
+        if endpoint == "upsert":
+            with self._lock:
+                self.upserted += len(json["datapoints"])
+            return FakeResponse(200, {})
+
+        video = json["instances"][0]["video"]
+        bucket_name, name = video["gcsUri"][len("gs://"):].split("/", 1)
+        config = video["videoSegmentConfig"]
+        interval = config["intervalSec"]
+        duration = segmenter.probe_duration(self.storage_client.bucket(bucket_name).blob(name).path) or 0
+        duration = min(duration, config.get("endOffsetSec", duration))
+        embeddings = []
+        start = config.get("startOffsetSec", 0)
+        while start < duration:
+            end = min(start + interval, duration)
+            embeddings.append({
+                "startOffsetSec": start,
+                "endOffsetSec": end,
+                "embedding": [random.random() for _ in range(self.dimension)]
+            })
+            start = end
+        return FakeResponse(200, {"predictions": [{"videoEmbeddings": embeddings}]})
@@ -0,0 +1,10 @@
+# Loaded by gunicorn from the working directory (see Dockerfile)
+
+
+def post_fork(server, worker):
+    """Starts the ingest queue workers in each gunicorn worker.
+
+    main doesn't start them at import, since the spawned encode pool processes import it too.
+    """
+    import main
+    main.ingest_queue.start()
@@ -0,0 +1,113 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Set VERTEX_HTTP2=1 to use HTTP/2 (needs `pip install httpx[http2]`)
+HTTP2 = os.environ.get("VERTEX_HTTP2", "0") == "1"
+
+# Each endpoint gets its own keep-alive pool so slow calls (predict) can't starve
+# the many small ones (upsert). timeout is (connect, read) in seconds.
+ENDPOINTS = {
+    "predict": {
+        "timeout": (10, 300),
+        "pool_size": int(os.environ.get("PREDICT_POOL_SIZE", 16))
+    },
+    "upsert": {
+        "timeout": (10, 60),
+        "pool_size": int(os.environ.get("UPSERT_POOL_SIZE", 16))
+    },
+    "remove": {
+        "timeout": (10, 60),
+        "pool_size": 4
+    },
+    "update": {
+        "timeout": (10, 60),
+        "pool_size": 2
+    },
+    "upload": {
+        "timeout": (10, 600),
+        "pool_size": 4
+    },
+    "default": {
+        "timeout": (10, 60),
+        "pool_size": 10
+    },
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _new_session(pool_size):
+    if HTTP2:
+        import httpx
+
+        return httpx.Client(http2=True,
+                            limits=httpx.Limits(
+                                max_connections=pool_size,
+                                max_keepalive_connections=pool_size))
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=pool_size,
+                          pool_block=False)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(endpoint="default"):
+    """Returns the shared keep-alive session for this endpoint."""
+    with _sessions_lock:
+        if endpoint not in _sessions:
+            _sessions[endpoint] = _new_session(
+                ENDPOINTS[endpoint]["pool_size"])
+        return _sessions[endpoint]
+
+
+def request(method, endpoint, url, data=None, json=None, headers=None):
+    """Sends a request over the endpoint's pooled session with its timeout.
+
+    Returns a requests.Response, or an httpx.Response (with .reason set) when
+    HTTP2 is enabled.
+    """
+    session = get_session(endpoint)
+    connect_timeout, read_timeout = ENDPOINTS[endpoint]["timeout"]
+
+    if HTTP2:
+        import httpx
+
+        response = session.request(method,
+                                   url,
+                                   content=data,
+                                   json=json,
+                                   headers=headers,
+                                   timeout=httpx.Timeout(
+                                       read_timeout, connect=connect_timeout))
+        response.reason = response.reason_phrase
+        return response
+
+    return session.request(method,
+                           url,
+                           data=data,
+                           json=json,
+                           headers=headers,
+                           timeout=(connect_timeout, read_timeout))
+
+
+def post(endpoint, url, **kwargs):
+    return request("POST", endpoint, url, **kwargs)
+
+
+def put(endpoint, url, **kwargs):
+    return request("PUT", endpoint, url, **kwargs)
+
+
+def patch(endpoint, url, **kwargs):
+    return request("PATCH", endpoint, url, **kwargs)
+
+
+def get(endpoint, url, **kwargs):
+    return request("GET", endpoint, url, **kwargs)
@@ -0,0 +1,209 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+# Put this on a mounted volume to keep jobs across instances, /tmp only survives
+# process restarts within the same instance.
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", "/tmp/ingest_jobs.sqlite3")
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 2))
+# index() answers 429 above this many queued jobs so Eventarc backs off and retries
+JOB_QUEUE_MAX_PENDING = int(os.environ.get("JOB_QUEUE_MAX_PENDING", 100))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+# A failed job waits JOB_RETRY_BACKOFF_SEC before its second attempt, twice as long before its third and so on
+# (at most JOB_RETRY_BACKOFF_MAX_SEC), so a dependency that is down or busy isn't hit again right away
+JOB_RETRY_BACKOFF_SEC = float(os.environ.get("JOB_RETRY_BACKOFF_SEC", 30))
+JOB_RETRY_BACKOFF_MAX_SEC = float(os.environ.get("JOB_RETRY_BACKOFF_MAX_SEC", 900))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler when the job would fail the same way on every attempt. It isn't retried."""
+
+
+class SQLiteJobBackend:
+    """Job storage in a local SQLite file.
+
+    Any object with the same methods (enqueue, claim, complete, fail, recover,
+    counts) can be passed to JobQueue as a backend instead.
+    """
+
+    def __init__(self, path=JOB_QUEUE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path,
+                                     check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL DEFAULT 0
+            )""")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "next_attempt_at" not in columns:
+            # Queue file of an earlier version
+            self._conn.execute(
+                "ALTER TABLE jobs ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)")
+
+    def enqueue(self, job_id, payload):
+        """Adds a job, or requeues it if it had failed. Returns False if it is already known otherwise."""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                """INSERT INTO jobs (job_id, payload, state, created_at, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (job_id) DO UPDATE SET state = excluded.state, attempts = 0, updated_at = excluded.updated_at,
+                next_attempt_at = 0
+                WHERE jobs.state = ?""",
+                (job_id, json.dumps(payload), QUEUED, now, now, FAILED))
+            return cursor.rowcount == 1
+
+    def claim(self):
+        """Marks the oldest queued job that is due as running and returns (job_id, payload, attempts), or None."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "SELECT job_id, payload, attempts FROM jobs WHERE state = ? AND next_attempt_at <= ? ORDER BY created_at LIMIT 1",
+                (QUEUED, time.time())).fetchone()
+            if row is None:
+                self._conn.execute("COMMIT")
+                return None
+            job_id, payload, attempts = row
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, attempts = ?, updated_at = ? WHERE job_id = ?",
+                (RUNNING, attempts + 1, time.time(), job_id))
+            self._conn.execute("COMMIT")
+            return job_id, json.loads(payload), attempts + 1
+
+    def complete(self, job_id):
+        self._set_state(job_id, DONE, None)
+
+    def fail(self, job_id, error, retry, delay_sec=0):
+        """Requeues the job to be claimed again in delay_sec if retry, else marks it failed."""
+        if not retry:
+            self._set_state(job_id, FAILED, error)
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, updated_at = ?, next_attempt_at = ? WHERE job_id = ?",
+                (QUEUED, error, now, now + delay_sec, job_id))
+
+    def recover(self):
+        """Requeues jobs left running by a previous process. Returns how many."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET state = ?, updated_at = ? WHERE state = ?",
+                (QUEUED, time.time(), RUNNING))
+            return cursor.rowcount
+
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return dict(rows)
+
+    def _set_state(self, job_id, state, error):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE job_id = ?",
+                (state, error, time.time(), job_id))
+
+
+class JobQueue:
+    """Fixed pool of worker threads draining a durable job backend.
+
+    submit() only records the job, so the request handler can acknowledge the
+    event right away. Jobs that raise are retried up to max_attempts times,
+    with exponential backoff between attempts.
+
+    Args:
+        handler: called as handler(**payload) for each job.
+        backend: defaults to SQLiteJobBackend().
+        workers: number of worker threads.
+        max_pending: submit() refuses new jobs above this many queued jobs.
+        max_attempts: attempts before a job is marked failed.
+        retry_backoff_sec: delay before the second attempt, doubled for each further one.
+        retry_backoff_max_sec: longest delay between attempts.
+        poll_sec: how often idle workers look for jobs that have become due.
+    """
+
+    def __init__(self,
+                 handler,
+                 backend=None,
+                 workers=INGEST_WORKERS,
+                 max_pending=JOB_QUEUE_MAX_PENDING,
+                 max_attempts=JOB_MAX_ATTEMPTS,
+                 retry_backoff_sec=JOB_RETRY_BACKOFF_SEC,
+                 retry_backoff_max_sec=JOB_RETRY_BACKOFF_MAX_SEC,
+                 poll_sec=5):
+        self.handler = handler
+        self.backend = backend or SQLiteJobBackend()
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retry_backoff_sec = retry_backoff_sec
+        self.retry_backoff_max_sec = retry_backoff_max_sec
+        self.poll_sec = poll_sec
+        self._wakeup = threading.Event()
+        self._threads = []
+
+    def start(self):
+        recovered = self.backend.recover()
+        if recovered:
+            print(f"Recovered {recovered} interrupted jobs")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name=f"ingest-worker-{i}",
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, job_id, payload):
+        """Returns "queued", "duplicate" (already known) or "full" (backpressure)."""
+        if self.backend.counts().get(QUEUED, 0) >= self.max_pending:
+            return "full"
+        if not self.backend.enqueue(job_id, payload):
+            return "duplicate"
+        self._wakeup.set()
+        return "queued"
+
+    def counts(self):
+        return self.backend.counts()
+
+    def _work(self):
+        while True:
+            job = self.backend.claim()
+            if job is None:
+                self._wakeup.wait(timeout=self.poll_sec)
+                self._wakeup.clear()
+                continue
+
+            job_id, payload, attempts = job
+            print(f"Starting job {job_id} (attempt {attempts})")
+            try:
+                self.handler(**payload)
+            except Exception as e:
+                error = traceback.format_exc()
+                retry = attempts < self.max_attempts and not isinstance(
+                    e, PermanentJobError)
+                delay_sec = min(self.retry_backoff_sec * 2**(attempts - 1),
+                                self.retry_backoff_max_sec)
+                print(f"Job {job_id} failed (retry={retry}, in {delay_sec}s): {error}")
+                self.backend.fail(job_id, error, retry, delay_sec)
+            else:
+                print(f"Job {job_id} done")
+                self.backend.complete(job_id)
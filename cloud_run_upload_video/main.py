@@ -5,97 +5,208 @@ from google.protobuf import struct_pb2
 from moviepy.editor import *
 from google.cloud.storage import transfer_manager
 from flask import Flask
+from flask import Response
 from flask import request
 
 from cloudevents.http import from_http
 
-import threading
-import requests
+import os
 import json
 import google.auth.transport.requests
 import math
+import urllib.parse
+import batch_index_writer
+import change_detector
+import credentials_cache
+import embedding_store
+import http_client
+import ingest_ledger
+import memory_monitor
+import metrics
+import mp4_index
+import pipeline
+import progress_manifest
+import resilience
+import scratch
+import segmenter
+import sliced_download
+from ingest_ledger import IngestLedger
+from job_queue import JobQueue, PermanentJobError
+from progress_manifest import ProgressManifest
+from replicator import PartReplicator, rewrite_blob
+from scratch import ScratchWorkspace
+from sliced_download import SlicedDownload
+from embedding_executor import EmbeddingExecutor, PREDICT_CONCURRENCY
+from batch_index_writer import BatchIndexWriter
+from upsert_writer import BatchUpsertWriter
 
 app = Flask(__name__)
 
 storage_client = storage.Client(project="videosearch-cloudspace")
 storage_client_2 = storage.Client(project="geminipro-15") # need to upload to different project so Gemini 1.5 can access objects
+ledger = IngestLedger(storage_client.bucket(ingest_ledger.LEDGER_BUCKET_NAME))
+# Datapoints that still failed to upsert after retries, next to the ledger entries
+dead_letters = resilience.DeadLetterStore(storage_client.bucket(ingest_ledger.LEDGER_BUCKET_NAME))
 
 # change these
 PROJECT_NAME="videosearch-cloudspace"
 REGION="us-central1"
+# Vertex AI REST base URL. Point it at vertex_emulator.py (e.g. http://localhost:8085) to run without the real APIs
+VERTEX_API_BASE=os.environ.get("VERTEX_API_BASE", f"https://{REGION}-aiplatform.googleapis.com")
 INDEX_ID="7673540028760326144"
+PARTS_BUCKET_NAME="videosearch_video_source_parts"
+GEMINI_PARTS_BUCKET_NAME="geminipro-15-video-source-parts"
+# Buckets (in the storage_client_2 project) that get a server-side copy of every part, comma separated
+REPLICA_BUCKET_NAMES=os.environ.get("REPLICA_BUCKET_NAMES", GEMINI_PARTS_BUCKET_NAME).split(",")
+OUTPUT_BUCKET_NAME="videosearch_embeddings"
+# Parts are named "{video}/tmp/part-N.mp4" in the buckets, whatever their local scratch path is
+PART_NAME_TEMPLATE="/tmp/part-%d.mp4"
 
-def getToken():
-    creds, project = google.auth.default()
-    auth_req = google.auth.transport.requests.Request()
-    creds.refresh(auth_req)
-    return creds.token
-
-def upsertDataPoint(datapoint_id, datapoint_content):
+# "streaming" overlaps split/upload/embed per part, "phased" runs each stage over every part in turn
+PIPELINE_MODE=os.environ.get("PIPELINE_MODE", "streaming")
+PIPELINE_QUEUE_SIZE=int(os.environ.get("PIPELINE_QUEUE_SIZE", 2))
 
-    type_datapointcontent = type(datapoint_content)
-    type_datapointid = type(datapoint_id)
+# Videos up to this long fit in a single multimodalembedding request, so they skip splitting entirely
+SHORT_VIDEO_MAX_SEC=float(os.environ.get("SHORT_VIDEO_MAX_SEC", segmenter.MAX_SEGMENT_SEC))
 
-    print(f"datapoint id: {datapoint_id}, type: {type_datapointid}")
-    print(f"datapoint content: {datapoint_content[0]}, type: {type_datapointcontent}")
+# "copy" cuts parts on keyframes without re-encoding, "reencode" re-encodes every part with moviepy
+SEGMENT_MODE=os.environ.get("SEGMENT_MODE", "copy")
 
-    token = getToken()
+def getToken():
+    # Cached, only refreshed when close to expiry
+    return credentials_cache.get_token()
 
-    response = requests.post(f"https://{REGION}-aiplatform.googleapis.com/v1/projects/{PROJECT_NAME}/locations/{REGION}/indexes/{INDEX_ID}:upsertDatapoints",
-        headers = {
-            "Authorization": f"Bearer {token}"
-        },
-        json = {
-            "datapoints": [
-                {
-                    "datapointId": datapoint_id,
-                    "featureVector": datapoint_content
-                }
-            ]
-        })
+def upsertDataPoints(datapoints):
+    """Upserts a list of {"datapointId", "featureVector"} dicts in one request. Used by BatchUpsertWriter.
 
-    print(response.json())
+    429 and 5xx are retried (see resilience). Raises RetriesExhausted when they persist.
+    """
 
+    print(f"Upserting {len(datapoints)} datapoints, first id: {datapoints[0]['datapointId']}")
+
+    def send():
+        with metrics.span("upsert", datapoints = len(datapoints)) as tags:
+            response = http_client.post("upsert", f"{VERTEX_API_BASE}/v1/projects/{PROJECT_NAME}/locations/{REGION}/indexes/{INDEX_ID}:upsertDatapoints",
+                headers = {
+                    "Authorization": f"Bearer {getToken()}"
+                },
+                json = {
+                    "datapoints": datapoints
+                })
+            tags["status_code"] = response.status_code
+        return response
+
+    response = resilience.upsert_endpoint.call(send)
     if response.status_code == 200:
-        return "success"
-    else:
-        return "error"
+        metrics.inc("ingest_upsert_datapoints_total", len(datapoints))
 
-def split_video_by_duration(
-        video,
-        seconds_per_part = 120,
-        output_filepath_template = "/tmp/part-%d.mp4"):
+    print(response.json())
 
-     # Calculate the duration of the video in seconds
-    duration = int(video.duration)
+    return response
+
+def updateIndex(contents_delta_uri):
+    """Starts a batch update of the index from the datapoint files under contents_delta_uri. Returns the operation name."""
+
+    def send():
+        with metrics.span("index_update") as tags:
+            response = http_client.patch("update", f"{VERTEX_API_BASE}/v1/projects/{PROJECT_NAME}/locations/{REGION}/indexes/{INDEX_ID}",
+                headers = {
+                    "Authorization": f"Bearer {getToken()}"
+                },
+                json = {
+                    "metadata": {
+                        "contentsDeltaUri": contents_delta_uri,
+                        "isCompleteOverwrite": False
+                    }
+                })
+            tags["status_code"] = response.status_code
+        return response
+
+    # Only one update runs on an index at a time: BatchIndexWriter waits for the one in progress and tries again
+    response = resilience.update_endpoint.call(send)
+    if batch_index_writer.is_update_conflict(response):
+        raise batch_index_writer.IndexUpdateInProgress(response.text)
+    if response.status_code != 200:
+        raise RuntimeError(f"Index update from {contents_delta_uri} failed: {response.status_code} {response.text}")
+
+    return response.json()["name"]
+
+def getOperation(operation_name):
+    """Returns the long-running operation (e.g. of updateIndex) as a dict, "done" is set once it has finished."""
+    response = http_client.get("default", f"{VERTEX_API_BASE}/v1/{operation_name}",
+        headers = {
+            "Authorization": f"Bearer {getToken()}"
+        })
+    if response.status_code != 200:
+        raise RuntimeError(f"Could not get operation {operation_name}: {response.status_code} {response.text}")
+    return response.json()
 
-    # print(f"Video Length: {duration}")
+def check_index_writer(upsert_writer):
+    """Raises once the writer is closed if some datapoints were not upserted (or their batch index update was rejected).
 
-    # Calculate the number of parts the video will be split into
-    parts = math.ceil(duration / seconds_per_part)
+    The job then fails instead of being marked done, and its retry (JobQueue, Eventarc redelivery) loads them again.
+    """
+    if upsert_writer.failed:
+        raise RuntimeError(f"{len(upsert_writer.failed)} datapoints failed to upsert")
 
-    # Split and export the video
-    output_filepaths = []
-    for part in range(parts):
-        # Calculate start and end times for the current part
-        start_time = part * 60
-        end_time = (part + 1) * 60
+def new_index_writer(stripped_input_video_name, duration, generation = None):
+    """Streaming upserts for most videos, a batch index update from GCS for long ones (see batch_index_writer).
 
-        # Ensure end time does not exceed video duration
-        end_time = min(end_time, duration)
+    The files are staged under the source generation, so a retried job reuses the staging directory.
+    """
+    if batch_index_writer.use_batch_update(duration):
+        directory, file_prefix = batch_index_writer.staging_location(stripped_input_video_name, generation)
+        return BatchIndexWriter(
+            storage_client.bucket(batch_index_writer.BATCH_STAGING_BUCKET_NAME),
+            directory,
+            file_prefix = file_prefix,
+            update_fn = None if batch_index_writer.BATCH_UPDATE_DEFERRED else updateIndex
+            )
+    return BatchUpsertWriter(upsertDataPoints, dead_letter = dead_letter(stripped_input_video_name))
 
-        # Clip the video for the current part
-        current_part = video.subclip(start_time, end_time)
+def dead_letter(stripped_input_video_name):
+    """BatchUpsertWriter dead_letter callback: keeps the datapoints that failed for POST /dead_letters/replay."""
+    return lambda datapoints, errors: dead_letters.put(stripped_input_video_name, datapoints, errors)
 
-        # Export the current part
-        output_filepath = output_filepath_template % part
-        current_part.write_videofile(
-            output_filepath,
-            audio = True # set this to True if you have audio files
+def split_video_by_duration(
+        video,
+        seconds_per_part = segmenter.MAX_SEGMENT_SEC,
+        output_filepath_template = "/tmp/part-%d.mp4",
+        mode = SEGMENT_MODE):
+
+    if mode == "copy":
+        # Remux only. Parts that can't be cut on a keyframe are re-encoded individually.
+        return segmenter.split_video_stream_copy(
+            video.filename,
+            video.duration,
+            seconds_per_part = seconds_per_part,
+            output_filepath_template = output_filepath_template
             )
-        output_filepaths.append(output_filepath)
 
-    return output_filepaths
+    # Whole video covered, boundaries on the intervalSec grid, at most seconds_per_part each
+    cuts = [
+        (start_time, end_time) for start_time, end_time, _ in segmenter.plan_segments(
+            video.duration, max_segment_sec = seconds_per_part)
+    ]
+    output_filepaths = [output_filepath_template % part for part in range(len(cuts))]
+
+    # Export the parts, several at a time (capped by ENCODE_WORKERS / ENCODE_MEMORY_BUDGET_MB).
+    # Under a job memory budget ffmpeg encodes instead of moviepy, it streams the audio with the video
+    # instead of decoding it into Python, and the pool gets no more than the job's budget.
+    if memory_monitor.bounded():
+        return segmenter.encode_parts_parallel(
+            video.filename,
+            cuts,
+            output_filepaths,
+            encoder = segmenter.encode_part,
+            memory_budget_mb = min(segmenter.ENCODE_MEMORY_BUDGET_MB, memory_monitor.JOB_MEMORY_BUDGET_MB)
+            )
+    return segmenter.encode_parts_parallel(
+        video.filename,
+        cuts,
+        output_filepaths,
+        encoder = segmenter.encode_part_moviepy
+        )
 
 # Triggered by a change in a storage bucket
 @app.route("/", methods=["POST"])
@@ -119,124 +230,481 @@ def index():
     input_video_name = data["name"]
     stripped_input_video_name = input_video_name.replace(".mp4","")
 
-    # Need to thread because Eventarc expects a response in 10 seconds or else it sends the request again which results
-    # in infinite calls made to the cloud run process.
-    # However, currently the thread is processing very slow. I suspect the thread has a limit of memory allocated towards it
-    # TODO
-    # For now - 05/07 - will continue using Cloud Function
-    # I should split this into two cloud run instances. One to ACK and do an asnych call to a seperate Cloud run instance which processes the video.
-    thr = threading.Thread(target=process_video, args=(input_bucket_name, input_video_name, stripped_input_video_name))
-    thr.start()
+    # Eventarc redelivers events, so each object version (bucket, name, generation, checksum) is only ingested once
+    key = ingest_ledger.ledger_key(data)
+    if not ledger.claim(key):
+        return (f"Duplicate - {key}", 200)
+
+    # Eventarc expects a response in 10 seconds or else it sends the request again, so the job is only
+    # recorded here and acknowledged. A fixed pool of workers (INGEST_WORKERS) processes the queue.
+    status = ingest_queue.submit(key, {
+        "ledger_key": key,
+        "input_bucket_name": input_bucket_name,
+        "input_video_name": input_video_name,
+        "stripped_input_video_name": stripped_input_video_name
+    })
+    print(f"Job {key}: {status}")
+
+    if status == "full":
+        # Backpressure: Eventarc retries with backoff
+        ledger.release(key)
+        return (f"Ingest queue full - {input_bucket_name}", 429)
 
     return (f"Recieved - {input_bucket_name}", 200)
 
-def process_video(input_bucket_name, input_video_name, stripped_input_video_name):
-    destination_file = "/tmp/video.mp4"
-    parts_bucket_name = "videosearch_video_source_parts"
-    output_bucket_name = "videosearch_embeddings"
+@app.route("/jobs", methods=["GET"])
+def jobs():
+    """Job counts by state (queued, running, done, failed)."""
+    return ingest_queue.counts()
 
-    with open(f'{destination_file}','wb') as file_obj:
-        storage_client.download_blob_to_file(f'gs://{input_bucket_name}/{input_video_name}',file_obj)
+@app.route("/ledger", methods=["GET"])
+def ledger_stats():
+    """Claimed ingests and suppressed duplicate deliveries on this instance."""
+    return ledger.stats()
 
-    vid = VideoFileClip(destination_file)
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Per-stage timing histograms and byte counters in the Prometheus text format."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
-    # could upload directly in this function to save space.
-    # Tradeoff is I might encounter function timeout because all files would be uploaded individually
-    # TODO: make more efficient for videos shorter than 120 seconds
-    split_video_paths = split_video_by_duration(vid)
-
-    results = transfer_manager.upload_many_from_filenames(
-        bucket=storage_client.bucket(parts_bucket_name),
-        filenames=split_video_paths,
-        source_directory="",
-        blob_name_prefix=stripped_input_video_name
-    )
-
-    results_2 = transfer_manager.upload_many_from_filenames(
-        bucket=storage_client_2.bucket("geminipro-15-video-source-parts"),
-        filenames=split_video_paths,
-        source_directory="",
-        blob_name_prefix=stripped_input_video_name
-    )
+@app.route("/dead_letters", methods=["GET"])
+def dead_letters_stats():
+    """Dead-lettered upsert batches waiting for a replay."""
+    return {"batches": dead_letters.count()}
 
-    for name, result in zip(split_video_paths, results):
-        # The results list is either `None` or an exception for each filename in
-        # the input list, in order.
+@app.route("/dead_letters/replay", methods=["POST"])
+def dead_letters_replay():
+    """Upserts the dead-lettered datapoints again, optionally only those of ?video=<name without .mp4>."""
+    return dead_letters.replay(upsertDataPoints, request.args.get("video", ""))
 
-        if isinstance(result, Exception):
-            print("Failed to upload {} due to exception: {}".format(name, result))
-        else:
-            print("Uploaded {} to {}.".format(name, parts_bucket_name))
+def upload_part(part, stripped_input_video_name, local_path, replicator):
+    """Uploads one local part to the parts bucket, then deletes it from /tmp (which is RAM on Cloud Run).
 
-    for name, result in zip(split_video_paths, results_2):
-        # The results list is either `None` or an exception for each filename in
-        # the input list, in order.
+    The copies to the other buckets are made server-side by the replicator, in the background.
+    """
+    name = f"{stripped_input_video_name}{part}"
 
-        if isinstance(result, Exception):
-            print("Failed to upload {} due to exception: {}".format(name, result))
-        else:
-            print("Uploaded {} to {}.".format(name, "geminipro-15-video-source-parts"))
-
-    token = getToken()
-
-    # get embeddings
-    for part in split_video_paths:
-      name = f"{stripped_input_video_name}{part}"
-      print(f"Generating embeddings for part: gs://{name}")
-
-      response = requests.post(f"https://{REGION}-aiplatform.googleapis.com/v1/projects/{PROJECT_NAME}/locations/{REGION}/publishers/google/models/multimodalembedding@001:predict",
-          headers = {
-              "Authorization": f"Bearer {token}"
-          },
-          json = {
-              "instances": [
-                  {"video": {
-                      "gcsUri": f"gs://{parts_bucket_name}/{name}",
-                      "videoSegmentConfig": {
-                          "intervalSec": 5
+    with metrics.span("upload", bucket = PARTS_BUCKET_NAME, video = stripped_input_video_name, part = part, nbytes = os.path.getsize(local_path)):
+        storage_client.bucket(PARTS_BUCKET_NAME).blob(name).upload_from_filename(local_path)
+    print("Uploaded {} to {}.".format(part, PARTS_BUCKET_NAME))
+    replicator.submit(name)
+
+    os.remove(local_path)
+    return part
+
+def new_replicator():
+    # Gemini 1.5 reads the parts from a bucket in another project
+    return PartReplicator(
+        storage_client.bucket(PARTS_BUCKET_NAME),
+        [storage_client_2.bucket(bucket_name) for bucket_name in REPLICA_BUCKET_NAMES]
+        )
+
+def predict_part(part, stripped_input_video_name, static_plan = None):
+    """Calls the multimodal embedding API for one uploaded part and returns its video embeddings.
+
+    With a static_plan the call stops after the last window that will be kept, so only a static or repeated
+    run at the end of the part saves predict cost (ingest_predict_windows_trimmed_total). The windows of runs
+    before it are embedded all the same and dropped by store_part_embeddings (ingest_static_windows_skipped_total).
+    """
+    name = f"{stripped_input_video_name}{part}"
+    print(f"Generating embeddings for part: gs://{name}")
+
+    segment_config = {
+        "intervalSec": segmenter.INTERVAL_SEC
+    }
+    if static_plan is not None:
+        segment_config["startOffsetSec"] = 0
+        segment_config["endOffsetSec"] = static_plan.end_offset_sec()
+        metrics.inc("ingest_predict_windows_trimmed_total", static_plan.trimmed())
+
+    def send():
+        # Token fetched per attempt (from the cache) so long videos don't outlive it
+        with metrics.span("predict", video = stripped_input_video_name, part = part) as tags:
+            response = http_client.post("predict", f"{VERTEX_API_BASE}/v1/projects/{PROJECT_NAME}/locations/{REGION}/publishers/google/models/multimodalembedding@001:predict",
+                headers = {
+                    "Authorization": f"Bearer {getToken()}"
+                },
+                json = {
+                    "instances": [
+                        {"video": {
+                            "gcsUri": f"gs://{PARTS_BUCKET_NAME}/{name}",
+                            "videoSegmentConfig": segment_config
+                            }
                         }
-                      }
-                  }
-              ]
-          })
+                    ]
+                })
+            tags["nbytes"] = len(response.content)
+            tags["status_code"] = response.status_code
+        return response
+
+    # Retried on 429/5xx with backoff. If it still fails the job fails and is retried by the JobQueue,
+    # resuming from the progress manifest.
+    response = resilience.predict_endpoint.call(send)
+    if response.status_code != 200:
+        raise RuntimeError(f"Predict failed for gs://{PARTS_BUCKET_NAME}/{name}: {response.status_code} {response.text}")
+
+    print(response.json())
+
 
-      print(response.json())
+    return response.json()["predictions"][0]['videoEmbeddings']
 
+def store_part_embeddings(part, stripped_input_video_name, embeddings_list, upsert_writer, static_plan = None):
+    """Stores the embeddings of one part, queues them for upsert into Vector Search and returns their ids.
 
-      embeddings_list = response.json()["predictions"][0]['videoEmbeddings']
+    With a static_plan (see change_detector) only the first window of each static or repeated run is kept,
+    and its record spans the whole run.
+    """
+    name = f"{stripped_input_video_name}{part}"
 
-      # TODO: embeddings should be stored by timestamps
-      count = 0
-      for embedding_object in embeddings_list:
+    # Embeddings are stored with their timestamps, one artifact per part (see embedding_store)
+    records = []
+    count = 0
+    for embedding_object in embeddings_list:
         count+=1
         embedding = embedding_object['embedding']
+        start_sec = embedding_object.get('startOffsetSec')
+        end_sec = embedding_object.get('endOffsetSec')
+
+        if static_plan is not None:
+            # Ids stay numbered by window, the front-end derives the timestamp from them
+            window = count - 1 if start_sec is None else round(start_sec / segmenter.INTERVAL_SEC)
+            count = window + 1
+            if not static_plan.keeps(window):
+                continue
+            start_sec, end_sec = static_plan.span(window)
+
         id = f"{name}_{count}"
 
-        json_object = {
+        records.append({
             "id": f"{id}",
+            "start_sec": start_sec,
+            "end_sec": end_sec,
             "embedding": embedding
-        }
+        })
+
+        # Sent in batches, failures are reported when the writer is closed at the end of the video
+        upsert_writer.add(id, embedding)
 
-        # NOTE: doesn't not check for repeated uploads of same image. Would need to include some logic in order to avoid overwriting already uploaded images
-        # Vector Search does check for duplicates before upserting so it wouldn't affect the index performance wise. Although you would likely get charged for the bytes transfered.
+    # NOTE: doesn't not check for repeated uploads of same image. Would need to include some logic in order to avoid overwriting already uploaded images
+    # Vector Search does check for duplicates before upserting so it wouldn't affect the index performance wise. Although you would likely get charged for the bytes transfered.
+    artifact_name = embedding_store.write_part_embeddings(storage_client.bucket(OUTPUT_BUCKET_NAME), name, records)
+    print(f"Stored {len(records)} embeddings in gs://{OUTPUT_BUCKET_NAME}/{artifact_name}")
+    if static_plan is not None:
+        # Embedded by predict, but left out of the index
+        metrics.inc("ingest_static_windows_skipped_total", len(embeddings_list) - len(records))
 
-        output_bucket = storage_client.bucket(output_bucket_name)
+    return [record["id"] for record in records]
+
+def ingest_job(ledger_key, input_bucket_name, input_video_name, stripped_input_video_name, claimed = True):
+    """JobQueue handler: processes the video and records the outcome in the ingest ledger.
+
+    claimed = False is a forced re-ingest without a claim (backfill.py without --only-new): a failure then
+    leaves the ledger entry as it was instead of releasing a claim someone else may hold, or deleting a DONE marker.
+    """
+    try:
+        # Keeps the claim for as long as the job runs
+        with ledger.heartbeat(ledger_key):
+            process_video(input_bucket_name, input_video_name, stripped_input_video_name)
+    except Exception:
+        # Let a redelivery of the same object retry
+        if claimed:
+            ledger.release(ledger_key)
+        raise
+    # This run upserted (or staged) every datapoint, replaying what an earlier attempt dead-lettered would put stale vectors back
+    dead_letters.clear(stripped_input_video_name)
+    ledger.mark_done(ledger_key)
+
+def source_url(input_bucket_name, input_video_name):
+    return f"https://storage.googleapis.com/{input_bucket_name}/{urllib.parse.quote(input_video_name)}"
+
+def source_headers():
+    # Fetched per ffmpeg call, a long job outlives a token
+    return {"Authorization": f"Bearer {getToken()}"}
+
+def probe_source_duration(input_bucket_name, input_video_name):
+    """Reads the source duration from its header over HTTP, without downloading the video. None if unknown."""
+    try:
+        return segmenter.probe_duration(source_url(input_bucket_name, input_video_name), headers = source_headers())
+    except Exception as e:
+        print(f"Could not probe duration of {input_video_name}: {e}")
+        return None
+
+def process_short_video(source_blob, stripped_input_video_name, duration = None):
+    """Fast path for videos within SHORT_VIDEO_MAX_SEC: no download, split or re-encode.
+
+    The original object is copied server-side into the parts bucket under the usual part name and embedded with one predict call.
+    """
+    part = PART_NAME_TEMPLATE % 0
+    name = f"{stripped_input_video_name}{part}"
+
+    with metrics.span("upload", bucket = PARTS_BUCKET_NAME, video = stripped_input_video_name, part = part) as tags:
+        tags["nbytes"] = rewrite_blob(source_blob, storage_client.bucket(PARTS_BUCKET_NAME).blob(name))
+    print(f"Copied {source_blob.name} to gs://{PARTS_BUCKET_NAME}/{name}")
+
+    replicator = new_replicator()
+    replicator.submit(name)
+
+    with new_index_writer(stripped_input_video_name, duration, source_blob.generation) as upsert_writer:
+        store_part_embeddings(part, stripped_input_video_name, predict_part(part, stripped_input_video_name), upsert_writer)
+
+    replicator.close()
+    check_index_writer(upsert_writer)
+    return
 
-        new_blob = output_bucket.blob(f"{id}.json")
-        new_blob.upload_from_string(
-            data=json.dumps(json_object),
-            content_type='application/json'
+def process_video(input_bucket_name, input_video_name, stripped_input_video_name, mode = PIPELINE_MODE):
+    # Each job gets its own scratch directory (removed afterwards) so several videos can be processed
+    # side by side on one instance. Entering waits until the instance-wide scratch budget has room.
+    #
+    # The memory the job uses (its processes and scratch files) is sampled throughout and its peak
+    # reported at the end. Under a JOB_MEMORY_BUDGET_MB the streaming pipeline holds back new parts
+    # until there is room and never downloads the source, so memory doesn't grow with video length.
+    # Phased mode keeps the source and all of its parts on /tmp: it only starts once they fit in the
+    # budget. A job that can't stay within it fails (MemoryBudgetExceeded).
+    source_blob = storage_client.bucket(input_bucket_name).get_blob(input_video_name)
+
+    with memory_monitor.MemoryMonitor(stripped_input_video_name) as monitor:
+        duration = probe_source_duration(input_bucket_name, input_video_name)
+        if duration is not None and duration <= SHORT_VIDEO_MAX_SEC:
+            print(f"{input_video_name} is {duration}s long, using the short video fast path")
+            process_short_video(source_blob, stripped_input_video_name, duration)
+            return
+
+        # A source too large to download next to its parts is cut straight from GCS in streaming mode.
+        # Phased mode needs the local copy, and would only run out of scratch after the download, on every attempt.
+        fits = scratch.source_fits(source_blob.size)
+        if mode != "streaming" and not fits:
+            raise PermanentJobError(f"{input_video_name} ({source_blob.size} bytes) and its parts don't fit in "
+                                    f"JOB_SCRATCH_QUOTA_MB, use PIPELINE_MODE=streaming")
+        phased_bytes = source_blob.size * scratch.SCRATCH_RESERVE_FACTOR
+        if mode != "streaming" and memory_monitor.bounded() and phased_bytes > monitor.budget_bytes:
+            raise PermanentJobError(f"{input_video_name} ({source_blob.size} bytes) and its parts don't fit in "
+                                    f"JOB_MEMORY_BUDGET_MB, use PIPELINE_MODE=streaming")
+        remote_source = mode == "streaming" and (memory_monitor.bounded() or not fits)
+        with ScratchWorkspace(stripped_input_video_name, source_bytes = 0 if remote_source else source_blob.size) as workspace:
+            monitor.scratch_dir = workspace.dir
+            if mode == "streaming":
+                process_video_streaming(input_bucket_name, input_video_name, stripped_input_video_name, source_blob, workspace, monitor, remote_source)
+            else:
+                process_video_phased(source_blob, stripped_input_video_name, workspace, monitor)
+
+    print(f"Credential cache: {credentials_cache.stats()}")
+    return
+
+def process_video_phased(source_blob, stripped_input_video_name, workspace, monitor = None):
+    destination_file = workspace.path("video.mp4")
+
+    # Under a memory budget, wait for room for the source and its parts (they don't leave /tmp until the upload)
+    if monitor is not None:
+        monitor.wait_for_headroom(source_blob.size * scratch.SCRATCH_RESERVE_FACTOR)
+
+    # Concurrent ranged reads (DOWNLOAD_WORKERS x DOWNLOAD_CHUNK_MB) instead of a single stream
+    with metrics.span("download", video = stripped_input_video_name, nbytes = source_blob.size):
+        throughput = sliced_download.download(source_blob, destination_file)
+    print(f"Downloaded {source_blob.name} at {throughput / 1e6:.1f} MB/s")
+
+    # could upload directly in this function to save space.
+    # Tradeoff is I might encounter function timeout because all files would be uploaded individually
+    # Videos shorter than SHORT_VIDEO_MAX_SEC never get here (see process_short_video)
+    #
+    # The clip only supplies the path and duration, the parts are encoded by their own readers. Without
+    # audio it holds no audio buffer, and leaving the block stops its ffmpeg reader process.
+    with metrics.span("split", video = stripped_input_video_name) as tags, VideoFileClip(destination_file, audio = False) as vid:
+        duration = vid.duration
+        local_paths = split_video_by_duration(vid, output_filepath_template = workspace.path("part-%d.mp4"))
+        tags["nbytes"] = sum(os.path.getsize(path) for path in local_paths)
+    workspace.check_quota()
+    if monitor is not None:
+        monitor.check()
+    split_video_paths = [PART_NAME_TEMPLATE % part for part in range(len(local_paths))]
+
+    # Static and repeated stretches are found on the local parts, before they are uploaded
+    with metrics.span("analyze", video = stripped_input_video_name):
+        static_plans = {part: change_detector.analyze_part(path) for part, path in zip(split_video_paths, local_paths)}
+
+    # Blob names keep the "{video}/tmp/part-N.mp4" layout the front-end and delete path expect
+    with metrics.span("upload", bucket = PARTS_BUCKET_NAME, video = stripped_input_video_name, nbytes = tags["nbytes"]):
+        results = transfer_manager.upload_many_from_filenames(
+            bucket=storage_client.bucket(PARTS_BUCKET_NAME),
+            filenames=[os.path.basename(path) for path in local_paths],
+            source_directory=workspace.dir,
+            blob_name_prefix=f"{stripped_input_video_name}/tmp/"
         )
 
-        upsert_result = upsertDataPoint(id, embedding)
-        print(f"Upsert Result: {upsert_result}")
+    # The other buckets get server-side copies of the first upload, in the background while embedding runs
+    replicator = new_replicator()
+
+    for name, result in zip(split_video_paths, results):
+        # The results list is either `None` or an exception for each filename in
+        # the input list, in order.
 
-        if upsert_result == "success":
-            print(f"{id}.json complete")
+        if isinstance(result, Exception):
+            print("Failed to upload {} due to exception: {}".format(name, result))
         else:
-            print(f"{id}.json unsuccessful")
+            print("Uploaded {} to {}.".format(name, PARTS_BUCKET_NAME))
+            replicator.submit(f"{stripped_input_video_name}{name}")
+
+    # get embeddings, PREDICT_CONCURRENCY parts at a time. Results come back in part order.
+    with new_index_writer(stripped_input_video_name, duration, source_blob.generation) as upsert_writer, EmbeddingExecutor() as executor:
+        embeddings = executor.map(lambda part: predict_part(part, stripped_input_video_name, static_plans[part]), split_video_paths)
+        for part, embeddings_list in zip(split_video_paths, embeddings):
+            store_part_embeddings(part, stripped_input_video_name, embeddings_list, upsert_writer, static_plans[part])
 
+    replicator.close()
+    check_index_writer(upsert_writer)
     return
 
+def process_video_streaming(input_bucket_name, input_video_name, stripped_input_video_name, source_blob, workspace, monitor = None, remote_source = False):
+    # Each part is uploaded (and deleted locally) then embedded as soon as it is written,
+    # so only a few parts are ever on /tmp and the first predict call starts right away.
+    #
+    # With remote_source (a memory budget, or a source larger than the scratch quota) parts are cut
+    # straight from GCS with ranged reads instead of from a local copy of the source. With a memory
+    # budget each one also waits until the job is under it.
+    #
+    # Progress is checkpointed per part in a ProgressManifest. A rerun (JobQueue retry,
+    # Eventarc redelivery, recycled instance) skips every stage a part has already been through.
+    destination_file = workspace.path("video.mp4")
+    manifest = ProgressManifest(storage_client.bucket(OUTPUT_BUCKET_NAME), stripped_input_video_name, source_blob.generation)
+    if manifest.load():
+        print(f"Resuming {stripped_input_video_name}: {manifest.summary()} of {len(manifest.parts)} parts")
+
+    # The source is only needed if some part still has to be encoded. It is downloaded with concurrent
+    # ranged reads, and parts are cut from the head of the file while the tail is still arriving.
+    download = None
+    sample_index = None
+    try:
+        headers = None
+        if remote_source:
+            destination_file = source_url(input_bucket_name, input_video_name)
+            headers = source_headers
+            if not manifest.parts:
+                duration = segmenter.probe_duration(destination_file, headers = headers())
+                if duration is None:
+                    raise RuntimeError(f"Could not read the duration of {input_video_name} from its header")
+                cuts = segmenter.plan_video_parts(destination_file, duration, mode = SEGMENT_MODE, headers = headers())
+                manifest.set_plan([PART_NAME_TEMPLATE % part for part in range(len(cuts))], cuts)
+        elif not manifest.parts or manifest.pending(progress_manifest.UPLOADED):
+            download = SlicedDownload(source_blob, destination_file).start()
+
+            if not manifest.parts:
+                if SEGMENT_MODE == "copy":
+                    # The keyframe scan reads the whole file
+                    download.wait()
+                else:
+                    download.wait_for_index()
+                duration = segmenter.probe_duration(destination_file)
+                if duration is None:
+                    # Index not readable from the head/tail alone
+                    download.wait()
+                    duration = segmenter.probe_duration(destination_file)
+                cuts = segmenter.plan_video_parts(destination_file, duration, mode = SEGMENT_MODE)
+                manifest.set_plan([PART_NAME_TEMPLATE % part for part in range(len(cuts))], cuts)
+
+            # Where each cut's samples are in the file, so a part is written once its bytes have arrived.
+            # The file is preallocated: cutting before that would read zeros, not hit EOF.
+            if download.available_bytes < download.size:
+                sample_index = mp4_index.load(destination_file, download.size, download.wait_for_range)
+            if sample_index is None and download.available_bytes < download.size:
+                print(f"No sample index in {input_video_name}, splitting after the whole download")
+
+        static_plans = {}
+
+        def parts():
+            for part, cut in zip(list(manifest.parts), manifest.cuts):
+                if not manifest.done(part, progress_manifest.UPLOADED):
+                    if download is not None and sample_index is not None:
+                        # A second past the cut, since ffmpeg reads on until every stream is past it
+                        download.wait_for(sample_index.bytes_needed(cut[1] + 1))
+                    elif download is not None:
+                        download.wait()
+                    if monitor is not None:
+                        monitor.wait_for_headroom()
+                    with metrics.span("split", video = stripped_input_video_name, part = part) as tags:
+                        segmenter.write_video_part(destination_file, cut, workspace.local_path(part), headers = headers and headers())
+                        tags["nbytes"] = os.path.getsize(workspace.local_path(part))
+                    # Needs the local part, so it runs before the upload deletes it. A resumed part that
+                    # was uploaded by an earlier run has no plan and is embedded in full.
+                    with metrics.span("analyze", video = stripped_input_video_name, part = part):
+                        static_plans[part] = change_detector.analyze_part(workspace.local_path(part), cut[1] - cut[0])
+                    workspace.check_quota()
+                    manifest.mark(part, progress_manifest.ENCODED)
+                yield part
+            if download is not None:
+                throughput = download.wait()
+                print(f"Downloaded {source_blob.name} at {throughput / 1e6:.1f} MB/s")
+                # Overlaps the split, so it is recorded from the download's own clock
+                metrics.record("download", download.elapsed_sec, video = stripped_input_video_name, nbytes = source_blob.size)
+
+        def upload(part):
+            if not manifest.done(part, progress_manifest.UPLOADED):
+                upload_part(part, stripped_input_video_name, workspace.local_path(part), replicator)
+                manifest.mark(part, progress_manifest.UPLOADED)
+            return part
+
+        def predict(part):
+            if manifest.done(part, progress_manifest.EMBEDDED):
+                return (part, None)
+            return (part, executor.submit(predict_part, part, stripped_input_video_name, static_plans.get(part)))
+
+        def store(item):
+            part, future = item
+            # A deferred batch update (backfill) rebuilds the index from the staged files, so parts upserted
+            # by an earlier run are staged again from their stored embeddings
+            if manifest.done(part, progress_manifest.UPSERTED) and not batch_index_writer.BATCH_UPDATE_DEFERRED:
+                return (part, [])
+
+            if future is None:
+                # Embedded by an earlier run but not (fully) upserted: upsert the stored embeddings again
+                name = f"{stripped_input_video_name}{part}"
+                artifact = embedding_store.find_part_artifact(storage_client.bucket(OUTPUT_BUCKET_NAME), name)
+                records = embedding_store.read_part_embeddings(artifact)
+                for record in records:
+                    upsert_writer.add(record["id"], record["embedding"])
+                return (part, [record["id"] for record in records])
+
+            ids = store_part_embeddings(part, stripped_input_video_name, future.result(), upsert_writer, static_plans.get(part))
+            manifest.mark(part, progress_manifest.EMBEDDED)
+            return (part, ids)
+
+        # "predict" only submits the call, "store" waits for it in part order. The queue between them
+        # holds the in-flight calls, so up to PREDICT_CONCURRENCY parts are embedded at once.
+        # Copies to the other parts buckets run server-side in the background.
+        replicator = new_replicator()
+        with new_index_writer(stripped_input_video_name, manifest.cuts[-1][1], source_blob.generation) as upsert_writer, EmbeddingExecutor() as executor:
+            results = pipeline.run_pipeline(
+                parts(),
+                [
+                    ("upload", upload),
+                    ("predict", predict),
+                    ("store", store, PREDICT_CONCURRENCY),
+                ],
+                queue_size = PIPELINE_QUEUE_SIZE
+                )
+    finally:
+        if download is not None:
+            # Stops the ranged reads and closes the file if the job failed before the download finished
+            download.close()
+
+    replicator.close()
+
+    for part, ids in results:
+        if not any(id in upsert_writer.failed for id in ids):
+            manifest.mark(part, progress_manifest.UPSERTED)
+    # Updates since the last save (at most one a second). If the pipeline failed the manifest's timer saves them.
+    manifest.flush()
+
+    print(f"Progress for {stripped_input_video_name}: {manifest.summary()} of {len(manifest.parts)} parts")
+
+    # Fail the job so it is retried. The retry only re-upserts the parts with failed datapoints.
+    check_index_writer(upsert_writer)
+
+    return
+
+# Its workers are started by the server process (gunicorn.conf.py, or below), never at import: the spawned
+# encode pool processes import this module too and would each drain the queue.
+ingest_queue = JobQueue(ingest_job)
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0",port=int(os.environ.get("PORT", 8080)))
+    # Jobs left running by a previous process are requeued. No reloader: its watcher process would start a second queue.
+    ingest_queue.start()
+    app.run(debug=True, use_reloader=False, host="0.0.0.0",port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,206 @@
+import os
+import resource
+import threading
+import time
+
+import metrics
+
+# Memory one job may use: this process and its ffmpeg / encoder children, plus its scratch
+# files (/tmp is RAM on Cloud Run). 0 (the default) only reports the peak.
+JOB_MEMORY_BUDGET_MB = int(os.environ.get("JOB_MEMORY_BUDGET_MB", 0))
+MEMORY_SAMPLE_SEC = float(os.environ.get("MEMORY_SAMPLE_SEC", 0.5))
+# A job still over its budget after waiting this long fails (and is retried by the job queue),
+# so a budget set below the baseline can't stall it forever
+MEMORY_WAIT_TIMEOUT_SEC = float(os.environ.get("MEMORY_WAIT_TIMEOUT_SEC", 300))
+
+_PAGE_SIZE = resource.getpagesize()
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+def bounded():
+    """True when a JOB_MEMORY_BUDGET_MB is set (bounded-memory processing)."""
+    return JOB_MEMORY_BUDGET_MB > 0
+
+
+def process_rss_bytes(pid="self"):
+    """Proportional set size of pid: pages shared with other processes are split between them.
+
+    A child that was just forked (before it execs ffmpeg) shares all of its
+    parent's pages, plain RSS would count them twice. Falls back to RSS where
+    /proc/<pid>/smaps_rollup doesn't exist.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as smaps:
+            for line in smaps:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except (FileNotFoundError, ProcessLookupError, IndexError, ValueError):
+        return 0  # exited in the meantime
+
+
+def child_pids(pid):
+    """Direct children of pid, from /proc/<pid>/task/*/children."""
+    children = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except FileNotFoundError:
+        return children
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            pass
+    return children
+
+
+def command_line(pid):
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return f.read()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+
+
+def process_tree_rss_bytes(pid=None):
+    """RSS of pid (default: this process) and all of its descendants.
+
+    A child still running its parent's command line hasn't exec'd yet.
+    subprocess starts children with vfork, so until then it shares its
+    parent's whole address space and /proc reports the parent's memory a
+    second time. Such children are skipped.
+    """
+    pending = [(pid or os.getpid(), None)]
+    total = 0
+    while pending:
+        current, parent_command = pending.pop()
+        command = command_line(current)
+        if parent_command is not None and command == parent_command:
+            continue
+        total += process_rss_bytes(current)
+        pending.extend((child, command) for child in child_pids(current))
+    return total
+
+
+def directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.path.getsize(os.path.join(root, filename))
+            except FileNotFoundError:
+                pass  # deleted after upload in the meantime
+    return total
+
+
+class MemoryMonitor:
+    """Samples the memory used while one job runs and reports its peak when the job ends.
+
+    Usage is the memory of this process and its children (ffmpeg, encode
+    workers, see process_rss_bytes) above what it was when the job started,
+    plus the job's scratch directory. Jobs running side by side on one
+    instance share the process, so each one sees the others' growth too.
+
+    With a budget, wait_for_headroom() holds back new work (the next part)
+    until usage is under it again, and check() fails a job that went over it
+    anyway. Either raises MemoryBudgetExceeded.
+
+    Args:
+        job: name used in the report.
+        scratch_dir: the job's scratch directory, counted as memory.
+        budget_mb: defaults to JOB_MEMORY_BUDGET_MB, 0 for none.
+        interval_sec: sampling interval.
+    """
+
+    def __init__(self,
+                 job,
+                 scratch_dir=None,
+                 budget_mb=None,
+                 interval_sec=MEMORY_SAMPLE_SEC):
+        self.job = job
+        self.scratch_dir = scratch_dir
+        self.budget_bytes = (JOB_MEMORY_BUDGET_MB if budget_mb is None else
+                             budget_mb) * 1024 * 1024
+        self.interval_sec = interval_sec
+        self.baseline_bytes = 0
+        self.peak_bytes = 0
+        self.peak_rss_bytes = 0
+        self.peak_scratch_bytes = 0
+        self.current_bytes = 0
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name=f"memory-{job}",
+                                        daemon=True)
+
+    def __enter__(self):
+        self.baseline_bytes = process_tree_rss_bytes()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        over = self.budget_bytes and self.peak_bytes > self.budget_bytes
+        print(f"Memory for {self.job}: peak {self.peak_bytes / 2**20:.0f} MB above a "
+              f"{self.baseline_bytes / 2**20:.0f} MB baseline (RSS {self.peak_rss_bytes / 2**20:.0f} MB, "
+              f"scratch {self.peak_scratch_bytes / 2**20:.0f} MB)"
+              + (f", over the {self.budget_bytes / 2**20:.0f} MB budget" if over else ""))
+        # One observation per job: a gauge would only keep the last job's peak
+        metrics.observe("ingest_job_peak_memory_bytes", self.peak_bytes, buckets=metrics.BYTES_BUCKETS)
+        metrics.observe("ingest_job_peak_rss_bytes", self.peak_rss_bytes, buckets=metrics.BYTES_BUCKETS)
+        if over:
+            metrics.inc("ingest_memory_budget_exceeded_total")
+
+    def sample(self):
+        """Measures current usage, updates the peaks and returns it."""
+        rss = max(0, process_tree_rss_bytes() - self.baseline_bytes)
+        scratch = directory_bytes(self.scratch_dir) if self.scratch_dir else 0
+        with self._condition:
+            self.peak_rss_bytes = max(self.peak_rss_bytes, rss)
+            self.peak_scratch_bytes = max(self.peak_scratch_bytes, scratch)
+            self.peak_bytes = max(self.peak_bytes, rss + scratch)
+            self.current_bytes = rss + scratch
+            self._condition.notify_all()
+        return rss + scratch
+
+    def wait_for_headroom(self, nbytes=0, timeout=MEMORY_WAIT_TIMEOUT_SEC):
+        """Blocks until usage plus nbytes fits in the budget. Returns immediately without one.
+
+        Raises:
+            MemoryBudgetExceeded: nbytes alone is over the budget, or there
+                was no room after timeout seconds.
+        """
+        if not self.budget_bytes:
+            return
+        if nbytes > self.budget_bytes:
+            raise MemoryBudgetExceeded(f"{self.job} needs {nbytes / 2**20:.0f} MB, more than its "
+                                       f"{self.budget_bytes / 2**20:.0f} MB memory budget")
+        deadline = time.monotonic() + timeout
+        while self.sample() + nbytes > self.budget_bytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise MemoryBudgetExceeded(f"{self.job}: still over its {self.budget_bytes / 2**20:.0f} MB "
+                                           f"memory budget after {timeout}s")
+            with self._condition:
+                self._condition.wait(timeout=min(self.interval_sec, remaining))
+
+    def check(self):
+        """Raises MemoryBudgetExceeded if the job has gone over its budget since it started."""
+        self.sample()
+        if self.budget_bytes and self.peak_bytes > self.budget_bytes:
+            raise MemoryBudgetExceeded(f"{self.job} used {self.peak_bytes / 2**20:.0f} MB, over its "
+                                       f"{self.budget_bytes / 2**20:.0f} MB memory budget")
+
+    def _run(self):
+        while not self._stop.wait(self.interval_sec):
+            self.sample()
@@ -0,0 +1,202 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Print every span as a structured (JSON) log line, for Cloud Logging log-based metrics
+LOG_SPANS = os.environ.get("METRICS_LOG_SPANS", "0") == "1"
+
+# Histogram bucket upper bounds in seconds, from a token refresh to a long encode
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600,
+           float("inf"))
+# For histograms of sizes in bytes: 16 MiB to 16 GiB, doubling
+BYTES_BUCKETS = tuple(2**i * 2**20 for i in range(4, 15)) + (float("inf"), )
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> [bucket counts, sum, count, buckets]
+_counters = {}  # (name, labels) -> value
+_gauges = {}  # (name, labels) -> value
+
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items()
+                               if v is not None)))
+
+
+def observe(name, value, buckets=BUCKETS, **labels):
+    """Adds value to the histogram name{labels}. A histogram keeps the buckets of its first observation."""
+    with _lock:
+        histogram = _histograms.setdefault(_key(name, labels),
+                                           [[0] * len(buckets), 0.0, 0, buckets])
+        histogram[0][bisect.bisect_left(histogram[3], value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def inc(name, value=1, **labels):
+    """Adds value to the counter name{labels}."""
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(name, value, **labels):
+    """Sets the gauge name{labels} to value."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def record(stage,
+           duration_sec,
+           bucket=None,
+           error=None,
+           video=None,
+           part=None,
+           nbytes=None,
+           status_code=None,
+           **fields):
+    """Records one finished stage span.
+
+    Only stage and bucket become metric labels; video, part and the other
+    fields are too many-valued for that and only go to the structured log.
+    A span fails if it raised (error) or got an HTTP error status_code.
+    """
+    if error is None and status_code is not None and status_code >= 400:
+        error = f"HTTP {status_code}"
+    status = "ok" if error is None else "error"
+    observe("ingest_stage_seconds", duration_sec, stage=stage, bucket=bucket)
+    inc("ingest_stage_total", stage=stage, bucket=bucket, status=status)
+    if nbytes:
+        inc("ingest_stage_bytes_total", nbytes, stage=stage, bucket=bucket)
+
+    if LOG_SPANS:
+        entry = {
+            "severity": "INFO" if error is None else "ERROR",
+            "message": f"{stage} {status} in {duration_sec:.3f}s",
+            "stage": stage,
+            "duration_sec": round(duration_sec, 6),
+            "bucket": bucket,
+            "video": video,
+            "part": part,
+            "bytes": nbytes,
+            "status_code": status_code,
+            "error": error,
+            **fields
+        }
+        print(json.dumps({k: v for k, v in entry.items() if v is not None}))
+
+
+@contextmanager
+def span(stage, **tags):
+    """Times the block as one stage span, see record() for the tags.
+
+    Yields the tags dict, so values only known at the end (like nbytes) can be
+    set inside the block.
+    """
+    start = time.time()
+    error = None
+    try:
+        yield tags
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record(stage, time.time() - start, error=error, **tags)
+
+
+def reset():
+    """Drops everything recorded so far (used between benchmark runs)."""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+
+
+def quantile(q, bucket_counts, buckets=BUCKETS):
+    """Estimates a quantile from bucket counts, interpolating within the bucket like histogram_quantile()."""
+    total = sum(bucket_counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(bucket_counts):
+        if seen + count >= rank:
+            lower = buckets[i - 1] if i else 0
+            upper = buckets[i]
+            if upper == float("inf"):
+                return lower
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+
+
+def snapshot():
+    """Current metrics as plain data: count, sum, p50 and p99 per histogram, value per counter and gauge."""
+    with _lock:
+        histograms = {key: (list(h[0]), h[1], h[2], h[3]) for key, h in _histograms.items()}
+        counters = dict(_counters)
+        counters.update(_gauges)
+
+    result = []
+    for (name, labels), (bucket_counts, total, count, buckets) in sorted(histograms.items()):
+        result.append({
+            "name": name,
+            "labels": dict(labels),
+            "count": count,
+            "sum": round(total, 6),
+            "p50": quantile(0.5, bucket_counts, buckets),
+            "p99": quantile(0.99, bucket_counts, buckets)
+        })
+    for (name, labels), value in sorted(counters.items()):
+        result.append({"name": name, "labels": dict(labels), "value": value})
+    return result
+
+
+def log_summary():
+    """Prints the snapshot as one structured log line."""
+    print(json.dumps({
+        "severity": "INFO",
+        "message": "ingest metrics",
+        "metrics": snapshot()
+    }))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render():
+    """Prometheus text exposition format (version 0.0.4)."""
+    with _lock:
+        histograms = {key: (list(h[0]), h[1], h[2], h[3]) for key, h in _histograms.items()}
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+
+    lines = []
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (hist_name, labels), (bucket_counts, total, count, buckets) in sorted(histograms.items()):
+            if hist_name != name:
+                continue
+            cumulative = 0
+            for upper, bucket_count in zip(buckets, bucket_counts):
+                cumulative += bucket_count
+                le = "+Inf" if upper == float("inf") else repr(float(upper))
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    for name in sorted({name for name, _ in gauges}):
+        lines.append(f"# TYPE {name} gauge")
+        for (gauge_name, labels), value in sorted(gauges.items()):
+            if gauge_name == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,170 @@
+"""Reads where each part of an MP4 lives in the file, from the sample tables in its moov box.
+
+Used to cut parts from the head of a file that is still downloading: a part
+can be written once every byte its samples (all tracks) occupy is on disk.
+Only the box headers and the moov box are read.
+"""
+import bisect
+import os
+import struct
+
+# Box types that only contain other boxes, on the way to the sample tables
+CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+
+
+class Mp4IndexError(Exception):
+    pass
+
+
+class SampleIndex:
+    """For each chunk of samples (any track), the time of its first sample and the end of its bytes.
+
+    Args:
+        chunks: list of (start_sec, end_offset).
+    """
+
+    def __init__(self, chunks):
+        chunks = sorted(chunks)
+        self.start_secs = [start_sec for start_sec, _ in chunks]
+        # Tracks are interleaved and not always in order, so this is the furthest byte so far
+        self.end_offsets = []
+        furthest = 0
+        for _, end_offset in chunks:
+            furthest = max(furthest, end_offset)
+            self.end_offsets.append(furthest)
+
+    def bytes_needed(self, end_sec):
+        """Offset up to which the file must be on disk to read everything before end_sec."""
+        count = bisect.bisect_left(self.start_secs, end_sec)
+        if count < len(self.end_offsets):
+            # The chunk that starts at or after end_sec may still hold its last frame
+            count += 1
+        return self.end_offsets[count - 1] if count else 0
+
+
+def load(path, file_size, wait_for_range=None):
+    """Returns the SampleIndex of the MP4 at path, or None if it has none (fragmented MP4, other container).
+
+    Args:
+        path: local file, possibly still being written.
+        file_size: its final size.
+        wait_for_range: called with (start, end) before reading those bytes,
+            e.g. SlicedDownload.wait_for_range.
+    """
+    wait_for_range = wait_for_range or (lambda start, end: None)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+
+        def read(offset, size):
+            wait_for_range(offset, offset + size)
+            data = os.pread(fd, size, offset)
+            if len(data) != size:
+                raise Mp4IndexError(f"short read at {offset}")
+            return data
+
+        moov = None
+        for box_type, start, end in iter_boxes(read, 0, file_size):
+            if box_type == b"moov":
+                moov = read(start, end - start)
+                break
+        if moov is None:
+            return None
+
+        chunks = []
+        for trak in find_boxes(moov, b"trak"):
+            chunks.extend(track_chunks(trak))
+        if not chunks:
+            return None
+        return SampleIndex(chunks)
+    except (Mp4IndexError, struct.error) as e:
+        print(f"Could not read the sample tables of {path}: {e}")
+        return None
+    finally:
+        os.close(fd)
+
+
+def iter_boxes(read, start, end):
+    """Yields (type, payload start, payload end) for each box in [start, end) of the file."""
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack(">I4s", read(offset, 8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", read(offset + 8, 8))[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            raise Mp4IndexError(f"invalid box size {size} at {offset}")
+        yield box_type, offset + header, min(offset + size, end)
+        offset += size
+
+
+def find_boxes(data, box_type):
+    """Payloads of every box_type box in data, looking inside container boxes."""
+    found = []
+    for child_type, start, end in iter_boxes(
+            lambda offset, size: data[offset:offset + size], 0, len(data)):
+        payload = data[start:end]
+        if child_type == box_type:
+            found.append(payload)
+        elif child_type in CONTAINER_BOXES:
+            found.extend(find_boxes(payload, box_type))
+    return found
+
+
+def track_chunks(trak):
+    """(start_sec, end_offset) of every chunk of one track."""
+    mdhd = find_boxes(trak, b"mdhd")
+    stts = find_boxes(trak, b"stts")
+    stsc = find_boxes(trak, b"stsc")
+    stsz = find_boxes(trak, b"stsz")
+    offsets = find_boxes(trak, b"stco")
+    offset_format = ">I"
+    if not offsets:
+        offsets = find_boxes(trak, b"co64")
+        offset_format = ">Q"
+    if not (mdhd and stts and stsc and stsz and offsets):
+        return []
+
+    # Every table starts with a version (1 byte) and flags (3 bytes)
+    version = mdhd[0][0]
+    timescale = struct.unpack_from(">I", mdhd[0], 20 if version == 1 else 12)[0]
+
+    deltas = []
+    (entries, ) = struct.unpack_from(">I", stts[0], 4)
+    for i in range(entries):
+        count, delta = struct.unpack_from(">II", stts[0], 8 + 8 * i)
+        deltas.extend([delta] * count)
+
+    sample_size, sample_count = struct.unpack_from(">II", stsz[0], 4)
+    if sample_size:
+        sizes = [sample_size] * sample_count
+    else:
+        sizes = list(struct.unpack_from(f">{sample_count}I", stsz[0], 12))
+
+    (entries, ) = struct.unpack_from(">I", offsets[0], 4)
+    chunk_offsets = struct.unpack_from(f">{entries}{offset_format[1]}",
+                                       offsets[0], 8)
+
+    # stsc runs: from first_chunk (1-based) on, each chunk has samples_per_chunk samples
+    (entries, ) = struct.unpack_from(">I", stsc[0], 4)
+    runs = [
+        struct.unpack_from(">III", stsc[0], 8 + 12 * i)[:2]
+        for i in range(entries)
+    ]
+
+    chunks = []
+    sample = 0
+    time = 0
+    for run, (first_chunk, samples_per_chunk) in enumerate(runs):
+        last_chunk = runs[run + 1][0] - 1 if run + 1 < len(runs) else len(
+            chunk_offsets)
+        for chunk in range(first_chunk - 1, last_chunk):
+            chunk_samples = range(sample,
+                                  min(sample + samples_per_chunk, len(sizes)))
+            chunks.append((time / timescale, chunk_offsets[chunk] +
+                           sum(sizes[i] for i in chunk_samples)))
+            time += sum(deltas[i] for i in chunk_samples if i < len(deltas))
+            sample += samples_per_chunk
+    return chunks
@@ -0,0 +1,80 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+def run_pipeline(source, stages, queue_size=2):
+    """Streams items from source through stages, each stage in its own thread.
+
+    Stages are connected by bounded queues, so a fast stage blocks once it is
+    queue_size items ahead of the next one instead of piling up work (and /tmp
+    files). Total time is roughly that of the slowest stage rather than the sum.
+
+    Args:
+        source: iterable producing the input items. It is consumed on the
+            calling thread, so a generator here acts as the first stage.
+        stages: list of (name, fn) or (name, fn, queue_size) where fn(item)
+            returns the item passed on to the next stage.
+        queue_size: maximum number of items waiting in front of a stage that
+            doesn't set its own.
+    Returns:
+        outputs of the last stage, in source order
+    Raises:
+        the first exception raised by the source or any stage. Once a stage
+        fails the remaining items are drained without being processed.
+    """
+    queues = [
+        queue.Queue(maxsize=stage[2] if len(stage) > 2 else queue_size)
+        for stage in stages
+    ]
+    errors = []
+    results = []
+
+    def run_stage(name, fn, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                if outbox is not None:
+                    outbox.put(_DONE)
+                return
+            if errors:
+                continue
+            try:
+                output = fn(item)
+            except Exception as e:
+                print(f"Pipeline stage {name} failed: {e}")
+                errors.append(e)
+                continue
+            if outbox is not None:
+                outbox.put(output)
+            else:
+                results.append(output)
+
+    threads = []
+    for i, (name, fn, *_) in enumerate(stages):
+        outbox = queues[i + 1] if i + 1 < len(stages) else None
+        thread = threading.Thread(target=run_stage,
+                                  name=f"pipeline-{name}",
+                                  args=(name, fn, queues[i], outbox),
+                                  daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    try:
+        for item in source:
+            if errors:
+                break
+            queues[0].put(item)
+    except Exception as e:
+        print(f"Pipeline source failed: {e}")
+        errors.append(e)
+    finally:
+        queues[0].put(_DONE)
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+import time
+
+from google.api_core.exceptions import NotFound
+
+MANIFEST_PREFIX = os.environ.get("MANIFEST_PREFIX", "_manifests/")
+# GCS allows about one write per second to the same object name, updates in between are saved together
+MANIFEST_SAVE_INTERVAL_SEC = float(os.environ.get("MANIFEST_SAVE_INTERVAL_SEC", 1))
+
+# Stages each part goes through, in order
+ENCODED = "encoded"
+UPLOADED = "uploaded"
+EMBEDDED = "embedded"
+UPSERTED = "upserted"
+
+
+class ProgressManifest:
+    """Per-video record of which parts have been encoded, uploaded, embedded and upserted.
+
+    Stored as gs://{bucket}/{MANIFEST_PREFIX}{video_name}.json, so a rerun
+    after a failure (or an instance recycle) only redoes the parts that are
+    missing. A manifest for a different generation of the source object is
+    discarded.
+
+    Updates are saved at most once per save_interval_sec, the ones in between
+    by a timer. flush() saves what is left at the end of a run. A crash loses
+    at most the last interval, whose parts are redone.
+    """
+
+    def __init__(self,
+                 bucket,
+                 video_name,
+                 generation,
+                 save_interval_sec=MANIFEST_SAVE_INTERVAL_SEC):
+        self.blob = bucket.blob(f"{MANIFEST_PREFIX}{video_name}.json")
+        self.generation = generation
+        self.save_interval_sec = save_interval_sec
+        self.cuts = []  # [start, end, reencode] per part
+        self.parts = {}  # part path -> list of stages done
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_save = 0
+        self._timer = None
+
+    def load(self):
+        """Loads the saved progress. Returns True if there was any for this generation."""
+        try:
+            saved = json.loads(self.blob.download_as_text())
+        except NotFound:
+            return False
+        if saved["generation"] != self.generation:
+            print(f"Ignoring manifest for generation {saved['generation']}, source is now {self.generation}")
+            return False
+        self.cuts = saved["cuts"]
+        self.parts = saved["parts"]
+        return True
+
+    def set_plan(self, part_paths, cuts):
+        with self._lock:
+            self.cuts = [list(cut) for cut in cuts]
+            self.parts = {part: [] for part in part_paths}
+            self._save()
+
+    def mark(self, part, stage):
+        with self._lock:
+            if stage in self.parts[part]:
+                return
+            self.parts[part].append(stage)
+            self._dirty = True
+            wait = self._last_save + self.save_interval_sec - time.monotonic()
+            if wait <= 0:
+                self._try_save()
+            else:
+                self._schedule_save(wait)
+
+    def flush(self):
+        """Saves the updates not written yet. Raises if the save fails."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._dirty:
+                self._save()
+
+    def done(self, part, stage):
+        with self._lock:
+            return stage in self.parts.get(part, [])
+
+    def pending(self, stage):
+        with self._lock:
+            return [part for part, stages in self.parts.items() if stage not in stages]
+
+    def summary(self):
+        with self._lock:
+            return {
+                stage: sum(stage in stages for stages in self.parts.values())
+                for stage in (ENCODED, UPLOADED, EMBEDDED, UPSERTED)
+            }
+
+    def _deferred_save(self):
+        with self._lock:
+            # A flush (and a newer timer) may have taken over in the meantime
+            if self._timer is not threading.current_thread():
+                return
+            self._timer = None
+            if self._dirty:
+                self._try_save()
+
+    def _schedule_save(self, wait):
+        # Caller holds the lock
+        if self._timer is None:
+            self._timer = threading.Timer(wait, self._deferred_save)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _try_save(self):
+        # Caller holds the lock. Progress is best effort: a failed save is retried an interval later
+        # instead of failing the stage that called mark().
+        try:
+            self._save()
+        except Exception as e:
+            print(f"Could not save gs://{self.blob.bucket.name}/{self.blob.name}: {e}")
+            self._last_save = time.monotonic()
+            self._schedule_save(self.save_interval_sec)
+
+    def _save(self):
+        # Caller holds the lock
+        self.blob.upload_from_string(json.dumps({
+            "generation": self.generation,
+            "cuts": self.cuts,
+            "parts": self.parts
+        }),
+                                     content_type="application/json")
+        self._dirty = False
+        self._last_save = time.monotonic()
@@ -0,0 +1,342 @@
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from google.api_core.exceptions import NotFound
+
+import embedding_executor
+import http_client
+import metrics
+
+# Attempts per call (first try included) and the backoff between them
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", 8))
+RETRY_BASE_DELAY_SEC = float(os.environ.get("RETRY_BASE_DELAY_SEC", 1))
+RETRY_MAX_DELAY_SEC = float(os.environ.get("RETRY_MAX_DELAY_SEC", 60))
+# Consecutive 5xx/connection failures that open the circuit, and how long it stays open
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RESET_SEC = float(os.environ.get("BREAKER_RESET_SEC", 30))
+UPSERT_MAX_CONCURRENCY = int(os.environ.get("UPSERT_MAX_CONCURRENCY", 8))
+DEAD_LETTER_PREFIX = os.environ.get("DEAD_LETTER_PREFIX", "_dead_letter/")
+
+RETRYABLE_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+if http_client.HTTP2:
+    import httpx
+
+    RETRYABLE_EXCEPTIONS += (httpx.TransportError,)
+
+
+class RetriesExhausted(Exception):
+
+    def __init__(self, endpoint, attempts, last_error):
+        super().__init__(
+            f"{endpoint} failed after {attempts} attempts: {last_error}")
+        self.last_error = last_error
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, overridden by Retry-After when the server sends one."""
+
+    def __init__(self,
+                 max_attempts=RETRY_MAX_ATTEMPTS,
+                 base_delay_sec=RETRY_BASE_DELAY_SEC,
+                 max_delay_sec=RETRY_MAX_DELAY_SEC):
+        self.max_attempts = max_attempts
+        self.base_delay_sec = base_delay_sec
+        self.max_delay_sec = max_delay_sec
+
+    def delay(self, attempt, response=None):
+        """Seconds to wait before retry number attempt (1 for the first retry)."""
+        retry_after = parse_retry_after(response)
+        if retry_after is not None:
+            # Plus a little jitter so throttled callers don't all come back at once
+            return min(retry_after, self.max_delay_sec) + random.uniform(0, 1)
+        ceiling = min(self.max_delay_sec,
+                      self.base_delay_sec * 2**(attempt - 1))
+        return random.uniform(0, ceiling)
+
+
+def parse_retry_after(response):
+    """Retry-After in seconds (delta-seconds or HTTP-date form), or None."""
+    if response is None:
+        return None
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() -
+                   time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Stops calling an endpoint that keeps failing, then lets one probe through after reset_sec.
+
+    Callers wait while the circuit is open instead of failing: ingest runs in
+    the background, and the work must not be dropped.
+    """
+
+    def __init__(self,
+                 name,
+                 failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 reset_sec=BREAKER_RESET_SEC):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_sec = reset_sec
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0
+        self._probing = False
+        self._condition = threading.Condition()
+
+    def wait(self):
+        """Blocks until a call is allowed. Returns True if this call is the half-open probe."""
+        with self._condition:
+            while True:
+                if self.state == "closed":
+                    return False
+                remaining = self._opened_at + self.reset_sec - time.monotonic()
+                if remaining <= 0 and not self._probing:
+                    self.state = "half-open"
+                    self._probing = True
+                    return True
+                self._condition.wait(timeout=max(remaining, 0.1))
+
+    def record_success(self, probe=False):
+        with self._condition:
+            if probe or self.state != "closed":
+                print(f"Circuit {self.name} closed")
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+            self._condition.notify_all()
+
+    def record_failure(self, probe=False):
+        with self._condition:
+            self.failures += 1
+            if probe or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"Circuit {self.name} open for {self.reset_sec}s after {self.failures} failures")
+                    metrics.inc("ingest_circuit_open_total", endpoint=self.name)
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self._condition.notify_all()
+
+
+class AIMDLimiter:
+    """Concurrency limit that grows by one per limit successes and halves on a 429.
+
+    Like TCP congestion control: under quota pressure the calls in flight
+    settle just below what the quota allows instead of piling up retries.
+
+    Args:
+        name: for logging.
+        maximum: upper bound (the static concurrency cap).
+        minimum: lower bound.
+        initial: starting limit, defaults to maximum.
+        decrease: factor applied on a 429.
+        cooldown_sec: at most one decrease per cooldown, so one burst of 429s
+            from calls already in flight only counts once.
+    """
+
+    def __init__(self,
+                 name,
+                 maximum,
+                 minimum=1,
+                 initial=None,
+                 decrease=0.5,
+                 cooldown_sec=2):
+        self.name = name
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(initial or maximum)
+        self.decrease = decrease
+        self.cooldown_sec = cooldown_sec
+        self.in_flight = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        with self._condition:
+            if self.limit < self.maximum:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown_sec:
+                return
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            print(f"{self.name} throttled, concurrency limit now {int(self.limit)}")
+
+
+class ResilientEndpoint:
+    """Runs calls to one Vertex endpoint with retries, a circuit breaker, AIMD concurrency and an optional rate limit.
+
+    429 shrinks the concurrency and waits for Retry-After (or backs off).
+    5xx and connection errors back off and count towards the breaker. Other
+    4xx are returned to the caller at once, they won't succeed on retry.
+    """
+
+    def __init__(self, name, limiter, breaker=None, policy=None,
+                 rate_limiter=None):
+        self.name = name
+        self.limiter = limiter
+        self.breaker = breaker or CircuitBreaker(name)
+        self.policy = policy or RetryPolicy()
+        self.rate_limiter = rate_limiter
+
+    def call(self, send):
+        """Calls send() (which returns a response) until it succeeds or the attempts run out.
+
+        Returns the successful (or non-retryable 4xx) response; raises
+        RetriesExhausted otherwise.
+        """
+        last_error = None
+        for attempt in range(1, self.policy.max_attempts + 1):
+            probe = self.breaker.wait()
+            response = None
+            with self.limiter:
+                try:
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.acquire()
+                    response = send()
+                except RETRYABLE_EXCEPTIONS as e:
+                    last_error = f"{type(e).__name__}: {e}"
+                except BaseException:
+                    # Not retried here (a token refresh error, ...), but a probe that never reports
+                    # would leave the breaker half-open and every later call waiting on it
+                    if probe:
+                        self.breaker.record_failure(probe)
+                    raise
+
+            if response is not None:
+                status = response.status_code
+                if status < 400:
+                    self.limiter.on_success()
+                    self.breaker.record_success(probe)
+                    return response
+                last_error = f"{status} {response.text[:200]}"
+                if status == 429:
+                    self.limiter.on_throttle()
+                    # The endpoint is up, it's the quota: doesn't count towards the breaker
+                    if probe:
+                        self.breaker.record_success(probe)
+                elif status >= 500:
+                    self.breaker.record_failure(probe)
+                else:
+                    self.breaker.record_success(probe)
+                    return response
+            else:
+                self.breaker.record_failure(probe)
+
+            reason = "429" if response is not None and response.status_code == 429 else "error"
+            metrics.inc("ingest_retries_total", endpoint=self.name, reason=reason)
+            if attempt < self.policy.max_attempts:
+                delay = self.policy.delay(attempt, response)
+                print(f"{self.name} attempt {attempt} failed ({last_error}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+        raise RetriesExhausted(self.name, self.policy.max_attempts, last_error)
+
+
+# Shared by every video processed on this instance. Predict calls are also held to the project quota.
+predict_endpoint = ResilientEndpoint(
+    "predict",
+    AIMDLimiter("predict", embedding_executor.PREDICT_INSTANCE_CONCURRENCY),
+    rate_limiter=embedding_executor.predict_rate_limiter)
+upsert_endpoint = ResilientEndpoint("upsert",
+                                    AIMDLimiter("upsert", UPSERT_MAX_CONCURRENCY))
+# Batch index updates (see batch_index_writer), one at a time per instance
+update_endpoint = ResilientEndpoint("update", AIMDLimiter("update", 1))
+
+
+class DeadLetterStore:
+    """Datapoints that could not be upserted, kept in GCS so they can be replayed instead of lost.
+
+    Each batch is one object: gs://{bucket}/{DEAD_LETTER_PREFIX}{video}/{timestamp}.json
+    holding {"video", "errors": {id: error}, "datapoints": [...]}.
+    """
+
+    def __init__(self, bucket, prefix=DEAD_LETTER_PREFIX):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, video_name, datapoints, errors):
+        if not datapoints:
+            return None
+        blob = self.bucket.blob(f"{self.prefix}{video_name}/{time.time():.6f}.json")
+        blob.upload_from_string(json.dumps({
+            "video": video_name,
+            "errors": errors,
+            "datapoints": datapoints
+        }),
+                                content_type="application/json")
+        metrics.inc("ingest_dead_letter_datapoints_total", len(datapoints))
+        print(f"Dead-lettered {len(datapoints)} datapoints of {video_name} to gs://{self.bucket.name}/{blob.name}")
+        return blob.name
+
+    def count(self):
+        return sum(1 for _ in self.bucket.list_blobs(prefix=self.prefix))
+
+    def clear(self, video_name):
+        """Deletes the dead letters of a video, once a later run has upserted all of its datapoints.
+
+        Replaying them after that would overwrite the index with stale vectors. Returns how many batches were deleted.
+        """
+        cleared = 0
+        for blob in self.bucket.list_blobs(prefix=f"{self.prefix}{video_name}/"):
+            try:
+                blob.delete()
+            except NotFound:
+                # Replayed in the meantime
+                continue
+            cleared += 1
+        if cleared:
+            print(f"Cleared {cleared} dead-lettered batches of {video_name}, superseded by a successful run")
+        return cleared
+
+    def replay(self, upsert_fn, video_name=""):
+        """Upserts every dead-lettered batch again (optionally only one video's) and deletes the ones that succeed.
+
+        Returns {"replayed": datapoints upserted, "remaining": batches still failing}.
+        """
+        replayed = 0
+        remaining = 0
+        for blob in self.bucket.list_blobs(prefix=f"{self.prefix}{video_name}"):
+            datapoints = json.loads(blob.download_as_text())["datapoints"]
+            try:
+                response = upsert_fn(datapoints)
+            except Exception as e:
+                print(f"Replay of gs://{self.bucket.name}/{blob.name} failed: {e}")
+                remaining += 1
+                continue
+            if response.status_code == 200:
+                blob.delete()
+                replayed += len(datapoints)
+            else:
+                print(f"Replay of gs://{self.bucket.name}/{blob.name} failed: {response.status_code} {response.text}")
+                remaining += 1
+        return {"replayed": replayed, "remaining": remaining}
@@ -0,0 +1,107 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+# /tmp is RAM on Cloud Run, so these quotas are effectively memory quotas
+SCRATCH_ROOT = os.environ.get("SCRATCH_ROOT", "/tmp/ingest")
+# Shared by every job on the instance
+SCRATCH_QUOTA_MB = int(os.environ.get("SCRATCH_QUOTA_MB", 4096))
+# Hard limit for a single job
+JOB_SCRATCH_QUOTA_MB = int(os.environ.get("JOB_SCRATCH_QUOTA_MB", 2048))
+# Reserved per job, as a multiple of the source size (source + parts written from it)
+SCRATCH_RESERVE_FACTOR = float(os.environ.get("SCRATCH_RESERVE_FACTOR", 2))
+
+
+class ScratchQuotaExceeded(Exception):
+    pass
+
+
+def source_fits(source_bytes):
+    """True if a local copy of the source and the parts written from it fit in the per-job quota."""
+    limit_bytes = min(JOB_SCRATCH_QUOTA_MB * 1024 * 1024, SCRATCH_QUOTA_MB * 1024 * 1024)
+    return source_bytes * SCRATCH_RESERVE_FACTOR <= limit_bytes
+
+
+class _ScratchBudget:
+    """Instance-wide byte budget. Jobs wait for room instead of running /tmp out of memory."""
+
+    def __init__(self, total_bytes):
+        self.total_bytes = total_bytes
+        self.reserved_bytes = 0
+        self._condition = threading.Condition()
+
+    def reserve(self, nbytes):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.reserved_bytes + nbytes <= self.total_bytes)
+            self.reserved_bytes += nbytes
+
+    def release(self, nbytes):
+        with self._condition:
+            self.reserved_bytes -= nbytes
+            self._condition.notify_all()
+
+
+_budget = _ScratchBudget(SCRATCH_QUOTA_MB * 1024 * 1024)
+
+
+class ScratchWorkspace:
+    """Private scratch directory for one ingest job, removed when the job ends.
+
+    Entering reserves space from the instance-wide budget, waiting if other jobs
+    hold it. check_quota() raises once the directory grows past the per-job
+    quota.
+
+    Args:
+        job_name: used as the directory prefix, for debugging.
+        source_bytes: size of the source video, used to size the reservation.
+    """
+
+    def __init__(self, job_name, source_bytes=0):
+        self.job_name = re.sub(r"[^A-Za-z0-9_.-]", "_", job_name)[:64]
+        self.quota_bytes = JOB_SCRATCH_QUOTA_MB * 1024 * 1024
+        self.reserved_bytes = min(int(source_bytes * SCRATCH_RESERVE_FACTOR),
+                                  self.quota_bytes)
+        self.dir = None
+
+    def __enter__(self):
+        if self.reserved_bytes > _budget.total_bytes:
+            raise ScratchQuotaExceeded(
+                f"{self.job_name} needs {self.reserved_bytes} bytes, more than SCRATCH_QUOTA_MB"
+            )
+        _budget.reserve(self.reserved_bytes)
+        os.makedirs(SCRATCH_ROOT, exist_ok=True)
+        self.dir = tempfile.mkdtemp(prefix=f"{self.job_name}-",
+                                    dir=SCRATCH_ROOT)
+        return self
+
+    def __exit__(self, *exc_info):
+        shutil.rmtree(self.dir, ignore_errors=True)
+        _budget.release(self.reserved_bytes)
+
+    def path(self, filename):
+        return os.path.join(self.dir, filename)
+
+    def local_path(self, part):
+        """Local file for a part named like "/tmp/part-N.mp4"."""
+        return self.path(os.path.basename(part))
+
+    def usage_bytes(self):
+        total = 0
+        for root, _, files in os.walk(self.dir):
+            for filename in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, filename))
+                except FileNotFoundError:
+                    pass  # deleted after upload in the meantime
+        return total
+
+    def check_quota(self):
+        usage = self.usage_bytes()
+        if usage > self.quota_bytes:
+            raise ScratchQuotaExceeded(
+                f"{self.job_name} uses {usage} bytes of scratch, over JOB_SCRATCH_QUOTA_MB"
+            )
+        return usage
@@ -0,0 +1,368 @@
+import bisect
+import math
+import multiprocessing
+import os
+import re
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from moviepy.config import get_setting
+
+# Same binary moviepy shells out to (imageio-ffmpeg by default)
+FFMPEG_BINARY = get_setting("FFMPEG_BINARY")
+
+# Re-encodes run in a process pool. The pool is capped both by worker count and by
+# how many workers fit in the memory budget (each one holds its own decoder/encoder).
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", os.cpu_count() or 1))
+ENCODE_MEMORY_BUDGET_MB = int(os.environ.get("ENCODE_MEMORY_BUDGET_MB", 2048))
+ENCODE_MEMORY_PER_WORKER_MB = int(
+    os.environ.get("ENCODE_MEMORY_PER_WORKER_MB", 512))
+
+# Longest video the multimodal embedding API embeds in one predict call, and the
+# videoSegmentConfig.intervalSec the predict calls use
+MAX_SEGMENT_SEC = float(os.environ.get("MAX_SEGMENT_SEC", 120))
+INTERVAL_SEC = int(os.environ.get("PREDICT_INTERVAL_SEC", 5))
+# A part boundary may move this far to land on a keyframe (and skip a re-encode)
+KEYFRAME_TOLERANCE_SEC = float(os.environ.get("KEYFRAME_TOLERANCE_SEC", 0.5))
+# Audio frames moviepy decodes ahead (its default of 200000 is ~4.5s of 44.1kHz stereo float)
+AUDIO_BUFFER_FRAMES = int(os.environ.get("AUDIO_BUFFER_FRAMES", 50000))
+
+PTS_TIME_PATTERN = re.compile(r"pts_time:\s*([0-9.]+)")
+DURATION_PATTERN = re.compile(r"Duration:\s*(\d+):(\d+):([0-9.]+)")
+
+
+def header_args(headers):
+    """ffmpeg options sending HTTP headers with an http(s) input, [] without any."""
+    if not headers:
+        return []
+    return [
+        "-headers",
+        "".join(f"{key}: {value}\r\n" for key, value in headers.items())
+    ]
+
+
+def probe_duration(url, headers=None):
+    """Returns the duration in seconds of a local path or http(s) URL, or None if unknown.
+
+    For a URL ffmpeg only reads the container header (with range requests),
+    not the whole file.
+    """
+    command = [FFMPEG_BINARY, "-hide_banner"] + header_args(headers)
+    command += ["-i", url]
+    # ffmpeg exits with an error because no output is given, the header is printed anyway
+    completed = subprocess.run(command,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE)
+    match = DURATION_PATTERN.search(
+        completed.stderr.decode("utf-8", errors="ignore"))
+    if match is None:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def list_keyframes(video_path, headers=None):
+    """Returns the timestamps (seconds) of every keyframe in the first video stream.
+
+    Only keyframes are decoded (-skip_frame nokey) so this is a small fraction of
+    the cost of a full decode. video_path may be an http(s) URL (see header_args).
+    """
+    command = [
+        FFMPEG_BINARY, "-hide_banner", "-nostats", "-skip_frame", "nokey"
+    ] + header_args(headers) + [
+        "-i", video_path, "-map", "0:v:0", "-vf", "showinfo", "-an", "-f",
+        "null", "-"
+    ]
+    completed = subprocess.run(command,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE,
+                               check=True)
+    stderr = completed.stderr.decode("utf-8", errors="ignore")
+    return sorted(float(t) for t in PTS_TIME_PATTERN.findall(stderr))
+
+
+def plan_segments(duration,
+                  keyframes=None,
+                  max_segment_sec=MAX_SEGMENT_SEC,
+                  interval_sec=INTERVAL_SEC,
+                  keyframe_tolerance_sec=KEYFRAME_TOLERANCE_SEC):
+    """Plans (start, end, reencode) parts that cover [0, duration] exactly.
+
+    Every part is one predict call, so the plan uses the fewest parts that are
+    each at most max_segment_sec long, and among those the fewest that need a
+    re-encode. Boundaries sit on multiples of interval_sec so every
+    intervalSec embedding window falls entirely inside one part (only the
+    last window of the video can be shorter). A keyframe within
+    keyframe_tolerance_sec of a grid point can be used instead of it, so the
+    parts either side of it can be stream copied, as long as each part still
+    gets exactly one window per interval it spans: a part that ended later
+    past the grid than it started would get an extra sliver window at its
+    end, embedding that interval twice.
+
+    Args:
+        duration: duration of the video in seconds.
+        keyframes: keyframe timestamps, or None to re-encode every part.
+        max_segment_sec: longest part the embedding API takes in one call.
+        interval_sec: videoSegmentConfig.intervalSec of the predict calls.
+        keyframe_tolerance_sec: how far a boundary can move to reach a keyframe.
+    Returns:
+        list of (start, end, reencode). Consecutive parts share a boundary, the
+        first starts at 0 and the last ends at duration.
+    """
+    if duration <= 0:
+        return []
+    # Lengths are compared with a small epsilon so float noise can't add a part
+    epsilon = 1e-6
+    max_segment_sec = max(max_segment_sec, interval_sec)
+
+    # Candidate boundaries: the interval grid, plus any keyframe close enough to a grid point
+    candidates = {0.0: True, float(duration): True}
+    keyframes = sorted(keyframes) if keyframes is not None else None
+    grid_points = int(math.ceil(duration / interval_sec - epsilon))
+    for k in range(1, grid_points):
+        point = float(k * interval_sec)
+        candidates.setdefault(point, False)
+        if keyframes is None:
+            continue
+        i = bisect.bisect_left(keyframes, point - keyframe_tolerance_sec)
+        while i < len(keyframes) and keyframes[i] <= point + keyframe_tolerance_sec:
+            if 0 < keyframes[i] < duration:
+                candidates[keyframes[i]] = True
+            i += 1
+    boundaries = []
+    for position, on_keyframe in sorted(candidates.items()):
+        if boundaries and position - boundaries[-1][0] <= epsilon:
+            # Same point on the grid and on a keyframe
+            boundaries[-1] = (boundaries[-1][0], boundaries[-1][1] or on_keyframe)
+        else:
+            boundaries.append((position, on_keyframe))
+    # The interval each boundary stands for: its grid point, and for the end of the video the interval count
+    grid = [round(position / interval_sec) for position, _ in boundaries]
+    grid[-1] = grid_points
+
+    # best[j] = (parts, reencodes, previous boundary) of the cheapest plan ending at boundary j
+    best = [(0, 0, None)] + [None] * (len(boundaries) - 1)
+    for j in range(1, len(boundaries)):
+        end, end_on_keyframe = boundaries[j]
+        for i in range(j - 1, -1, -1):
+            start, start_on_keyframe = boundaries[i]
+            if end - start > max_segment_sec + epsilon:
+                break
+            if best[i] is None:
+                continue
+            # The predict call cuts the part into windows from its own start
+            if math.ceil((end - start) / interval_sec - epsilon) != grid[j] - grid[i]:
+                continue
+            reencode = keyframes is None or not (start_on_keyframe and
+                                                 end_on_keyframe)
+            cost = (best[i][0] + 1, best[i][1] + reencode, i)
+            if best[j] is None or cost[:2] < best[j][:2]:
+                best[j] = cost
+
+    cuts = []
+    j = len(boundaries) - 1
+    while j:
+        i = best[j][2]
+        start, start_on_keyframe = boundaries[i]
+        end, end_on_keyframe = boundaries[j]
+        cuts.append((start, end, keyframes is None or
+                     not (start_on_keyframe and end_on_keyframe)))
+        j = i
+    return cuts[::-1]
+
+
+def copy_part(video_path,
+              start_time,
+              end_time,
+              output_filepath,
+              headers=None):
+    # Input seeking to a keyframe + stream copy: container remux only, no decode.
+    # The seek lands on the last keyframe at or before the target, and keyframe times
+    # are printed rounded (e.g. 119.633333 for 119.6333...): rounding the target down
+    # too would land a whole GOP early. It is rounded up to the next millisecond
+    # instead, and the length down, so the part never reaches into the next one.
+    seek_time = math.ceil(start_time * 1000) / 1000
+    length = math.floor((end_time - seek_time) * 1000) / 1000
+    command = [
+        FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y", "-ss",
+        f"{seek_time:.3f}"
+    ] + header_args(headers) + [
+        "-i", video_path, "-t",
+        f"{length:.3f}", "-map", "0:v:0", "-map", "0:a?",
+        "-c", "copy", "-avoid_negative_ts", "make_zero", "-movflags",
+        "+faststart", output_filepath
+    ]
+    subprocess.run(command, check=True)
+    return output_filepath
+
+
+def encode_part(video_path,
+                start_time,
+                end_time,
+                output_filepath,
+                threads=0,
+                headers=None):
+    # Frame-accurate cut, only used when a boundary doesn't land on a keyframe.
+    # Audio and video go through the one ffmpeg process a packet at a time, nothing is buffered here.
+    command = [
+        FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y", "-ss",
+        f"{start_time:.3f}"
+    ] + header_args(headers) + [
+        "-i", video_path, "-t",
+        f"{end_time - start_time:.3f}", "-map", "0:v:0", "-map", "0:a?",
+        "-c:v", "libx264", "-preset", "veryfast", "-threads",
+        str(threads), "-c:a", "aac", "-movflags", "+faststart", output_filepath
+    ]
+    subprocess.run(command, check=True)
+    return output_filepath
+
+
+def encode_part_moviepy(video_path, start_time, end_time, output_filepath,
+                        threads=0):
+    # Same export as the sequential split_video_by_duration loop, but each worker
+    # opens (and closes) its own reader since clips can't be shared across processes.
+    from moviepy.editor import VideoFileClip
+
+    video = VideoFileClip(video_path, audio_buffersize=AUDIO_BUFFER_FRAMES)
+    part = video.subclip(start_time, end_time)
+    try:
+        # The audio is written to a temporary file first: keep it in the job's scratch
+        # directory (counted, and removed with it) rather than the working directory
+        part.write_videofile(
+            output_filepath,
+            audio=True,
+            temp_audiofile=f"{output_filepath}.audio.mp3",
+            threads=threads or None,
+            logger=None)
+    finally:
+        # Stops the ffmpeg reader processes of both the subclip and the source
+        part.close()
+        video.close()
+    return output_filepath
+
+
+def encode_worker_count(parts,
+                        max_workers=None,
+                        memory_budget_mb=None,
+                        memory_per_worker_mb=None):
+    max_workers = max_workers or ENCODE_WORKERS
+    memory_budget_mb = memory_budget_mb or ENCODE_MEMORY_BUDGET_MB
+    memory_per_worker_mb = memory_per_worker_mb or ENCODE_MEMORY_PER_WORKER_MB
+
+    workers_in_budget = memory_budget_mb // memory_per_worker_mb
+    return max(1, min(max_workers, workers_in_budget, parts))
+
+
+def encode_parts_parallel(video_path,
+                          cuts,
+                          output_filepaths,
+                          encoder=encode_part,
+                          max_workers=None,
+                          memory_budget_mb=None):
+    """Encodes several parts at once in a process pool.
+
+    Args:
+        video_path: local path of the source video.
+        cuts: list of (start_time, end_time) to encode.
+        output_filepaths: output path for each cut.
+        encoder: encode_part (ffmpeg) or encode_part_moviepy.
+        max_workers: defaults to ENCODE_WORKERS.
+        memory_budget_mb: defaults to ENCODE_MEMORY_BUDGET_MB.
+    Returns:
+        output file paths in the same order as cuts
+    """
+    if not cuts:
+        return []
+
+    workers = encode_worker_count(len(cuts), max_workers, memory_budget_mb)
+    # Split the cores between workers instead of letting every encoder grab all of them
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"Encoding {len(cuts)} parts with {workers} workers ({threads} threads each)")
+
+    if workers == 1:
+        return [
+            encoder(video_path, start_time, end_time, output_filepath, threads)
+            for (start_time, end_time), output_filepath in zip(
+                cuts, output_filepaths)
+        ]
+
+    # spawn rather than fork: the Flask server runs this from a request thread.
+    # moviepy workers are replaced after every part, numpy frees its frame buffers
+    # back to Python's allocator but the process keeps the memory otherwise.
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=1
+            if encoder is encode_part_moviepy else None) as executor:
+        futures = [
+            executor.submit(encoder, video_path, start_time, end_time,
+                            output_filepath, threads)
+            for (start_time, end_time), output_filepath in zip(
+                cuts, output_filepaths)
+        ]
+        return [future.result() for future in futures]
+
+
+def split_video_stream_copy(video_path,
+                            duration,
+                            seconds_per_part=MAX_SEGMENT_SEC,
+                            output_filepath_template="/tmp/part-%d.mp4"):
+    """Splits video_path into parts on keyframes without re-encoding.
+
+    Args:
+        video_path: local path of the source video.
+        duration: duration of the source video in seconds.
+        seconds_per_part: maximum length of a part.
+        output_filepath_template: same "/tmp/part-%d.mp4" template used by
+            split_video_by_duration.
+    Returns:
+        list of output file paths, in part order
+    """
+    keyframes = list_keyframes(video_path)
+    cuts = plan_segments(duration, keyframes, max_segment_sec=seconds_per_part)
+
+    output_filepaths = []
+    reencode_cuts = []
+    reencode_filepaths = []
+    for part, (start_time, end_time, reencode) in enumerate(cuts):
+        output_filepath = output_filepath_template % part
+        if reencode:
+            print(f"Re-encoding part {part} ({start_time}->{end_time}): no keyframe on its boundaries")
+            reencode_cuts.append((start_time, end_time))
+            reencode_filepaths.append(output_filepath)
+        else:
+            copy_part(video_path, start_time, end_time, output_filepath)
+        output_filepaths.append(output_filepath)
+
+    encode_parts_parallel(video_path, reencode_cuts, reencode_filepaths)
+
+    return output_filepaths
+
+
+def plan_video_parts(video_path,
+                     duration,
+                     seconds_per_part=MAX_SEGMENT_SEC,
+                     mode="copy",
+                     headers=None):
+    """Returns the (start, end, reencode) cuts of video_path, each to be written with write_video_part.
+
+    mode "copy" cuts on keyframes where possible, any other mode re-encodes every part.
+    """
+    keyframes = list_keyframes(video_path, headers) if mode == "copy" else None
+    return plan_segments(duration, keyframes, max_segment_sec=seconds_per_part)
+
+
+def write_video_part(video_path, cut, output_filepath, headers=None):
+    """Writes one part of video_path, a local path or an http(s) URL read with ranged requests."""
+    start_time, end_time, reencode = cut
+    if reencode:
+        return encode_part(video_path,
+                           start_time,
+                           end_time,
+                           output_filepath,
+                           headers=headers)
+    return copy_part(video_path,
+                     start_time,
+                     end_time,
+                     output_filepath,
+                     headers=headers)
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DOWNLOAD_CHUNK_MB = int(os.environ.get("DOWNLOAD_CHUNK_MB", 32))
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 8))
+
+
+class SlicedDownload:
+    """Downloads a blob with concurrent ranged reads into a local file.
+
+    The first and last chunks are fetched first, since that is where MP4 keeps
+    its index (moov), then the rest in order. available_bytes tracks the
+    contiguous prefix already on disk, so consumers can wait_for() the range
+    they need and start on the head of the file while the tail is still
+    arriving. The file is created at full size, so bytes not downloaded yet
+    read as zeros rather than EOF: only read what has been waited for.
+
+    wait() or close() must be called in the end, close() stops a download
+    that is no longer needed.
+
+    Args:
+        blob: the source blob. Its generation is pinned so every range reads the
+            same object version.
+        destination: local file path.
+        chunk_size: bytes per ranged read (each worker holds one in memory).
+        workers: concurrent ranged reads.
+    """
+
+    def __init__(self,
+                 blob,
+                 destination,
+                 chunk_size=DOWNLOAD_CHUNK_MB * 1024 * 1024,
+                 workers=DOWNLOAD_WORKERS):
+        if blob.size is None:
+            blob.reload()
+        self.blob = blob
+        self.destination = destination
+        self.size = blob.size
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.available_bytes = 0
+        self.elapsed_sec = None
+
+        self._done_chunks = set()
+        self._chunk_count = 0
+        self._error = None
+        self._condition = threading.Condition()
+        self._executor = None
+        self._started_at = None
+        self._fd = None
+
+    def start(self):
+        self._started_at = time.time()
+        with open(self.destination, "wb") as file_obj:
+            file_obj.truncate(self.size)
+
+        chunks = list(range(0, self.size, self.chunk_size))
+        if len(chunks) > 2:
+            chunks = [chunks[0], chunks[-1]] + chunks[1:-1]
+
+        self._chunk_count = len(chunks)
+        self._fd = os.open(self.destination, os.O_WRONLY)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix="download")
+        for start in chunks:
+            self._executor.submit(self._download_chunk, start)
+        if not chunks:
+            self._finish()
+        return self
+
+    def wait_for(self, offset):
+        """Blocks until bytes [0, offset) are on disk."""
+        offset = min(offset, self.size)
+        with self._condition:
+            self._condition.wait_for(lambda: self._error is not None or self.
+                                     available_bytes >= offset)
+            if self._error is not None:
+                raise self._error
+
+    def wait_for_range(self, start, end):
+        """Blocks until bytes [start, end) are on disk, whether or not everything before them is."""
+        end = min(end, self.size)
+        needed = set(
+            range(start // self.chunk_size * self.chunk_size, end,
+                  self.chunk_size))
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._error is not None or self.available_bytes >= end
+                or needed <= self._done_chunks)
+            if self._error is not None:
+                raise self._error
+
+    def wait_for_index(self):
+        """Blocks until the first and last chunks (the container header and index) are on disk."""
+        last_chunk = max(0, (self.size - 1) // self.chunk_size * self.chunk_size)
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._error is not None or self.available_bytes >= self.
+                size or {0, last_chunk} <= self._done_chunks)
+            if self._error is not None:
+                raise self._error
+
+    def wait(self):
+        """Blocks until the whole file is on disk and returns the throughput in bytes/sec."""
+        try:
+            self.wait_for(self.size)
+        finally:
+            self.close()
+        return self.size / max(self.elapsed_sec, 1e-9)
+
+    def close(self):
+        """Stops the download if it is still running and releases its threads and file. Safe to call again.
+
+        Chunks not started yet are dropped, the ones in flight finish first, so
+        nothing writes to the file descriptor after it is closed.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._condition:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            if self.elapsed_sec is None and self._error is None:
+                self._error = RuntimeError(f"Download of {self.blob.name} was stopped")
+            self._condition.notify_all()
+
+    def _download_chunk(self, start):
+        end = min(start + self.chunk_size, self.size)
+        try:
+            # end is inclusive for ranged downloads; ranged reads skip the checksum
+            data = self.blob.download_as_bytes(start=start,
+                                               end=end - 1,
+                                               checksum=None)
+            os.pwrite(self._fd, data, start)
+        except Exception as e:
+            with self._condition:
+                self._error = self._error or e
+                self._condition.notify_all()
+            return
+
+        with self._condition:
+            self._done_chunks.add(start)
+            while self.available_bytes in self._done_chunks:
+                self.available_bytes = min(self.available_bytes + self.chunk_size,
+                                           self.size)
+            if len(self._done_chunks) == self._chunk_count:
+                self._finish()
+            self._condition.notify_all()
+
+    def _finish(self):
+        # Caller holds the condition (or nothing was submitted)
+        os.close(self._fd)
+        self._fd = None
+        self.available_bytes = self.size
+        self.elapsed_sec = time.time() - self._started_at
+
+
+def download(blob, destination, chunk_size=None, workers=None):
+    """Downloads blob to destination with concurrent ranged reads and returns the throughput in bytes/sec."""
+    sliced = SlicedDownload(blob,
+                            destination,
+                            chunk_size=chunk_size or DOWNLOAD_CHUNK_MB * 1024 * 1024,
+                            workers=workers or DOWNLOAD_WORKERS)
+    return sliced.start().wait()
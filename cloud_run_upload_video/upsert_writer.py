@@ -0,0 +1,144 @@
+import os
+import threading
+import time
+
+UPSERT_BATCH_SIZE = int(os.environ.get("UPSERT_BATCH_SIZE", 100))
+UPSERT_MAX_AGE_SEC = float(os.environ.get("UPSERT_MAX_AGE_SEC", 10))
+
+
+class BatchUpsertWriter:
+    """Buffers Vector Search datapoints and upserts them in batches.
+
+    A batch is sent when batch_size datapoints are buffered or the oldest one has
+    waited max_age_sec, whichever comes first. close() does the final flush,
+    waits for batches still being sent (by the age timer or other threads) and
+    must be called at the end of each video.
+
+    upsertDatapoints accepts or rejects a request as a whole, so when a batch is
+    rejected as invalid (400) it is bisected to find the datapoints that caused
+    it. Other errors, such as 403 or 404, would fail every half the same way and
+    fail every datapoint in the batch at once (upsert_fn is expected to have
+    retried 429 and 5xx already, see resilience).
+
+    Args:
+        upsert_fn: takes a list of {"datapointId", "featureVector"} dicts and
+            returns the requests.Response of the upsertDatapoints call.
+        batch_size: maximum datapoints per request.
+        max_age_sec: maximum time a datapoint waits in the buffer.
+        dead_letter: called by close() with the failed datapoints and
+            {id: error}, so they can be replayed later instead of lost.
+    """
+
+    def __init__(self,
+                 upsert_fn,
+                 batch_size=UPSERT_BATCH_SIZE,
+                 max_age_sec=UPSERT_MAX_AGE_SEC,
+                 dead_letter=None):
+        self.upsert_fn = upsert_fn
+        self.batch_size = batch_size
+        self.max_age_sec = max_age_sec
+        self.dead_letter = dead_letter
+
+        self.upserted = 0
+        self.failed = {}  # datapoint id -> error
+        self._failed_datapoints = []
+
+        self._buffer = []
+        self._lock = threading.Lock()
+        # Notified when a batch taken from the buffer has been sent (or failed)
+        self._sent = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, datapoint_id, feature_vector):
+        with self._lock:
+            self._buffer.append({
+                "datapointId": datapoint_id,
+                "featureVector": feature_vector
+            })
+            if len(self._buffer) >= self.batch_size:
+                batch = self._take_batch()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.max_age_sec,
+                                                  self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if batch:
+            self._send_batch(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._take_batch()
+        if batch:
+            self._send_batch(batch)
+
+    def close(self):
+        """Flushes what is left and returns {"upserted": count, "failed": {id: error}}."""
+        self.flush()
+        # A batch the timer took is sent outside the lock, its result must be in before reporting
+        with self._lock:
+            self._sent.wait_for(lambda: self._in_flight == 0)
+        for datapoint_id, error in self.failed.items():
+            print(f"Upsert of {datapoint_id} failed: {error}")
+        print(f"Upserted {self.upserted} datapoints, {len(self.failed)} failed")
+        if self.dead_letter is not None and self._failed_datapoints:
+            self.dead_letter(self._failed_datapoints, dict(self.failed))
+            self._failed_datapoints = []
+        return {"upserted": self.upserted, "failed": dict(self.failed)}
+
+    def _take_batch(self):
+        # Caller holds the lock
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = self._buffer
+        self._buffer = []
+        if batch:
+            self._in_flight += 1
+        return batch
+
+    def _send_batch(self, batch):
+        # For a batch counted as in flight by _take_batch
+        try:
+            self._send(batch)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._sent.notify_all()
+
+    def _send(self, batch):
+        start = time.time()
+        try:
+            response = self.upsert_fn(batch)
+        except Exception as e:
+            self._record_failures(batch, str(e))
+            return
+
+        if response.status_code == 200:
+            with self._lock:
+                self.upserted += len(batch)
+            print(f"Upserted batch of {len(batch)} in {time.time() - start:.2f}s")
+        elif response.status_code == 400 and len(batch) > 1:
+            # Find the invalid datapoints instead of dropping the whole batch
+            middle = len(batch) // 2
+            self._send(batch[:middle])
+            self._send(batch[middle:])
+        else:
+            self._record_failures(batch,
+                                  f"{response.status_code} {response.text}")
+
+    def _record_failures(self, batch, error):
+        with self._lock:
+            for datapoint in batch:
+                self.failed[datapoint["datapointId"]] = error
+            self._failed_datapoints.extend(batch)
+        print(f"Failed to upsert {len(batch)} datapoints: {error}")
@@ -0,0 +1,332 @@
+"""Local stand-in for the Vertex AI endpoints the ingest services and the front-end call.
+
+Serves, over plain HTTP/JSON (the REST shapes of the real APIs):
+
+    POST /v1/projects/*/locations/*/publishers/google/models/*:predict   multimodalembedding
+    POST /v1/projects/*/locations/*/indexes/*:upsertDatapoints
+    POST /v1/projects/*/locations/*/indexes/*:removeDatapoints
+    POST /v1/projects/*/locations/*/indexEndpoints/*:findNeighbors        (MatchServiceClient, rest transport)
+    PATCH /v1/projects/*/locations/*/indexes/*                            batch update from metadata.contentsDeltaUri
+    GET  /v1/projects/*/locations/*/operations/*                          always done
+    GET  /stats                                                           request counts and index size
+
+Embeddings are deterministic: the same text, or the same video and segment
+start, always gets the same unit vector. Every index shares one in-memory
+brute-force (dot product) index. Latency, per-minute quota (answered 429 with
+Retry-After) and error rate can be set per method:
+
+    python vertex_emulator.py --port 8085 --latency-ms predict=2000,upsert=200 --qpm predict=120 --error-rate 0.01
+
+then point the services at it:
+
+    VERTEX_API_BASE=http://localhost:8085                 (ingest services and front-end)
+    VECTOR_SEARCH_API_ENDPOINT=http://localhost:8085      (front-end findNeighbors)
+
+Batch updates read the staged files from a local directory laid out like
+fake_backends.FakeStorageClient (--gcs-root) and are applied before the
+operation is returned.
+
+Authorization headers are accepted and ignored.
+"""
+import argparse
+import collections
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+METHODS = ["predict", "upsert", "remove", "findNeighbors", "update"]
+ROUTES = [
+    (re.compile(r"^/v1/projects/[^/]+/locations/[^/]+/publishers/google/models/[^/:]+:predict$"), "predict"),
+    (re.compile(r"^/v1/projects/[^/]+/locations/[^/]+/indexes/[^/:]+:upsertDatapoints$"), "upsert"),
+    (re.compile(r"^/v1/projects/[^/]+/locations/[^/]+/indexes/[^/:]+:removeDatapoints$"), "remove"),
+    (re.compile(r"^/v1/projects/[^/]+/locations/[^/]+/indexEndpoints/[^/:]+:findNeighbors$"), "findNeighbors"),
+]
+PATCH_ROUTES = [
+    (re.compile(r"^/v1/projects/[^/]+/locations/[^/]+/indexes/[^/:]+$"), "update"),
+]
+OPERATION_ROUTE = re.compile(r"^/v1/(projects/[^/]+/locations/[^/]+/(?:indexes/[^/]+/)?operations/[^/]+)$")
+
+
+class EmulatorError(Exception):
+
+    def __init__(self, code, status, message, retry_after=None):
+        super().__init__(message)
+        self.code = code
+        self.status = status
+        self.retry_after = retry_after
+
+
+def fake_embedding(key, dimension):
+    """Unit vector seeded by key, so repeated calls agree."""
+    seed = int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimension)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class BruteForceIndex:
+    """Datapoints in memory; queries score every vector by dot product."""
+
+    def __init__(self):
+        self._vectors = {}
+        self._matrix = None
+        self._ids = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def upsert(self, datapoints):
+        with self._lock:
+            for datapoint in datapoints:
+                self._vectors[datapoint["datapointId"]] = np.asarray(datapoint["featureVector"], dtype=np.float32)
+            self._matrix = None
+
+    def remove(self, datapoint_ids):
+        with self._lock:
+            for datapoint_id in datapoint_ids:
+                self._vectors.pop(datapoint_id, None)
+            self._matrix = None
+
+    def query(self, vector, neighbor_count):
+        with self._lock:
+            if self._matrix is None:
+                self._ids = list(self._vectors)
+                self._matrix = np.stack([self._vectors[i] for i in self._ids]) if self._ids else None
+            ids, matrix = self._ids, self._matrix
+        if matrix is None:
+            return []
+        vector = np.asarray(vector, dtype=np.float32)
+        if vector.shape[0] != matrix.shape[1]:
+            raise EmulatorError(400, "INVALID_ARGUMENT",
+                                f"query has dimension {vector.shape[0]}, index has {matrix.shape[1]}")
+        scores = matrix @ vector
+        top = np.argsort(-scores)[:neighbor_count]
+        return [(ids[i], float(scores[i])) for i in top]
+
+
+class Limits:
+    """Per-method latency, requests-per-minute quota and error injection."""
+
+    def __init__(self, latency_ms, qpm, error_rate, jitter, seed=0):
+        self.latency_ms = latency_ms
+        self.qpm = qpm
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self._calls = collections.defaultdict(collections.deque)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def admit(self, method):
+        now = time.time()
+        with self._lock:
+            limit = self.qpm.get(method)
+            if limit:
+                calls = self._calls[method]
+                while calls and calls[0] <= now - 60:
+                    calls.popleft()
+                if len(calls) >= limit:
+                    raise EmulatorError(429, "RESOURCE_EXHAUSTED", f"Quota exceeded for {method}: {limit} per minute",
+                                        retry_after=math.ceil(calls[0] + 60 - now))
+                calls.append(now)
+            fail = self._random.random() < self.error_rate
+            delay = self.latency_ms.get(method, 0) / 1000 * (1 + self._random.uniform(-self.jitter, self.jitter))
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            raise EmulatorError(503, "UNAVAILABLE", f"Injected error for {method}")
+
+
+class Emulator:
+
+    def __init__(self, limits, dimension=1408, video_duration_sec=120, storage_client=None):
+        self.limits = limits
+        self.dimension = dimension
+        self.video_duration_sec = video_duration_sec
+        self.storage_client = storage_client
+        self.index = BruteForceIndex()
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+
+    def handle(self, method, body, path=""):
+        """Returns (status, payload, headers)."""
+        self.requests[method] += 1
+        try:
+            self.limits.admit(method)
+            if method == "update":
+                return 200, self.update(body, path), {}
+            return 200, getattr(self, method)(body), {}
+        except EmulatorError as e:
+            self.errors[method] += 1
+            headers = {"Retry-After": str(e.retry_after)} if e.retry_after is not None else {}
+            return e.code, {"error": {"code": e.code, "status": e.status, "message": str(e)}}, headers
+        except (KeyError, TypeError, ValueError) as e:
+            self.errors[method] += 1
+            return 400, {"error": {"code": 400, "status": "INVALID_ARGUMENT", "message": repr(e)}}, {}
+
+    def predict(self, body):
+        dimension = body.get("parameters", {}).get("dimension", self.dimension)
+        predictions = []
+        for instance in body["instances"]:
+            prediction = {}
+            if "text" in instance:
+                prediction["textEmbedding"] = fake_embedding(f"text:{instance['text']}", dimension)
+            if "image" in instance:
+                image = instance["image"]
+                key = image.get("gcsUri") or hashlib.sha256(image.get("bytesBase64Encoded", "").encode()).hexdigest()
+                prediction["imageEmbedding"] = fake_embedding(f"image:{key}", dimension)
+            if "video" in instance:
+                video = instance["video"]
+                config = video.get("videoSegmentConfig", {})
+                start = float(config.get("startOffsetSec", 0))
+                end = min(float(config.get("endOffsetSec", 120)), self.video_duration_sec)
+                interval = float(config.get("intervalSec", 16))
+                segments = []
+                while start < end:
+                    segment_end = min(start + interval, end)
+                    segments.append({
+                        "startOffsetSec": int(start),
+                        "endOffsetSec": int(segment_end),
+                        "embedding": fake_embedding(f"video:{video.get('gcsUri')}#{start}", dimension)
+                    })
+                    start = segment_end
+                prediction["videoEmbeddings"] = segments
+            predictions.append(prediction)
+        return {"predictions": predictions, "deployedModelId": "emulator"}
+
+    def upsert(self, body):
+        self.index.upsert(body["datapoints"])
+        return {}
+
+    def remove(self, body):
+        self.index.remove(body.get("datapointIds", body.get("datapoint_ids", [])))
+        return {}
+
+    def findNeighbors(self, body):
+        nearest_neighbors = []
+        for query in body["queries"]:
+            datapoint = query["datapoint"]
+            neighbors = self.index.query(datapoint["featureVector"], int(query.get("neighborCount", 10)))
+            nearest_neighbors.append({
+                "id": datapoint.get("datapointId", ""),
+                "neighbors": [{"datapoint": {"datapointId": datapoint_id}, "distance": distance}
+                              for datapoint_id, distance in neighbors]
+            })
+        return {"nearestNeighbors": nearest_neighbors}
+
+    def update(self, body, path):
+        uri = body["metadata"]["contentsDeltaUri"]
+        if self.storage_client is None:
+            raise EmulatorError(400, "INVALID_ARGUMENT", f"cannot read {uri}: start the emulator with --gcs-root")
+        import batch_index_writer
+
+        datapoints = list(batch_index_writer.read_staged_datapoints(self.storage_client, uri))
+        self.index.upsert([{"datapointId": d["id"], "featureVector": d["embedding"]} for d in datapoints])
+        operation = f"{path[len('/v1/'):]}/operations/{self.requests['update']}"
+        return {"name": operation, "done": True, "metadata": {"datapoints": len(datapoints)}}
+
+    def stats(self):
+        return {"requests": dict(self.requests), "errors": dict(self.errors), "datapoints": len(self.index)}
+
+
+def make_handler(emulator):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real endpoints
+
+        def do_GET(self):
+            operation = OPERATION_ROUTE.match(self.path.split("?", 1)[0])
+            if self.path == "/stats":
+                self._reply(200, emulator.stats())
+            elif operation:
+                # Updates are applied before they are acknowledged
+                self._reply(200, {"name": operation.group(1), "done": True})
+            else:
+                self._reply(404, {"error": {"code": 404, "status": "NOT_FOUND", "message": self.path}})
+
+        def do_POST(self):
+            self._route(ROUTES)
+
+        def do_PATCH(self):
+            self._route(PATCH_ROUTES)
+
+        def _route(self, routes):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            path = self.path.split("?", 1)[0]
+            for pattern, method in routes:
+                if pattern.match(path):
+                    self._reply(*emulator.handle(method, body, path))
+                    return
+            self._reply(404, {"error": {"code": 404, "status": "NOT_FOUND", "message": path}})
+
+        def _reply(self, status, payload, headers=None):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass  # one line per request drowns the output under load
+
+    return Handler
+
+
+def parse_per_method(value, cast=float):
+    """Parses "predict=2000,upsert=200" into {"predict": 2000.0, "upsert": 200.0}. A bare number applies to every method."""
+    if not value:
+        return {}
+    if "=" not in value:
+        return {method: cast(value) for method in METHODS}
+    result = {}
+    for pair in value.split(","):
+        method, number = pair.split("=")
+        if method not in METHODS:
+            raise argparse.ArgumentTypeError(f"unknown method {method}, expected one of {METHODS}")
+        result[method] = cast(number)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8085)
+    parser.add_argument("--latency-ms", type=parse_per_method, default={}, help="e.g. predict=2000,upsert=200")
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency varies by +/- this fraction")
+    parser.add_argument("--qpm", type=lambda v: parse_per_method(v, int), default={}, help="requests per minute, e.g. predict=120")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests answered 503")
+    parser.add_argument("--dimension", type=int, default=1408)
+    parser.add_argument("--video-duration-sec", type=float, default=120, help="duration assumed for every video part")
+    parser.add_argument("--gcs-root", help="local directory (fake_backends layout) that batch updates read gs:// files from")
+    args = parser.parse_args()
+
+    storage_client = None
+    if args.gcs_root:
+        from fake_backends import FakeStorageClient
+
+        FakeStorageClient.root = args.gcs_root
+        storage_client = FakeStorageClient()
+    emulator = Emulator(Limits(args.latency_ms, args.qpm, args.error_rate, args.jitter),
+                        dimension=args.dimension,
+                        video_duration_sec=args.video_duration_sec,
+                        storage_client=storage_client)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(emulator))
+    print(f"Vertex AI emulator on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Stats: {emulator.stats()}")
+
+
+if __name__ == "__main__":
+    main()
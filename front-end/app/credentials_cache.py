@@ -0,0 +1,80 @@
+import datetime
+import threading
+
+import google.auth
+import google.auth.transport.requests
+
+# Refresh this long before the token actually expires
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+
+class CachedCredentials:
+    """Thread-safe wrapper around google.auth.default() credentials.
+
+    The credentials are loaded once and only refreshed when the token is missing
+    or within REFRESH_MARGIN of expiring, instead of on every call.
+    """
+
+    def __init__(self, scopes=None, refresh_margin=REFRESH_MARGIN):
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+        self.hits = 0
+        self.refreshes = 0
+        self._creds = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns valid credentials, refreshing them first if needed."""
+        with self._lock:
+            if self._creds is None:
+                self._creds, _ = google.auth.default(scopes=self.scopes)
+
+            if self._needs_refresh():
+                self._creds.refresh(google.auth.transport.requests.Request())
+                self.refreshes += 1
+                print(f"Refreshed credentials (scopes={self.scopes}), expiry: {self._creds.expiry}")
+            else:
+                self.hits += 1
+            return self._creds
+
+    def token(self):
+        return self.get().token
+
+    def _needs_refresh(self):
+        if not self._creds.token or self._creds.expiry is None:
+            return True
+        # google.auth keeps expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return self._creds.expiry - now < self.refresh_margin
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(scopes=None):
+    """Returns the process-wide CachedCredentials for these scopes."""
+    key = tuple(scopes) if scopes else None
+    with _providers_lock:
+        if key not in _providers:
+            _providers[key] = CachedCredentials(scopes=scopes)
+        return _providers[key]
+
+
+def get_credentials(scopes=None):
+    return get_provider(scopes).get()
+
+
+def get_token(scopes=None):
+    return get_provider(scopes).token()
+
+
+def stats():
+    """Cache hits and refreshes per scope set, to confirm the refresh rate dropped."""
+    with _providers_lock:
+        return {
+            ",".join(key) if key else "default": {
+                "hits": provider.hits,
+                "refreshes": provider.refreshes
+            } for key, provider in _providers.items()
+        }
@@ -0,0 +1,216 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+# One artifact per part, e.g. "video/tmp/part-0.mp4.embeddings.jsonl", holding every
+# 5 second segment of the part: id, start_sec, end_sec and embedding. This replaces the
+# legacy layout of one "{id}.json" object per segment.
+#
+# EMBEDDINGS_FORMAT picks the artifact encoding:
+#   jsonl    one JSON object per line (.embeddings.jsonl)
+#   float32  binary, exact (.embeddings.bin)
+#   float16  binary, half the size of float32
+#   int8     binary, a quarter of the size, one float32 scale per vector
+EMBEDDINGS_FORMAT = os.environ.get("EMBEDDINGS_FORMAT", "jsonl")
+EMBEDDINGS_SUFFIX = ".embeddings.jsonl"
+BINARY_SUFFIX = ".embeddings.bin"
+LEGACY_SUFFIX = ".json"
+
+# Binary layout, little-endian:
+#
+#   offset 0   header (HEADER_FORMAT, padded with zeros to VECTORS_OFFSET bytes)
+#                magic b"VEMB", version u16, dtype code u8, reserved u8,
+#                count u32, dim u32, index_offset u64
+#   offset 64  vectors: count x dim values of the dtype, row major
+#              int8 only: count float32 scales, vector = int8 values * scale
+#   index_offset
+#              timestamps: count x (start_sec, end_sec) float32, NaN when unknown
+#              ids: utf-8, separated by "\n"
+#
+# The vectors start at a fixed, aligned offset so a local file can be opened with
+# np.memmap, and the index sits at the end so ids can be read with two ranged reads.
+MAGIC = b"VEMB"
+VERSION = 1
+HEADER_FORMAT = "<4sHBBIIQ"
+VECTORS_OFFSET = 64
+DTYPES = {"float32": (0, np.float32), "float16": (1, np.float16), "int8": (2, np.int8)}
+DTYPE_NAMES = {code: name for name, (code, _) in DTYPES.items()}
+
+
+def part_artifact_name(name, fmt=EMBEDDINGS_FORMAT):
+    suffix = EMBEDDINGS_SUFFIX if fmt == "jsonl" else BINARY_SUFFIX
+    return f"{name}{suffix}"
+
+
+def quantize(vectors, dtype):
+    """Returns (values, scales) for a float32 (count, dim) array. scales is None unless dtype is int8."""
+    if dtype != "int8":
+        return vectors.astype(DTYPES[dtype][1]), None
+    # Symmetric per-vector scale so each vector uses the full int8 range
+    scales = np.abs(vectors).max(axis=1, initial=0) / 127
+    scales[scales == 0] = 1
+    values = np.clip(np.rint(vectors / scales[:, None]), -127, 127)
+    return values.astype(np.int8), scales.astype(np.float32)
+
+
+def dequantize(values, scales=None):
+    vectors = np.asarray(values, dtype=np.float32)
+    if scales is not None:
+        vectors = vectors * np.asarray(scales, dtype=np.float32)[:, None]
+    return vectors
+
+
+def encode_binary(records, dtype="float16"):
+    """Encodes embedding records into the binary layout above."""
+    count = len(records)
+    dim = len(records[0]["embedding"]) if records else 0
+    vectors = np.asarray([record["embedding"] for record in records],
+                         dtype=np.float32).reshape(count, dim)
+    values, scales = quantize(vectors, dtype)
+
+    timestamps = np.asarray(
+        [[np.nan if record.get("start_sec") is None else record["start_sec"],
+          np.nan if record.get("end_sec") is None else record["end_sec"]]
+         for record in records],
+        dtype="<f4").reshape(count, 2)
+    ids = "\n".join(record["id"] for record in records).encode("utf-8")
+
+    body = values.astype(values.dtype.newbyteorder("<")).tobytes()
+    if scales is not None:
+        body += scales.astype("<f4").tobytes()
+    index_offset = VECTORS_OFFSET + len(body)
+
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, DTYPES[dtype][0], 0,
+                         count, dim, index_offset)
+    header = header.ljust(VECTORS_OFFSET, b"\0")
+    return header + body + timestamps.tobytes() + ids
+
+
+def read_header(buffer):
+    """Returns (dtype name, count, dim, index_offset) from the first VECTORS_OFFSET bytes."""
+    magic, version, dtype_code, _, count, dim, index_offset = struct.unpack_from(
+        HEADER_FORMAT, buffer)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} embeddings artifact")
+    return DTYPE_NAMES[dtype_code], count, dim, index_offset
+
+
+def decode_index(buffer, count):
+    """Decodes the index region into (ids, timestamps array of shape (count, 2))."""
+    timestamps = np.frombuffer(buffer, dtype="<f4", count=count * 2).reshape(
+        count, 2)
+    ids = bytes(buffer[count * 8:]).decode("utf-8").split("\n") if count else []
+    return ids, timestamps
+
+
+def decode_binary(buffer, mmap_path=None):
+    """Decodes a binary artifact into (ids, timestamps, values, scales).
+
+    values stays in the stored dtype, use dequantize(values, scales) for float32.
+    With mmap_path (a local copy of the same artifact) values and scales are
+    np.memmap views instead of copies.
+    """
+    dtype, count, dim, index_offset = read_header(buffer)
+    numpy_dtype = np.dtype(DTYPES[dtype][1]).newbyteorder("<")
+    vectors_bytes = count * dim * numpy_dtype.itemsize
+
+    if mmap_path is not None:
+        values = np.memmap(mmap_path, dtype=numpy_dtype, mode="r",
+                           offset=VECTORS_OFFSET, shape=(count, dim))
+    else:
+        values = np.frombuffer(buffer, dtype=numpy_dtype, count=count * dim,
+                               offset=VECTORS_OFFSET).reshape(count, dim)
+
+    scales = None
+    if dtype == "int8":
+        if mmap_path is not None:
+            scales = np.memmap(mmap_path, dtype="<f4", mode="r",
+                               offset=VECTORS_OFFSET + vectors_bytes,
+                               shape=(count, ))
+        else:
+            scales = np.frombuffer(buffer, dtype="<f4", count=count,
+                                   offset=VECTORS_OFFSET + vectors_bytes)
+
+    ids, timestamps = decode_index(memoryview(buffer)[index_offset:], count)
+    return ids, timestamps, values, scales
+
+
+def open_binary(path):
+    """Memory-maps a local binary artifact. Returns (ids, timestamps, values, scales)."""
+    with open(path, "rb") as file_obj:
+        header = file_obj.read(VECTORS_OFFSET)
+        _, _, _, index_offset = read_header(header)
+        file_obj.seek(index_offset)
+        index = file_obj.read()
+    # Only the header and index are read, the vectors stay on disk until used
+    buffer = bytearray(header.ljust(index_offset, b"\0") + index)
+    return decode_binary(buffer, mmap_path=path)
+
+
+def write_part_embeddings(bucket, name, records, fmt=EMBEDDINGS_FORMAT):
+    """Writes all the embedding records of one part in a single upload."""
+    blob = bucket.blob(part_artifact_name(name, fmt))
+    if fmt == "jsonl":
+        data = "\n".join(json.dumps(record) for record in records)
+        blob.upload_from_string(data=data, content_type="application/x-ndjson")
+    else:
+        blob.upload_from_string(data=encode_binary(records, fmt),
+                                content_type="application/octet-stream")
+    return blob.name
+
+
+def find_part_artifact(bucket, name):
+    """Returns the artifact blob of a part in whichever format it was written, or None."""
+    for blob in bucket.list_blobs(prefix=f"{name}.embeddings."):
+        return blob
+    return None
+
+
+def read_part_embeddings(blob):
+    """Returns the records of one artifact (any layout) as a list of dicts."""
+    if blob.name.endswith(BINARY_SUFFIX):
+        ids, timestamps, values, scales = decode_binary(blob.download_as_bytes())
+        vectors = dequantize(values, scales)
+        return [{
+            "id": datapoint_id,
+            "start_sec": None if np.isnan(start) else float(start),
+            "end_sec": None if np.isnan(end) else float(end),
+            "embedding": vector.tolist()
+        } for datapoint_id, (start, end), vector in zip(ids, timestamps, vectors)]
+
+    text = blob.download_as_text()
+    if blob.name.endswith(EMBEDDINGS_SUFFIX):
+        return [json.loads(line) for line in text.splitlines() if line]
+    return [json.loads(text)]
+
+
+def read_datapoint_ids(blob):
+    """Reads only the ids of an artifact. For the binary layout that is the header and index, not the vectors."""
+    if blob.name.endswith(BINARY_SUFFIX):
+        header = blob.download_as_bytes(start=0, end=VECTORS_OFFSET - 1)
+        _, count, _, index_offset = read_header(header)
+        ids, _ = decode_index(blob.download_as_bytes(start=index_offset), count)
+        return ids
+    return [record["id"] for record in read_part_embeddings(blob)]
+
+
+def list_datapoint_ids(storage_client, bucket_name, prefix):
+    """Lists the Vector Search datapoint ids stored under prefix, in every layout."""
+    datapoint_ids = []
+    for blob in storage_client.list_blobs(bucket_name, prefix=prefix):
+        if blob.name.endswith((EMBEDDINGS_SUFFIX, BINARY_SUFFIX)):
+            datapoint_ids.extend(read_datapoint_ids(blob))
+        elif blob.name.endswith(LEGACY_SUFFIX):
+            # Legacy per-segment object, the name is the id
+            datapoint_ids.append(blob.name[:-len(LEGACY_SUFFIX)])
+    return datapoint_ids
+
+
+def recall_at_k(vectors, approximate_vectors, queries, k=10):
+    """Fraction of the exact top-k neighbours (by dot product) that the approximate vectors also return."""
+    exact = np.argsort(-(queries @ vectors.T), axis=1)[:, :k]
+    approximate = np.argsort(-(queries @ approximate_vectors.T), axis=1)[:, :k]
+    hits = sum(len(set(e) & set(a)) for e, a in zip(exact, approximate))
+    return hits / exact.size
@@ -7,6 +7,7 @@ from google.cloud import storage
 import vertexai, requests, json, math
 from datetime import datetime, timedelta
 # import utils
+import http_client
 from vertexai.preview.generative_models import GenerativeModel, Part, SafetySetting, Tool
 from vertexai.preview.generative_models import grounding
 
@@ -88,9 +89,10 @@ def upload_audio_file(upload_file, bucket_name, name):
     # encoded_content = base64.b64encode(uploaded_file.read()).decode("utf-8")
 
     # Again leverage signed URLs here to circumvence Cloud Run's 32 MB upload limit
-    response = requests.put(url,
-                            upload_file,
-                            headers={'Content-Type': 'audio/mpeg'})
+    response = http_client.put("upload",
+                               url,
+                               data=upload_file,
+                               headers={'Content-Type': 'audio/mpeg'})
 
     #TODO: review. Returns unsuccessful upon success.
     print(response.status_code)
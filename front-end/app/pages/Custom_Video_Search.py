@@ -1,16 +1,21 @@
+import os
 import streamlit as st
+from google.auth.credentials import AnonymousCredentials
 from google.cloud import aiplatform_v1
 from google.cloud import storage
 import vertexai
 import math
 import utils
+import http_client
+import embedding_store
 from vertexai.generative_models import GenerativeModel, Part
 from vertexai.vision_models import MultiModalEmbeddingModel
-import requests
 
 PROJECT_ID = "videosearch-cloudspace"
 REGION = "us-central1"
-API_ENDPOINT = "1949003250.us-central1-6255484976.vdb.vertexai.goog"
+# Both can point at vertex_emulator.py, e.g. VERTEX_API_BASE=http://localhost:8085 VECTOR_SEARCH_API_ENDPOINT=http://localhost:8085
+VERTEX_API_BASE = os.environ.get("VERTEX_API_BASE", f"https://{REGION}-aiplatform.googleapis.com")
+API_ENDPOINT = os.environ.get("VECTOR_SEARCH_API_ENDPOINT", "1949003250.us-central1-6255484976.vdb.vertexai.goog")
 INDEX_ENDPOINT = "projects/6255484976/locations/us-central1/indexEndpoints/4956743553549074432"
 DEPLOYED_INDEX_ID = "video_search_endpoint_1710342048921"
 INDEX_ID = "7673540028760326144"
@@ -90,9 +95,10 @@ def upload_video_file(uploaded_file, bucket_name):
     # encoded_content = base64.b64encode(uploaded_file.read()).decode("utf-8")
 
     # Again leverage signed URLs here to circumvence Cloud Run's 32 MB upload limit
-    response = requests.put(url,
-                            uploaded_file,
-                            headers={'Content-Type': 'video/mp4'})
+    response = http_client.put("upload",
+                               url,
+                               data=uploaded_file,
+                               headers={'Content-Type': 'video/mp4'})
 
     #TODO: review. Returns unsuccessful upon success.
     print(response.status_code)
@@ -108,6 +114,14 @@ def upload_video_file(uploaded_file, bucket_name):
 
 # Function to get embedding from query text
 def get_query_embedding(query):
+    if VERTEX_API_BASE.startswith("http://"):
+        # Local emulator: same predict call over REST, the SDK only talks to the real endpoint
+        response = http_client.post(
+            "predict",
+            f"{VERTEX_API_BASE}/v1/projects/{PROJECT_ID}/locations/{REGION}/publishers/google/models/multimodalembedding@001:predict",
+            json={"instances": [{"text": query}]})
+        return response.json()["predictions"][0]["textEmbedding"]
+
     model = MultiModalEmbeddingModel.from_pretrained(
         model_name="multimodalembedding@001")
 
@@ -134,8 +148,15 @@ if search_button and query:
 
     client_options = {"api_endpoint": API_ENDPOINT}
 
-    vector_search_client = aiplatform_v1.MatchServiceClient(
-        client_options=client_options, )
+    if API_ENDPOINT.startswith("http://"):
+        # Local emulator: plain HTTP/JSON, no credentials
+        vector_search_client = aiplatform_v1.MatchServiceClient(
+            client_options=client_options,
+            transport="rest",
+            credentials=AnonymousCredentials())
+    else:
+        vector_search_client = aiplatform_v1.MatchServiceClient(
+            client_options=client_options, )
 
     # Build FindNeighborsRequest object
     datapoint = aiplatform_v1.IndexDatapoint(feature_vector=query_embedding)
@@ -368,16 +389,14 @@ delete_button = st.button("Delete")
 def delete_video(video_name):
 
 
-    blobs = storage_client.list_blobs(EMBEDDINGS_BUCKET, prefix=f"{video_name}/tmp")
-
-    blob_list = []
-    for blob in blobs:
-        blob_list.append(blob.name.replace('.json',''))
+    # Reads both the per-part .embeddings.jsonl artifacts and legacy per-segment .json objects
+    blob_list = embedding_store.list_datapoint_ids(storage_client, EMBEDDINGS_BUCKET, f"{video_name}/tmp")
 
     print(f"Deleting...{blob_list}")
 
-    response = requests.post(
-      url = f"https://{REGION}-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}/locations/{REGION}/indexes/{INDEX_ID}:removeDatapoints",
+    response = http_client.post(
+      "remove",
+      url = f"{VERTEX_API_BASE}/v1/projects/{PROJECT_ID}/locations/{REGION}/indexes/{INDEX_ID}:removeDatapoints",
       json={
         "datapoint_ids": blob_list
       },
@@ -4,6 +4,7 @@ from google.cloud import storage
 import vertexai, requests, json, math
 from datetime import datetime
 import utils
+import http_client
 from vertexai.generative_models import GenerativeModel, Part, SafetySetting
 
 PROJECT_ID = "videosearch-cloudspace"
@@ -37,9 +38,10 @@ def upload_video_file(uploaded_file, bucket_name):
     # encoded_content = base64.b64encode(uploaded_file.read()).decode("utf-8")
 
     # Again leverage signed URLs here to circumvence Cloud Run's 32 MB upload limit
-    response = requests.put(url,
-                            uploaded_file,
-                            headers={'Content-Type': 'video/mp4'})
+    response = http_client.put("upload",
+                               url,
+                               data=uploaded_file,
+                               headers={'Content-Type': 'video/mp4'})
 
     #TODO: review. Returns unsuccessful upon success.
     print(response.status_code)
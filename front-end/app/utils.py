@@ -2,35 +2,45 @@ import google.auth.transport.requests
 from google.auth import impersonated_credentials
 import datetime
 import math
+import threading
+import credentials_cache
 
 def getCreds():
-    creds, _ = google.auth.default(
+    # Cached, only refreshed when close to expiry
+    return credentials_cache.get_credentials(
         scopes=['https://www.googleapis.com/auth/cloud-platform'])
-    auth_req = google.auth.transport.requests.Request()
-    creds.refresh(auth_req)
-    return creds
 
 
 #token for removing datapoints from vector search
 def getToken():
-    creds, _ = google.auth.default()
-    auth_req = google.auth.transport.requests.Request()
-    creds.refresh(auth_req)
-    return creds.token
+    return credentials_cache.get_token()
+
+
+_signing_credentials = None
+_signing_credentials_lock = threading.Lock()
+
+
+def getSigningCreds():
+    # Built once from the cached source credentials. Signing goes through the IAM
+    # signBlob API with the source credentials, so this doesn't need its own refresh.
+    global _signing_credentials
+    with _signing_credentials_lock:
+        if _signing_credentials is None:
+            _signing_credentials = impersonated_credentials.Credentials(
+                source_credentials=getCreds(),
+                target_principal=
+                'videosearch-streamlit-frontend@videosearch-cloudspace.iam.gserviceaccount.com',
+                target_scopes='',
+                lifetime=500)
+        return _signing_credentials
 
 
 # Function to get signed GCS urls
 def getSignedURL(filename, bucket, action):
 
     # creds = service_account.Credentials.from_service_account_file('./credentials.json')
-    creds = getCreds()
-
-    signing_credentials = impersonated_credentials.Credentials(
-        source_credentials=creds,
-        target_principal=
-        'videosearch-streamlit-frontend@videosearch-cloudspace.iam.gserviceaccount.com',
-        target_scopes='',
-        lifetime=500)
+    getCreds()  # keeps the shared source credentials fresh
+    signing_credentials = getSigningCreds()
 
     blob = bucket.blob(filename)
 
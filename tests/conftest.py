@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+# The modules are deployed flat (one directory per service), tests import them the same way.
+# cloud_function_video_upload holds copies of the shared ones.
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                    "cloud_run_upload_video"))
+
+from fake_backends import FakeStorageClient
+
+
+@pytest.fixture
+def fake_gcs(tmp_path, monkeypatch):
+    """A FakeStorageClient with its buckets under tmp_path."""
+    monkeypatch.setattr(FakeStorageClient, "root", str(tmp_path / "gcs"))
+    monkeypatch.setattr(FakeStorageClient, "_buckets", {})
+    return FakeStorageClient()
+
+
+@pytest.fixture(scope="session")
+def main_module(tmp_path_factory):
+    """main, imported like benchmark_ingest does: every storage.Client is a FakeStorageClient and no JobQueue worker runs."""
+    work_dir = tmp_path_factory.mktemp("main")
+    os.environ.setdefault("SCRATCH_ROOT", str(work_dir / "scratch"))
+    os.environ["JOB_QUEUE_PATH"] = str(work_dir / "jobs.sqlite3")
+    os.environ["INGEST_WORKERS"] = "0"
+    FakeStorageClient.root = str(work_dir / "gcs")
+    from google.cloud import storage
+    storage.Client = FakeStorageClient
+    import main
+    return main
@@ -0,0 +1,102 @@
+import pytest
+
+import batch_index_writer
+from batch_index_writer import BatchIndexWriter, IndexUpdateInProgress
+from fake_backends import FakeResponse
+
+PREFIX = batch_index_writer.BATCH_STAGING_PREFIX
+IN_PROGRESS = FakeResponse(400, {"error": {"code": 400, "status": "FAILED_PRECONDITION", "message": "update in progress"}})
+
+
+def new_writer(fake_gcs, update_fn, **kwargs):
+    directory, file_prefix = batch_index_writer.staging_location("video", 1234, deferred=False)
+    return BatchIndexWriter(fake_gcs.bucket("staging"),
+                            directory,
+                            file_prefix=file_prefix,
+                            update_fn=update_fn,
+                            file_datapoints=2,
+                            **kwargs)
+
+
+def staged_files(fake_gcs):
+    return sorted(blob.name for blob in fake_gcs.list_blobs("staging"))
+
+
+def test_update_waits_for_the_one_in_progress(fake_gcs):
+    calls = []
+
+    def update(uri):
+        calls.append(uri)
+        if len(calls) < 3:
+            raise IndexUpdateInProgress("update in progress")
+        return "operations/1"
+
+    writer = new_writer(fake_gcs, update, update_wait_sec=60, update_retry_sec=0)
+    for i in range(3):
+        writer.add(f"id-{i}", [0.0])
+    assert writer.close() == {"upserted": 3, "failed": {}}
+    assert writer.operation == "operations/1"
+    assert calls == [f"gs://staging/{PREFIX}video/1234/"] * 3
+
+
+def test_datapoints_fail_once_the_wait_is_over(fake_gcs):
+    calls = []
+
+    def update(uri):
+        calls.append(uri)
+        raise IndexUpdateInProgress("update in progress")
+
+    writer = new_writer(fake_gcs, update, update_wait_sec=0.05, update_retry_sec=0.01)
+    writer.add("a", [0.0])
+    result = writer.close()
+    assert result["upserted"] == 0
+    assert list(result["failed"]) == ["a"]
+    assert 1 < len(calls) <= 6
+
+
+def test_other_errors_fail_without_waiting(fake_gcs):
+    calls = []
+
+    def update(uri):
+        calls.append(uri)
+        raise RuntimeError("Index update failed: 403")
+
+    writer = new_writer(fake_gcs, update, update_wait_sec=60, update_retry_sec=60)
+    writer.add("a", [0.0])
+    assert list(writer.close()["failed"]) == ["a"]
+    assert len(calls) == 1
+
+
+def test_retry_reuses_the_staged_files(fake_gcs):
+    uris = []
+
+    def update(uri):
+        uris.append(uri)
+        if len(uris) == 1:
+            raise RuntimeError("Index update failed: 500")
+        return "operations/1"
+
+    for _ in range(2):
+        writer = new_writer(fake_gcs, update, update_wait_sec=0)
+        for i in range(3):
+            writer.add(f"id-{i}", [0.0])
+        writer.close()
+    assert uris[0] == uris[1]
+    assert staged_files(fake_gcs) == [
+        f"{PREFIX}video/1234/datapoints-0.json", f"{PREFIX}video/1234/datapoints-1.json"
+    ]
+    assert writer.failed == {}
+
+
+def test_deferred_staging_is_named_after_the_generation():
+    assert batch_index_writer.staging_location("dir/video 1", 42, deferred=True) == (PREFIX, "dir_video_1-42")
+
+
+@pytest.mark.parametrize("response, conflict", [
+    (IN_PROGRESS, True),
+    (FakeResponse(409, {"error": {"code": 409, "status": "ABORTED"}}), True),
+    (FakeResponse(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT"}}), False),
+    (FakeResponse(200, {"name": "operations/1"}), False),
+])
+def test_is_update_conflict(response, conflict):
+    assert batch_index_writer.is_update_conflict(response) == conflict
@@ -0,0 +1,70 @@
+import subprocess
+
+import pytest
+
+import change_detector
+import segmenter
+
+
+def make_video(path, duration, slide_sec=0, keyint=None):
+    """A gradient at 25 fps that moves every frame, or only every slide_sec seconds."""
+    step = f"floor(T/{slide_sec})*85" if slide_sec else "N*7"
+    command = [
+        segmenter.FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"color=black:size=320x240:rate=25:duration={duration}",
+        "-vf", f"geq=lum='mod(2*X+Y+{step},256)':cb=128:cr=128",
+        "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p"
+    ]
+    if keyint:
+        command += ["-g", str(keyint)]
+    subprocess.run(command + [path], check=True)
+    return path
+
+
+def test_slides_collapse_to_one_run_each(tmp_path):
+    path = make_video(str(tmp_path / "slides.mp4"), 60, slide_sec=20)
+    frames, times = change_detector.sample_frames(path, keyframes_only=False)
+    runs = change_detector.find_duplicate_runs(frames, times, 60, interval_sec=5)
+    assert runs == [[0, 3], [4, 7], [8, 11]]
+
+
+def test_keyframes_only_never_spans_a_slide_change(tmp_path):
+    # x264's default keyint (250 frames, 10s) is longer than intervalSec: most windows have no keyframe.
+    # The window just before a change has none and can't be told apart, it is embedded on its own.
+    path = make_video(str(tmp_path / "slides.mp4"), 60, slide_sec=20)
+    frames, times = change_detector.sample_frames(path, keyframes_only=True)
+    runs = change_detector.find_duplicate_runs(frames, times, 60, interval_sec=5)
+    assert [first for first, _ in runs][0] == 0 and runs[-1][1] == 11
+    for first, last in runs:
+        # Windows 0-3 show slide 0, 4-7 slide 1, 8-11 slide 2
+        assert first // 4 == last // 4
+    assert len(runs) <= 5
+
+
+def test_moving_picture_keeps_every_window(tmp_path):
+    path = make_video(str(tmp_path / "moving.mp4"), 30, keyint=50)
+    frames, times = change_detector.sample_frames(path)
+    runs = change_detector.find_duplicate_runs(frames, times, 30, interval_sec=5)
+    assert runs == [[window, window] for window in range(6)]
+
+
+def test_keyframes_only_decodes_a_fraction_of_the_frames(tmp_path):
+    path = make_video(str(tmp_path / "moving.mp4"), 30, keyint=50)
+    frames, times = change_detector.sample_frames(path)
+    assert len(frames) == 15
+    assert list(times[:3]) == [0, 2, 4]
+
+
+def test_plan_spans_cover_the_part():
+    plan = change_detector.StaticPlan([[0, 3], [4, 4], [5, 7]], duration=38, interval_sec=5)
+    assert [window for window in range(8) if plan.keeps(window)] == [0, 4, 5]
+    assert plan.span(0) == (0, 20)
+    assert plan.span(5) == (25, 38)
+    assert plan.skipped() == 5
+
+
+def test_only_the_trailing_run_is_trimmed_from_predict():
+    plan = change_detector.StaticPlan([[0, 3], [4, 4], [5, 7]], duration=38, interval_sec=5)
+    # Windows 1-3 are still embedded, only 6 and 7 are past endOffsetSec
+    assert plan.end_offset_sec() == 30
+    assert plan.trimmed() == 2
@@ -0,0 +1,59 @@
+import datetime
+
+import pytest
+
+import credentials_cache
+
+
+class FakeCredentials:
+    """google.auth credentials whose token lasts lifetime from each refresh."""
+
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+        self.token = None
+        self.expiry = None
+        self.refreshes = 0
+
+    def refresh(self, request):
+        self.refreshes += 1
+        self.token = f"token-{self.refreshes}"
+        self.expiry = utcnow() + self.lifetime
+
+
+def utcnow():
+    # google.auth keeps expiry as a naive UTC datetime
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+@pytest.fixture
+def credentials(monkeypatch):
+    creds = FakeCredentials(datetime.timedelta(hours=1))
+    monkeypatch.setattr(credentials_cache.google.auth, "default", lambda scopes=None: (creds, "project"))
+    return creds
+
+
+def test_token_is_reused_until_the_margin(credentials):
+    cache = credentials_cache.CachedCredentials(refresh_margin=datetime.timedelta(minutes=5))
+    assert cache.token() == "token-1"
+    for _ in range(10):
+        assert cache.token() == "token-1"
+    assert (cache.refreshes, cache.hits) == (1, 10)
+
+
+def test_token_is_refreshed_inside_the_margin(credentials):
+    cache = credentials_cache.CachedCredentials(refresh_margin=datetime.timedelta(minutes=5))
+    cache.token()
+    # 6 minutes left: still outside the margin
+    credentials.expiry = utcnow() + datetime.timedelta(minutes=6)
+    assert cache.token() == "token-1"
+    # 4 minutes left: refreshed before it expires
+    credentials.expiry = utcnow() + datetime.timedelta(minutes=4)
+    assert cache.token() == "token-2"
+    assert cache.refreshes == 2
+
+
+def test_providers_are_shared_per_scope_set(credentials, monkeypatch):
+    monkeypatch.setattr(credentials_cache, "_providers", {})
+    scopes = ["https://www.googleapis.com/auth/cloud-platform"]
+    assert credentials_cache.get_provider(scopes) is credentials_cache.get_provider(list(scopes))
+    assert credentials_cache.get_provider(scopes) is not credentials_cache.get_provider()
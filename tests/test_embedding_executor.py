@@ -0,0 +1,83 @@
+import threading
+import time
+
+import pytest
+
+from embedding_executor import EmbeddingExecutor, TokenBucket
+
+
+def test_token_bucket_allows_a_burst_then_the_rate():
+    bucket = TokenBucket(rate_per_minute=600, capacity=3)
+    start = time.monotonic()
+    for _ in range(3):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.05
+    # 10 tokens a second after the burst
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.5 - 0.02
+
+
+def test_token_bucket_is_shared_across_threads():
+    bucket = TokenBucket(rate_per_minute=1200, capacity=1)
+    start = time.monotonic()
+    threads = [threading.Thread(target=lambda: [bucket.acquire() for _ in range(3)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 12 tokens at 20 a second, the first one from the bucket
+    assert time.monotonic() - start >= 11 / 20 - 0.02
+
+
+def test_map_keeps_input_order():
+
+    def predict(part):
+        # Later parts finish first
+        time.sleep((5 - part) * 0.01)
+        return part
+
+    with EmbeddingExecutor(concurrency=5) as executor:
+        assert list(executor.map(predict, range(5))) == [0, 1, 2, 3, 4]
+
+
+def test_map_raises_the_failure_in_order():
+    calls = []
+
+    def predict(part):
+        calls.append(part)
+        if part == 2:
+            raise RuntimeError("predict failed")
+        return part
+
+    with EmbeddingExecutor(concurrency=2) as executor:
+        results = executor.map(predict, range(4))
+        assert next(results) == 0
+        assert next(results) == 1
+        with pytest.raises(RuntimeError, match="predict failed"):
+            next(results)
+
+
+def test_shutdown_cancels_calls_not_started():
+    release = threading.Event()
+    started = []
+
+    def predict(part):
+        started.append(part)
+        release.wait()
+        return part
+
+    executor = EmbeddingExecutor(concurrency=1)
+    futures = [executor.submit(predict, part) for part in range(3)]
+    while not started:
+        time.sleep(0.01)
+    # Shutting down (a failed video) cancels the queued calls, then waits for the one running
+    shutdown = threading.Thread(target=executor.shutdown)
+    shutdown.start()
+    while not futures[2].cancelled():
+        time.sleep(0.01)
+    release.set()
+    shutdown.join()
+    assert futures[0].result() == 0
+    assert all(future.cancelled() for future in futures[1:])
+    assert started == [0]
@@ -0,0 +1,103 @@
+import sys
+
+import numpy as np
+import pytest
+
+import benchmark_quantization
+import embedding_store
+
+DIM = 1408
+# Measured on 2000 random unit vectors: float16 1.0, int8 0.99
+MIN_RECALL = {"float32": 1.0, "float16": 0.99, "int8": 0.95}
+# Largest per-value error of a unit vector
+MAX_ERROR = {"float32": 0, "float16": 1e-3, "int8": 1e-2}
+
+
+def records(count, dim=DIM, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((count, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return [{
+        "id": f"video/tmp/part-0.mp4_{i + 1}",
+        "start_sec": float(i * 5),
+        "end_sec": float(i * 5 + 5),
+        "embedding": vector.tolist()
+    } for i, vector in enumerate(vectors)]
+
+
+def vectors_of(records):
+    return np.asarray([record["embedding"] for record in records], dtype=np.float32)
+
+
+@pytest.mark.parametrize("fmt", ["float32", "float16", "int8"])
+def test_binary_round_trip(fmt):
+    original = records(50)
+    # Unknown timestamps and ids that aren't ASCII survive too
+    original[3]["start_sec"] = original[3]["end_sec"] = None
+    original[4]["id"] = "vidéo/tmp/part-0.mp4_5"
+
+    ids, timestamps, values, scales = embedding_store.decode_binary(embedding_store.encode_binary(original, fmt))
+    assert ids == [record["id"] for record in original]
+    assert np.isnan(timestamps[3]).all()
+    assert timestamps[5].tolist() == [25.0, 30.0]
+    assert values.dtype == np.dtype(embedding_store.DTYPES[fmt][1])
+    assert (scales is not None) == (fmt == "int8")
+    decoded = embedding_store.dequantize(values, scales)
+    assert np.abs(decoded - vectors_of(original)).max() <= MAX_ERROR[fmt]
+
+
+@pytest.mark.parametrize("fmt", ["jsonl", "float32", "float16", "int8"])
+def test_stored_artifact_round_trip(fake_gcs, tmp_path, fmt):
+    bucket = fake_gcs.bucket("embeddings")
+    original = records(20)
+    name = embedding_store.write_part_embeddings(bucket, "video/tmp/part-0.mp4", original, fmt)
+    blob = embedding_store.find_part_artifact(bucket, "video/tmp/part-0.mp4")
+    assert blob.name == name
+
+    stored = embedding_store.read_part_embeddings(blob)
+    assert [record["id"] for record in stored] == [record["id"] for record in original]
+    assert [record["start_sec"] for record in stored] == [record["start_sec"] for record in original]
+    assert np.abs(vectors_of(stored) - vectors_of(original)).max() <= MAX_ERROR.get(fmt, 0)
+    assert embedding_store.read_datapoint_ids(blob) == [record["id"] for record in original]
+
+    if fmt != "jsonl":
+        path = tmp_path / "part.bin"
+        path.write_bytes(blob.download_as_bytes())
+        ids, _, values, scales = embedding_store.open_binary(str(path))
+        assert isinstance(values, np.memmap)
+        assert ids == [record["id"] for record in original]
+        assert np.abs(embedding_store.dequantize(values, scales) - vectors_of(original)).max() <= MAX_ERROR[fmt]
+
+
+def test_empty_part():
+    ids, timestamps, values, scales = embedding_store.decode_binary(embedding_store.encode_binary([], "int8"))
+    assert ids == [] and timestamps.shape == (0, 2) and values.shape == (0, 0)
+
+
+def test_zero_vector_survives_int8():
+    original = records(2)
+    original[0]["embedding"] = [0.0] * DIM
+    _, _, values, scales = embedding_store.decode_binary(embedding_store.encode_binary(original, "int8"))
+    assert not embedding_store.dequantize(values, scales)[0].any()
+
+
+@pytest.mark.parametrize("fmt", ["float32", "float16", "int8"])
+def test_recall_per_quantization_level(fmt):
+    original = records(2000)
+    vectors = vectors_of(original)
+    queries = vectors[np.random.default_rng(1).choice(len(vectors), 200, replace=False)]
+    decoded = benchmark_quantization.decode(embedding_store.encode_binary(original, fmt), fmt)
+    assert embedding_store.recall_at_k(vectors, decoded, queries, k=10) >= MIN_RECALL[fmt]
+
+
+@pytest.mark.parametrize("argv", [[], ["gs://embeddings/video", "--synthetic", "10"]])
+def test_benchmark_needs_a_uri_or_synthetic(monkeypatch, argv):
+    monkeypatch.setattr(sys, "argv", ["benchmark_quantization.py"] + argv)
+    with pytest.raises(SystemExit) as error:
+        benchmark_quantization.main()
+    assert error.value.code == 2
+
+
+def test_benchmark_synthetic(monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["benchmark_quantization.py", "--synthetic", "100", "--queries", "10"])
+    benchmark_quantization.main()
+    assert "int8" in capsys.readouterr().out
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+import resilience
+from ingest_ledger import IngestLedger
+
+
+@pytest.fixture
+def failing_main(main_module, fake_gcs, monkeypatch):
+    monkeypatch.setattr(main_module, "ledger", IngestLedger(fake_gcs.bucket("ledger")))
+
+    def process_video(*args):
+        raise RuntimeError("predict failed")
+
+    monkeypatch.setattr(main_module, "process_video", process_video)
+    return main_module
+
+
+def test_failure_releases_the_claim(failing_main):
+    key = "source/video.mp4/1-abcd"
+    assert failing_main.ledger.claim(key)
+    with pytest.raises(RuntimeError):
+        failing_main.ingest_job(key, "source", "video.mp4", "video")
+    # A redelivery can claim it again
+    assert not failing_main.ledger._blob(key).exists()
+
+
+def test_unclaimed_failure_keeps_the_done_marker(failing_main):
+    # A forced re-ingest (backfill.py without --only-new) of a video production already ingested
+    key = "source/video.mp4/1-abcd"
+    assert failing_main.ledger.claim(key)
+    failing_main.ledger.mark_done(key)
+    with pytest.raises(RuntimeError):
+        failing_main.ingest_job(key, "source", "video.mp4", "video", claimed=False)
+    assert json.loads(failing_main.ledger._blob(key).download_as_text())["state"] == "done"
+
+
+def test_success_clears_superseded_dead_letters(main_module, fake_gcs, monkeypatch):
+    monkeypatch.setattr(main_module, "ledger", IngestLedger(fake_gcs.bucket("ledger")))
+    monkeypatch.setattr(main_module, "dead_letters", resilience.DeadLetterStore(fake_gcs.bucket("ledger")))
+    monkeypatch.setattr(main_module, "process_video", lambda *args: None)
+    # Left by an attempt whose upserts failed, the retry has upserted the video since
+    main_module.dead_letters.put("video", [{"datapointId": "video_1", "featureVector": [0.0]}], {"video_1": "503"})
+    key = "source/video.mp4/1-abcd"
+    assert main_module.ledger.claim(key)
+    main_module.ingest_job(key, "source", "video.mp4", "video")
+    assert main_module.dead_letters.count() == 0
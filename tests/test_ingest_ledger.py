@@ -0,0 +1,54 @@
+import threading
+import time
+
+from ingest_ledger import IngestLedger
+
+KEY = "source/video.mp4/1-abcd"
+
+
+def test_concurrent_claims_have_one_winner(fake_gcs):
+    # One ledger per instance, so only the if_generation_match=0 precondition tells them apart
+    ledgers = [IngestLedger(fake_gcs.bucket("ledger")) for _ in range(8)]
+    barrier = threading.Barrier(len(ledgers))
+    results = [None] * len(ledgers)
+
+    def claim(i):
+        barrier.wait()
+        results[i] = ledgers[i].claim(KEY)
+
+    threads = [threading.Thread(target=claim, args=(i, )) for i in range(len(ledgers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 1
+    assert sum(ledger.stats()["duplicates_suppressed"] for ledger in ledgers) == len(ledgers) - 1
+
+
+def test_expired_claim_is_taken_over(fake_gcs):
+    crashed = IngestLedger(fake_gcs.bucket("ledger"), lease_sec=0)
+    other = IngestLedger(fake_gcs.bucket("ledger"), lease_sec=0)
+    assert crashed.claim(KEY)
+    assert other.claim(KEY)
+    # The first instance finds out when it tries to renew
+    assert not crashed.renew(KEY)
+    assert other.renew(KEY)
+
+
+def test_done_marker_is_never_taken_over(fake_gcs):
+    ledger = IngestLedger(fake_gcs.bucket("ledger"), lease_sec=0)
+    assert ledger.claim(KEY)
+    ledger.mark_done(KEY)
+    assert not IngestLedger(fake_gcs.bucket("ledger"), lease_sec=0).claim(KEY)
+
+
+def test_heartbeat_keeps_a_claim_past_its_lease(fake_gcs):
+    ledger = IngestLedger(fake_gcs.bucket("ledger"), lease_sec=0.5, heartbeat_sec=0.05)
+    other = IngestLedger(fake_gcs.bucket("ledger"), lease_sec=0.5)
+    assert ledger.claim(KEY)
+    with ledger.heartbeat(KEY):
+        time.sleep(1)
+        assert not other.claim(KEY)
+    time.sleep(0.6)
+    # Not renewed since the job ended
+    assert other.claim(KEY)
@@ -0,0 +1,88 @@
+import sqlite3
+import time
+
+from job_queue import FAILED, JobQueue, PermanentJobError, SQLiteJobBackend
+
+
+def run_until_settled(queue, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        counts = queue.counts()
+        if not counts.get("queued") and not counts.get("running"):
+            return counts
+        time.sleep(0.05)
+    raise AssertionError(f"jobs still pending: {queue.counts()}")
+
+
+def test_failed_job_is_retried_up_to_max_attempts(tmp_path):
+    calls = []
+
+    def handler(name):
+        calls.append(name)
+        raise RuntimeError("transient")
+
+    queue = JobQueue(handler,
+                     SQLiteJobBackend(str(tmp_path / "jobs.sqlite3")),
+                     workers=1,
+                     max_attempts=3,
+                     retry_backoff_sec=0)
+    queue.start()
+    queue.submit("job", {"name": "video.mp4"})
+    assert run_until_settled(queue) == {FAILED: 1}
+    assert len(calls) == 3
+
+
+def test_permanent_error_is_not_retried(tmp_path):
+    calls = []
+
+    def handler(name):
+        calls.append(name)
+        raise PermanentJobError("source too large")
+
+    queue = JobQueue(handler, SQLiteJobBackend(str(tmp_path / "jobs.sqlite3")), workers=1, max_attempts=3)
+    queue.start()
+    queue.submit("job", {"name": "video.mp4"})
+    assert run_until_settled(queue) == {FAILED: 1}
+    assert len(calls) == 1
+
+
+def test_retries_back_off(tmp_path):
+    calls = []
+
+    def handler(name):
+        calls.append(time.monotonic())
+        raise RuntimeError("transient")
+
+    queue = JobQueue(handler,
+                     SQLiteJobBackend(str(tmp_path / "jobs.sqlite3")),
+                     workers=1,
+                     max_attempts=3,
+                     retry_backoff_sec=0.3,
+                     poll_sec=0.01)
+    queue.start()
+    queue.submit("job", {"name": "video.mp4"})
+    assert run_until_settled(queue) == {FAILED: 1}
+    # 0.3s before the second attempt, twice that before the third
+    assert calls[1] - calls[0] >= 0.3
+    assert calls[2] - calls[1] >= 0.6
+
+
+def test_delayed_job_is_not_claimed_before_it_is_due(tmp_path):
+    backend = SQLiteJobBackend(str(tmp_path / "jobs.sqlite3"))
+    backend.enqueue("job", {"name": "video.mp4"})
+    job_id, _, _ = backend.claim()
+    backend.fail(job_id, "transient", retry=True, delay_sec=60)
+    assert backend.claim() is None
+    backend.fail(job_id, "transient", retry=True, delay_sec=0)
+    assert backend.claim()[0] == "job"
+
+
+def test_queue_file_of_an_earlier_version_is_migrated(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE jobs (job_id TEXT PRIMARY KEY, payload TEXT NOT NULL, state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)""")
+    conn.execute("""INSERT INTO jobs (job_id, payload, state, created_at, updated_at) VALUES ('job', '{}', 'queued', 0, 0)""")
+    conn.commit()
+    conn.close()
+    assert SQLiteJobBackend(path).claim() == ("job", {}, 1)
@@ -0,0 +1,77 @@
+import subprocess
+
+import pytest
+
+import memory_monitor
+import metrics
+import segmenter
+from fake_backends import FakeLatency, FakeTransferManager, FakeVertex
+from job_queue import PermanentJobError
+
+BUDGET_MB = 256
+# Without the budget the 1200s job peaks ~140 MB above the 300s one (it downloads the source)
+MAX_GROWTH_MB = 32
+
+
+def make_video(path, duration):
+    """A 320x240 moving test pattern, large enough (~0.2 MB per second) for a local copy to show."""
+    subprocess.run([
+        segmenter.FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size=320x240:rate=15:duration={duration}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-crf", "8", "-g", "30",
+        "-pix_fmt", "yuv420p", path
+    ], check=True)
+
+
+@pytest.fixture
+def ingest(main_module, fake_gcs, monkeypatch):
+    """Runs main.process_video against the fakes, like benchmark_ingest. Returns the job's peak memory in MB."""
+    storage_client = main_module.storage_client
+    vertex = FakeVertex(storage_client, predict=FakeLatency(), upsert=FakeLatency())
+    monkeypatch.setattr(main_module, "http_client", vertex)
+    monkeypatch.setattr(main_module, "getToken", lambda: "test")
+    monkeypatch.setattr(main_module, "transfer_manager", FakeTransferManager)
+    # The fake objects are local files
+    monkeypatch.setattr(main_module, "probe_source_duration", lambda bucket_name, name: segmenter.probe_duration(
+        storage_client.bucket(bucket_name).blob(name).path))
+    monkeypatch.setattr(main_module, "source_url", lambda bucket_name, name: storage_client.bucket(bucket_name).blob(name).path)
+    monkeypatch.setattr(main_module, "source_headers", lambda: None)
+
+    def run(duration, mode="streaming"):
+        name = f"video-{duration}s.mp4"
+        make_video(storage_client.bucket("source").blob(name).path, duration)
+        metrics.reset()
+        main_module.process_video("source", name, name.replace(".mp4", ""), mode=mode)
+        peaks = [metric for metric in metrics.snapshot() if metric["name"] == "ingest_job_peak_memory_bytes"]
+        assert peaks[0]["count"] == 1
+        return peaks[0]["sum"] / 2**20
+
+    return run
+
+
+def test_memory_stays_flat_as_videos_get_longer(ingest, monkeypatch):
+    monkeypatch.setattr(memory_monitor, "JOB_MEMORY_BUDGET_MB", BUDGET_MB)
+    short = ingest(300)
+    long = ingest(1200)
+    assert long <= BUDGET_MB
+    assert long - short <= MAX_GROWTH_MB
+
+
+def test_phased_mode_refuses_a_source_over_the_budget(ingest, monkeypatch):
+    monkeypatch.setattr(memory_monitor, "JOB_MEMORY_BUDGET_MB", 16)
+    with pytest.raises(PermanentJobError):
+        ingest(300, mode="phased")
+
+
+def test_no_headroom_fails_instead_of_continuing(tmp_path):
+    with memory_monitor.MemoryMonitor("job", scratch_dir=str(tmp_path), budget_mb=1, interval_sec=0.01) as monitor:
+        # Scratch files count as memory, exactly
+        (tmp_path / "part-0.mp4").write_bytes(b"\0" * 2 * 2**20)
+        with pytest.raises(memory_monitor.MemoryBudgetExceeded):
+            monitor.wait_for_headroom(timeout=0.1)
+        with pytest.raises(memory_monitor.MemoryBudgetExceeded):
+            monitor.check()
+        (tmp_path / "part-0.mp4").unlink()
+        with pytest.raises(memory_monitor.MemoryBudgetExceeded):
+            # More than the whole budget can never fit
+            monitor.wait_for_headroom(2 * 2**20)
@@ -0,0 +1,72 @@
+import os
+import subprocess
+
+import pytest
+
+import mp4_index
+import segmenter
+
+
+def make_video(path, duration, faststart=False):
+    command = [
+        segmenter.FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=duration={duration}:size=320x240:rate=25",
+        "-f", "lavfi", "-i", f"sine=duration={duration}",
+        "-c:v", "libx264", "-g", "25", "-c:a", "aac", "-shortest"
+    ]
+    if faststart:
+        command += ["-movflags", "+faststart"]
+    subprocess.run(command + [path], check=True)
+    return path
+
+
+def frame_hashes(path):
+    completed = subprocess.run(
+        [segmenter.FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-i", path, "-map", "0:v:0",
+         "-f", "framemd5", "-"],
+        stdout=subprocess.PIPE,
+        check=True)
+    return [line.split(b",")[-1] for line in completed.stdout.splitlines() if not line.startswith(b"#")]
+
+
+@pytest.mark.parametrize("faststart", [False, True])
+def test_bytes_needed_grows_with_time_and_covers_the_file(tmp_path, faststart):
+    path = make_video(str(tmp_path / "video.mp4"), 20, faststart)
+    size = os.path.getsize(path)
+    index = mp4_index.load(path, size)
+
+    needed = [index.bytes_needed(end_sec) for end_sec in range(0, 25)]
+    assert needed == sorted(needed)
+    assert 0 < needed[5] < needed[15] < size
+    assert needed[-1] <= size
+
+
+def test_part_cut_from_partial_download_matches_full_file(tmp_path):
+    """Only the bytes the index asks for (and the moov at the tail) are on disk, the rest are zeros."""
+    path = make_video(str(tmp_path / "video.mp4"), 20)
+    size = os.path.getsize(path)
+    with open(path, "rb") as source:
+        data = source.read()
+
+    waited = []
+    index = mp4_index.load(path, size, lambda start, end: waited.append((start, end)))
+    # The moov box is read last, its payload starts after an 8 byte header
+    moov_start = waited[-1][0] - 8
+    needed = index.bytes_needed(8 + 1)
+
+    partial = str(tmp_path / "partial.mp4")
+    with open(partial, "wb") as file_obj:
+        file_obj.truncate(size)
+        file_obj.write(data[:needed])
+        file_obj.seek(moov_start)
+        file_obj.write(data[moov_start:])
+
+    for source, output in [(path, "full-part.mp4"), (partial, "partial-part.mp4")]:
+        segmenter.encode_part(source, 2, 8, str(tmp_path / output), threads=1)
+    assert frame_hashes(str(tmp_path / "partial-part.mp4")) == frame_hashes(str(tmp_path / "full-part.mp4"))
+
+
+def test_not_an_mp4(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"\0" * 1000)
+    assert mp4_index.load(str(path), 1000) is None
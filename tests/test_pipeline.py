@@ -0,0 +1,47 @@
+import threading
+
+import pytest
+
+from pipeline import run_pipeline
+
+
+def pipeline_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith("pipeline-")]
+
+
+def test_outputs_are_in_source_order():
+    stages = [("double", lambda item: item * 2), ("add", lambda item: item + 1)]
+    assert run_pipeline(range(10), stages) == [item * 2 + 1 for item in range(10)]
+
+
+def test_failed_stage_stops_the_pipeline():
+    produced = []
+    stored = []
+
+    def source():
+        for item in range(100):
+            produced.append(item)
+            yield item
+
+    def predict(item):
+        if item == 3:
+            raise RuntimeError("predict failed")
+        return item
+
+    with pytest.raises(RuntimeError, match="predict failed"):
+        run_pipeline(source(), [("predict", predict), ("store", stored.append)], queue_size=2)
+    # The source stops a few items (the queues) after the failure, and every stage thread has exited
+    assert len(produced) < 10
+    assert 3 not in stored
+    assert pipeline_threads() == []
+
+
+def test_failed_source_stops_the_pipeline():
+
+    def source():
+        yield 1
+        raise RuntimeError("split failed")
+
+    with pytest.raises(RuntimeError, match="split failed"):
+        run_pipeline(source(), [("upload", lambda item: item)])
+    assert pipeline_threads() == []
@@ -0,0 +1,83 @@
+import threading
+import time
+
+import progress_manifest
+from progress_manifest import ProgressManifest
+
+PARTS = [f"/tmp/part-{part}.mp4" for part in range(50)]
+CUTS = [(part * 120.0, (part + 1) * 120.0, False) for part in range(50)]
+
+
+def counting_uploads(manifest):
+    """Records the time of every write to the manifest object."""
+    writes = []
+    upload = manifest.blob.upload_from_string
+
+    def counted(data, **kwargs):
+        writes.append(time.monotonic())
+        return upload(data, **kwargs)
+
+    manifest.blob.upload_from_string = counted
+    return writes
+
+
+def test_marks_are_coalesced_to_one_write_per_interval(fake_gcs):
+    manifest = ProgressManifest(fake_gcs.bucket("out"), "video", 1, save_interval_sec=0.2)
+    manifest.set_plan(PARTS, CUTS)
+    writes = counting_uploads(manifest)
+
+    threads = [
+        threading.Thread(target=lambda stage=stage: [manifest.mark(part, stage) for part in PARTS])
+        for stage in (progress_manifest.ENCODED, progress_manifest.UPLOADED, progress_manifest.EMBEDDED)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for part in PARTS:
+        manifest.mark(part, progress_manifest.UPSERTED)
+    manifest.flush()
+
+    assert len(writes) <= 3
+    assert all(later - earlier >= 0.19 for earlier, later in zip(writes, writes[1:]))
+
+    reloaded = ProgressManifest(fake_gcs.bucket("out"), "video", 1)
+    assert reloaded.load()
+    assert reloaded.summary() == {stage: len(PARTS) for stage in reloaded.summary()}
+
+
+def test_pending_updates_are_saved_by_the_timer(fake_gcs):
+    manifest = ProgressManifest(fake_gcs.bucket("out"), "video", 1, save_interval_sec=0.1)
+    manifest.set_plan(PARTS, CUTS)
+    manifest.mark(PARTS[0], progress_manifest.ENCODED)
+    time.sleep(0.3)
+
+    reloaded = ProgressManifest(fake_gcs.bucket("out"), "video", 1)
+    assert reloaded.load()
+    assert reloaded.done(PARTS[0], progress_manifest.ENCODED)
+
+
+def test_failed_save_does_not_fail_mark(fake_gcs):
+    manifest = ProgressManifest(fake_gcs.bucket("out"), "video", 1, save_interval_sec=0.05)
+    manifest.set_plan(PARTS, CUTS)
+    upload = manifest.blob.upload_from_string
+    failures = [RuntimeError("429 Too Many Requests")]
+
+    def flaky(data, **kwargs):
+        if failures:
+            raise failures.pop()
+        return upload(data, **kwargs)
+
+    manifest.blob.upload_from_string = flaky
+    time.sleep(0.1)
+    manifest.mark(PARTS[0], progress_manifest.ENCODED)
+    time.sleep(0.2)
+
+    reloaded = ProgressManifest(fake_gcs.bucket("out"), "video", 1)
+    assert reloaded.load()
+    assert reloaded.done(PARTS[0], progress_manifest.ENCODED)
+
+
+def test_other_generation_is_ignored(fake_gcs):
+    ProgressManifest(fake_gcs.bucket("out"), "video", 1).set_plan(PARTS, CUTS)
+    assert not ProgressManifest(fake_gcs.bucket("out"), "video", 2).load()
@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+
+import resilience
+from fake_backends import FakeResponse
+
+
+def endpoint():
+    return resilience.ResilientEndpoint(
+        "test",
+        resilience.AIMDLimiter("test", 4),
+        breaker=resilience.CircuitBreaker("test",
+                                          failure_threshold=1,
+                                          reset_sec=0.05),
+        policy=resilience.RetryPolicy(max_attempts=1, base_delay_sec=0))
+
+
+def call_within(endpoint, send, timeout=2):
+    """Runs endpoint.call(send) in a thread, returns its outcome or fails if it hangs."""
+    outcome = {}
+
+    def run():
+        try:
+            outcome["response"] = endpoint.call(send)
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "call blocked on the circuit breaker"
+    return outcome
+
+
+def test_retries_5xx_then_succeeds():
+    ep = endpoint()
+    ep.policy.max_attempts = 3
+    ep.breaker.failure_threshold = 5
+    responses = iter([FakeResponse(503, {}), FakeResponse(200, {"ok": True})])
+    assert ep.call(lambda: next(responses)).status_code == 200
+    assert ep.breaker.state == "closed"
+
+
+def test_other_4xx_returned_without_retry():
+    ep = endpoint()
+    ep.policy.max_attempts = 3
+    calls = []
+    response = ep.call(lambda: calls.append(1) or FakeResponse(400, {}))
+    assert response.status_code == 400
+    assert len(calls) == 1
+
+
+def test_probe_raising_does_not_leave_breaker_half_open():
+    ep = endpoint()
+    with pytest.raises(resilience.RetriesExhausted):
+        ep.call(lambda: FakeResponse(503, {}))
+    assert ep.breaker.state == "open"
+
+    def token_error():
+        raise RuntimeError("token refresh failed")
+
+    outcome = call_within(ep, token_error)
+    assert isinstance(outcome["error"], RuntimeError)
+    assert ep.breaker.state == "open"
+
+    # The next call gets its own probe once reset_sec has passed
+    outcome = call_within(ep, lambda: FakeResponse(200, {}))
+    assert outcome["response"].status_code == 200
+    assert ep.breaker.state == "closed"
+
+
+def test_error_outside_probe_does_not_count_towards_breaker():
+    ep = endpoint()
+
+    def token_error():
+        raise RuntimeError("token refresh failed")
+
+    with pytest.raises(RuntimeError):
+        ep.call(token_error)
+    assert ep.breaker.state == "closed"
+    assert ep.breaker.failures == 0
+
+
+def test_clear_only_deletes_the_videos_dead_letters(fake_gcs):
+    store = resilience.DeadLetterStore(fake_gcs.bucket("ledger"))
+    for video in ["video", "video", "video10"]:
+        store.put(video, [{"datapointId": f"{video}_1", "featureVector": [0.0]}], {f"{video}_1": "503"})
+    assert store.clear("video") == 2
+    upserted = []
+    assert store.replay(lambda datapoints: upserted.extend(datapoints) or FakeResponse(200, {})) == {
+        "replayed": 1,
+        "remaining": 0
+    }
+    assert [datapoint["datapointId"] for datapoint in upserted] == ["video10_1"]
@@ -0,0 +1,22 @@
+import pytest
+
+import scratch
+from scratch import ScratchQuotaExceeded, ScratchWorkspace
+
+
+def test_source_fits_leaves_room_for_the_parts(monkeypatch):
+    monkeypatch.setattr(scratch, "JOB_SCRATCH_QUOTA_MB", 2048)
+    monkeypatch.setattr(scratch, "SCRATCH_RESERVE_FACTOR", 2)
+    assert scratch.source_fits(1024 * 2**20)
+    assert not scratch.source_fits(1024 * 2**20 + 1)
+    assert not scratch.source_fits(3 * 2**30)
+
+
+def test_check_quota_raises_past_the_job_quota(tmp_path, monkeypatch):
+    monkeypatch.setattr(scratch, "SCRATCH_ROOT", str(tmp_path))
+    with ScratchWorkspace("video") as workspace:
+        workspace.quota_bytes = 1000
+        with open(workspace.path("part-0.mp4"), "wb") as part:
+            part.write(b"\0" * 1001)
+        with pytest.raises(ScratchQuotaExceeded):
+            workspace.check_quota()
@@ -0,0 +1,170 @@
+import math
+import random
+import re
+import subprocess
+
+import pytest
+
+import segmenter
+
+EPSILON = 1e-6
+FPS = 30
+CHECKSUM_PATTERN = re.compile(r"checksum:(\w+)")
+
+
+def random_case(rng):
+    """A video duration, its keyframes (regular GOP, scene cuts, or none) and the planning settings."""
+    interval_sec = rng.choice([1, 2, 5, 10])
+    max_segment_sec = rng.choice([interval_sec, 3 * interval_sec, 30, 120, 121.5])
+    tolerance_sec = rng.choice([0, 0.1, 0.5]) * interval_sec / 2
+    duration = rng.choice([
+        round(rng.uniform(0.1, 1000), 3),
+        float(rng.randint(1, 60) * interval_sec),
+        rng.randint(1, 60) * interval_sec + rng.choice([-1, 1]) * EPSILON / 10,
+    ])
+    kind = rng.choice(["gop", "scene_cuts", "none"])
+    if kind == "gop":
+        gop = rng.choice([0.5, 1, 2, 2.002, 4.004, 8.3417])
+        keyframes = [k * gop for k in range(int(duration / gop) + 1)]
+    elif kind == "scene_cuts":
+        keyframes = [0.0] + [rng.uniform(0, duration) for _ in range(rng.randint(0, 200))]
+    else:
+        keyframes = None
+    return dict(duration=duration,
+                keyframes=keyframes,
+                max_segment_sec=max_segment_sec,
+                interval_sec=interval_sec,
+                keyframe_tolerance_sec=tolerance_sec)
+
+
+def windows(start, end, interval_sec):
+    """Start times (in the video) of the windows a predict call makes of the part [start, end]."""
+    count = math.ceil((end - start) / interval_sec - EPSILON)
+    return [start + i * interval_sec for i in range(count)]
+
+
+CASES = [random_case(random.Random(seed)) for seed in range(40)]
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_parts_cover_the_video_exactly(case):
+    cuts = segmenter.plan_segments(**case)
+    assert cuts[0][0] == 0
+    assert cuts[-1][1] == case["duration"]
+    for (_, end, _), (start, _, _) in zip(cuts, cuts[1:]):
+        assert start == end
+    limit = max(case["max_segment_sec"], case["interval_sec"])
+    for start, end, _ in cuts:
+        assert 0 < end - start <= limit + EPSILON
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_every_interval_is_embedded_exactly_once(case):
+    interval_sec = case["interval_sec"]
+    cuts = segmenter.plan_segments(**case)
+    starts = [start for part_start, end, _ in cuts for start in windows(part_start, end, interval_sec)]
+    # One window per interval of the video: none lost, no sliver window embedding one twice
+    assert len(starts) == math.ceil(case["duration"] / interval_sec - EPSILON)
+    for k, start in enumerate(starts):
+        assert abs(start - k * interval_sec) <= case["keyframe_tolerance_sec"] + EPSILON
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_only_parts_between_keyframes_are_copied(case):
+    cuts = segmenter.plan_segments(**case)
+    keyframes = set(case["keyframes"] or [])
+    for start, end, reencode in cuts:
+        if not reencode:
+            assert start in keyframes | {0.0}
+            assert end in keyframes | {case["duration"]}
+        if case["keyframes"] is None:
+            assert reencode
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_no_more_parts_than_cutting_on_the_grid(case):
+    interval_sec = case["interval_sec"]
+    longest = max(case["max_segment_sec"], interval_sec) // interval_sec * interval_sec
+    cuts = segmenter.plan_segments(**case)
+    assert len(cuts) <= math.ceil(case["duration"] / longest - EPSILON)
+
+
+def test_copies_between_keyframes_on_the_grid():
+    cuts = segmenter.plan_segments(300, [k * 2.0 for k in range(150)], max_segment_sec=120, interval_sec=5)
+    assert cuts == [(0.0, 120.0, False), (120.0, 240.0, False), (240.0, 300.0, False)]
+
+
+def test_no_sliver_window_after_a_late_keyframe():
+    # Copying 0-5.3 and 5.3-10 would make 3 windows of a 10s video, the second one 0.3s long
+    cuts = segmenter.plan_segments(10, [0.0, 5.3], max_segment_sec=6, interval_sec=5)
+    assert cuts == [(0.0, 5.0, True), (5.0, 10.0, True)]
+
+
+def test_early_keyframe_can_still_be_copied_to():
+    # Each part has one window, the first one 0.3s short
+    cuts = segmenter.plan_segments(14.5, [0.0, 4.7, 9.7], max_segment_sec=6, interval_sec=5)
+    assert cuts == [(0.0, 4.7, False), (4.7, 9.7, False), (9.7, 14.5, False)]
+
+
+def test_empty_video():
+    assert segmenter.plan_segments(0) == []
+
+
+def make_video(path, duration, keyframes):
+    """A 160x120 test pattern with a tone, with keyframes only at the given times."""
+    subprocess.run([
+        segmenter.FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size=160x120:rate={FPS}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=duration={duration}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-g", "100000",
+        "-force_key_frames", ",".join(str(t) for t in keyframes),
+        "-c:a", "aac", "-shortest", path
+    ], check=True)
+    return path
+
+
+def frame_checksums(path):
+    """The checksum of every decoded video frame, in order."""
+    completed = subprocess.run([
+        segmenter.FFMPEG_BINARY, "-hide_banner", "-nostats", "-i", path,
+        "-map", "0:v:0", "-vf", "showinfo", "-f", "null", "-"
+    ], stderr=subprocess.PIPE, check=True)
+    return CHECKSUM_PATTERN.findall(completed.stderr.decode("utf-8", errors="ignore"))
+
+
+@pytest.fixture(scope="module")
+def keyframed_video(tmp_path_factory):
+    # Keyframes a few frames before the 12s grid points, at times ffmpeg prints rounded
+    # down (11.633333 for frame 349): a copy that seeks to the rounded time starts a GOP early
+    return make_video(str(tmp_path_factory.mktemp("video") / "source.mp4"), 26.5, [0, 349 / FPS, 709 / FPS])
+
+
+def test_copied_parts_start_on_their_keyframe(keyframed_video, tmp_path):
+    cuts = segmenter.plan_segments(segmenter.probe_duration(keyframed_video),
+                                   segmenter.list_keyframes(keyframed_video),
+                                   max_segment_sec=12,
+                                   interval_sec=1)
+    assert [reencode for _, _, reencode in cuts] == [False, False, False]
+    source = frame_checksums(keyframed_video)
+    for part, cut in enumerate(cuts):
+        start, end, _ = cut
+        frames = frame_checksums(segmenter.write_video_part(keyframed_video, cut, str(tmp_path / f"part-{part}.mp4")))
+        # Starts with the source frame at its start time, and is as long as planned
+        assert frames[0] == source[round(start * FPS)]
+        assert len(frames) == round(end * FPS) - round(start * FPS)
+
+
+@pytest.mark.parametrize("copy", [True, False])
+def test_parts_have_no_gap_or_overlap(keyframed_video, tmp_path, copy):
+    keyframes = segmenter.list_keyframes(keyframed_video) if copy else None
+    cuts = segmenter.plan_segments(segmenter.probe_duration(keyframed_video), keyframes, max_segment_sec=12, interval_sec=1)
+    parts = [
+        frame_checksums(segmenter.write_video_part(keyframed_video, cut, str(tmp_path / f"part-{part}.mp4")))
+        for part, cut in enumerate(cuts)
+    ]
+    source = frame_checksums(keyframed_video)
+    # Every source frame is in exactly one part
+    assert sum(len(frames) for frames in parts) == len(source)
+    if copy:
+        # Stream copies decode to the very same frames
+        assert [checksum for frames in parts for checksum in frames] == source
@@ -0,0 +1,59 @@
+import os
+import threading
+
+import pytest
+
+from fake_backends import FakeLatency, FakeStorageClient
+from sliced_download import SlicedDownload
+
+CHUNK = 1024
+
+
+def source_blob(fake_gcs, size):
+    bucket = fake_gcs.bucket("source")
+    blob = bucket.blob("video.mp4")
+    blob.upload_from_string(os.urandom(size))
+    return blob
+
+
+def test_downloads_every_chunk(fake_gcs, tmp_path):
+    blob = source_blob(fake_gcs, 10 * CHUNK + 7)
+    destination = str(tmp_path / "video.mp4")
+    SlicedDownload(blob, destination, chunk_size=CHUNK, workers=3).start().wait()
+    with open(destination, "rb") as downloaded, open(blob.path, "rb") as source:
+        assert downloaded.read() == source.read()
+
+
+def test_wait_for_range_only_needs_its_chunks(fake_gcs, tmp_path):
+    blob = source_blob(fake_gcs, 10 * CHUNK)
+    download = SlicedDownload(blob, str(tmp_path / "video.mp4"), chunk_size=CHUNK, workers=1).start()
+    # The last chunk is fetched second, before the middle of the file
+    download.wait_for_range(9 * CHUNK + 10, 10 * CHUNK)
+    assert 9 * CHUNK in download._done_chunks
+    download.wait()
+
+
+def test_close_stops_a_running_download(fake_gcs, tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeStorageClient, "gcs", FakeLatency(latency_ms=20))
+    blob = source_blob(fake_gcs, 100 * CHUNK)
+    download = SlicedDownload(blob, str(tmp_path / "video.mp4"), chunk_size=CHUNK, workers=2).start()
+
+    errors = []
+
+    def consumer():
+        try:
+            download.wait_for(download.size)
+        except RuntimeError as e:
+            errors.append(e)
+
+    waiter = threading.Thread(target=consumer)
+    waiter.start()
+    download.close()
+    waiter.join(5)
+
+    assert not waiter.is_alive()
+    assert errors, "a consumer waiting on a stopped download must not hang"
+    assert download._fd is None
+    assert len(download._done_chunks) < 100
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith("download")]
+    download.close()
@@ -0,0 +1,77 @@
+import threading
+import time
+
+from fake_backends import FakeResponse
+from upsert_writer import BatchUpsertWriter
+
+
+def test_full_batches_are_sent_and_counted():
+    batches = []
+    writer = BatchUpsertWriter(lambda batch: batches.append(batch) or FakeResponse(200, {}),
+                               batch_size=2,
+                               max_age_sec=60)
+    for i in range(5):
+        writer.add(f"id-{i}", [0.0])
+    assert writer.close() == {"upserted": 5, "failed": {}}
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+
+
+def test_invalid_datapoint_is_isolated_by_bisection():
+
+    def upsert(batch):
+        if any(datapoint["datapointId"] == "bad" for datapoint in batch):
+            return FakeResponse(400, {"error": "invalid"})
+        return FakeResponse(200, {})
+
+    writer = BatchUpsertWriter(upsert, batch_size=4, max_age_sec=60)
+    for datapoint_id in ["a", "b", "bad", "c"]:
+        writer.add(datapoint_id, [0.0])
+    result = writer.close()
+    assert result["upserted"] == 3
+    assert list(result["failed"]) == ["bad"]
+
+
+def test_other_client_errors_fail_the_batch_without_bisecting():
+    batches = []
+
+    def upsert(batch):
+        batches.append(batch)
+        return FakeResponse(403, {"error": "permission denied"})
+
+    writer = BatchUpsertWriter(upsert, batch_size=4, max_age_sec=60)
+    for datapoint_id in ["a", "b", "c", "d"]:
+        writer.add(datapoint_id, [0.0])
+    result = writer.close()
+    assert len(batches) == 1
+    assert result["upserted"] == 0
+    assert sorted(result["failed"]) == ["a", "b", "c", "d"]
+
+
+def test_close_waits_for_batch_sent_by_timer():
+    started = threading.Event()
+    release = threading.Event()
+    dead_lettered = []
+
+    def slow_failing_upsert(batch):
+        started.set()
+        release.wait(5)
+        return FakeResponse(503, {})
+
+    writer = BatchUpsertWriter(slow_failing_upsert,
+                               batch_size=100,
+                               max_age_sec=0.01,
+                               dead_letter=lambda datapoints, errors: dead_lettered.extend(datapoints))
+    writer.add("id-0", [0.0])
+    assert started.wait(5)
+
+    result = {}
+    closer = threading.Thread(target=lambda: result.update(writer.close()))
+    closer.start()
+    time.sleep(0.1)
+    assert closer.is_alive(), "close() returned while a batch was still being sent"
+
+    release.set()
+    closer.join(5)
+    assert result["upserted"] == 0
+    assert list(result["failed"]) == ["id-0"]
+    assert [datapoint["datapointId"] for datapoint in dead_lettered] == ["id-0"]